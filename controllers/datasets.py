@@ -1,9 +1,16 @@
 import shutil
 import hashlib
 import datetime
+from gluon.serializers import loads_json
 from safe_web_global_functions import datepicker_script
-from safe_web_datasets import (submit_dataset_to_zenodo, dataset_description, 
-                               generate_inspire_xml, update_published_metadata)
+from safe_web_db_indexes import check_indexes, explain_api_queries
+from safe_web_validator_service import verify_dataset_task
+from safe_web_datasets import (dataset_description, generate_inspire_xml, 
+                               update_published_metadata,
+                               update_search_documents as rebuild_search_documents,
+                               update_taxon_closure as rebuild_taxon_closure,
+                               update_taxon_summary as rebuild_taxon_summary,
+                               bump_catalogue_generation, log_catalogue_changes)
 
 
 def view_datasets():
@@ -162,7 +169,19 @@ def administer_datasets():
                                                       _href=URL('projects','project_view',
                                                                 args=[value]))
     table.dataset_check_outcome.represent =  lambda value, row: approval_icons[value]
-    table.zenodo_submission_status.represent =  lambda value, row: approval_icons[value]
+    
+    # show the current publication step alongside the zenodo status icon
+    def _zenodo_status(row):
+        
+        state = row.zenodo_publication
+        
+        if row.zenodo_submission_status in ['ZEN_RUN', 'ZEN_FAIL'] and state is not None:
+            return CAT(approval_icons[row.zenodo_submission_status], 
+                       XML('&nbsp') * 2, state['current'])
+        else:
+            return approval_icons[row.zenodo_submission_status]
+    
+    table.zenodo_submission_status.represent =  lambda value, row: _zenodo_status(row)
     
     # alter the file representation to add the dataset id as a variable to the download
     table.file.represent = lambda value, row: A('Download file', 
@@ -209,6 +228,8 @@ def administer_datasets():
     # hide field used in preparing the table
     #table.dataset_metadata.readable = False
     table.project_id.readable = False
+    table.dataset_check_timings.readable = False
+    table.zenodo_publication.readable = False
     #db.submitted_datasets.concept_id.readable = False
 
     # add buttons to provide options
@@ -225,10 +246,22 @@ def administer_datasets():
         return btn
     
     # - run publish (can only be run if file has passed and not yet been published)
+    #   Failed publications resume from the failed step, using the same deposit,
+    #   so that a resumed adoption does not discard the adopted deposit.
     def _run_publish(row):
-        if row.dataset_check_outcome != 'PASS' or row.zenodo_submission_status == 'ZEN_PASS':
+        if (row.dataset_check_outcome != 'PASS' or 
+                row.zenodo_submission_status in ['ZEN_PASS', 'ZEN_RUN']):
             btn = A('Publish', _class='button btn btn-default disabled',
                     _style='padding: 3px 10px 3px 10px;width: 70px;')
+        elif row.zenodo_submission_status == 'ZEN_FAIL' and row.zenodo_publication is not None:
+            resume_vars = {'id':row.id, 'manage':''}
+            if row.zenodo_publication['deposit_id'] is not None:
+                resume_vars['zenodo'] = row.zenodo_publication['deposit_id']
+            
+            btn = A('Resume', _class='button btn btn-default',
+                    _href=URL("datasets","run_submit_dataset_to_zenodo",
+                              vars=resume_vars),
+                    _style='padding: 3px 10px 3px 10px;width: 70px;')
         elif ((row.dataset_metadata is not None) and 
               ('metadata' in row.dataset_metadata) and 
               ('external_files' in row.dataset_metadata['metadata']) and
@@ -245,9 +278,50 @@ def administer_datasets():
         
         return btn
     
+    # - view the time taken by the stages of the most recent check
+    def _view_timings(row):
+        if row.dataset_check_timings is None:
+            btn = A('Timings', _class='button btn btn-default disabled',
+                    _style='padding: 3px 10px 3px 10px;')
+        else:
+            btn = A('Timings', _class='button btn btn-default',
+                    _href=URL("datasets", "dataset_check_timings", vars={'id': row.id}),
+                    _style='padding: 3px 10px 3px 10px;')
+        return btn
+    
+    # - publish a batch of selected datasets, queuing those that can be published
+    def _batch_publish(ids):
+        
+        rows = db((db.submitted_datasets.id.belongs(ids)) &
+                  (db.submitted_datasets.dataset_check_outcome == 'PASS') &
+                  (~ db.submitted_datasets.zenodo_submission_status.belongs(['ZEN_PASS', 'ZEN_RUN']))
+                  ).select()
+        
+        # Datasets with external files need a deposit to adopt, so are published singly
+        record_ids = [r.id for r in rows 
+                      if not r.dataset_metadata['metadata']['external_files']]
+        
+        if len(record_ids) == 0:
+            session.flash = 'No selected datasets can be published as a batch'
+            redirect(URL('datasets','administer_datasets'))
+        
+        db(db.submitted_datasets.id.belongs(record_ids)
+           ).update(zenodo_submission_status='ZEN_RUN')
+        
+        scheduler.queue_task('publish_datasets',
+                             pvars={'record_ids': record_ids},
+                             timeout=60*60*len(record_ids),
+                             repeats=1,
+                             immediate=True)
+        
+        session.flash = '{} of {} selected datasets queued for publication'.format(
+                            len(record_ids), len(ids))
+        redirect(URL('datasets','administer_datasets'))
+    
     # - submit page link    
     links = [dict(header = '', body = lambda row: _run_check(row)),
-             dict(header = '', body = lambda row: _run_publish(row))]
+             dict(header = '', body = lambda row: _run_publish(row)),
+             dict(header = '', body = lambda row: _view_timings(row))]
     
     # provide a grid display of current datasets
     form = SQLFORM.grid(db.submitted_datasets,
@@ -259,6 +333,8 @@ def administer_datasets():
                                   db.submitted_datasets.dataset_metadata,
                                   db.submitted_datasets.dataset_check_outcome,
                                   db.submitted_datasets.zenodo_submission_status,
+                                  db.submitted_datasets.dataset_check_timings,
+                                  db.submitted_datasets.zenodo_publication,
                                   db.submitted_datasets.file],
                         headers = {'submitted_datasets.upload_datetime': 'Upload date',
                                    'submitted_datasets.concept_id': 'Updating',
@@ -267,6 +343,7 @@ def administer_datasets():
                                    'submitted_datasets.zenodo_submission_status': 'Published'},
                         orderby = [~ db.submitted_datasets.upload_datetime],
                         links = links,
+                        selectable = [('Publish selected', lambda ids: _batch_publish(ids))],
                         maxtextlength = 100,
                         deletable=True,
                         editable=False,
@@ -274,7 +351,80 @@ def administer_datasets():
                         create=False,
                         csv=False)
     
-    return dict(form=form)
+    # Is a publication running, in which case the page reloads to show progress.
+    # Publications left running by a stopped worker or a timed out task are 
+    # marked as failed first, so that they can be resumed.
+    __reset_stale_publications()
+    in_progress = db(db.submitted_datasets.zenodo_submission_status == 'ZEN_RUN').count() > 0
+    
+    return dict(form=form, in_progress=in_progress)
+
+
+@auth.requires_membership('admin')
+def dataset_check_timings():
+    
+    """
+    Shows the time and peak memory used by each stage of dataset checking. The
+    peak memory is the memory allocated by the stage if validation.trace_memory
+    is set and otherwise the maximum resident memory of the checking process.
+    If a submitted dataset id is provided, the timings of the most recent check
+    of that dataset are shown, followed by a summary of the stage timings across
+    all checked submissions, grouped by validator version, to help identify 
+    changes in performance between versions.
+    """
+    
+    def _mb(value):
+        return '' if value is None else '{:0.1f} MB'.format(value / 1024.0 ** 2)
+    
+    # Timings for a single record
+    if 'id' in request.vars:
+        record = db.submitted_datasets[request.vars['id']]
+        
+        if record is None:
+            session.flash = 'Unknown submitted dataset record id.'
+            redirect(URL('datasets', 'administer_datasets'))
+        
+        stages = record.dataset_check_timings or []
+        
+        record_table = TABLE(TR(TH('Stage'), TH('Worksheet'), TH('Seconds'), TH('Peak memory')),
+                             *[TR(st['stage'], st['worksheet'] or '', 
+                                  '{:0.3f}'.format(st['seconds']), _mb(st['peak_memory']))
+                               for st in stages],
+                             _class='table table-striped')
+        
+        record_table = CAT(H4('Submission {}: {}'.format(record.id, record.file_name)),
+                           record_table)
+    else:
+        record_table = DIV()
+    
+    # Cumulative timings across submissions:
+    # - select validator_version, stage, count(distinct submission_id), avg(seconds),
+    #          max(seconds), sum(seconds), max(peak_memory)
+    #       from dataset_check_timings group by validator_version, stage;
+    tbl = db.dataset_check_timings
+    summary = db(tbl).select(tbl.validator_version,
+                             tbl.stage,
+                             tbl.submission_id.count(distinct=True).with_alias('n_checks'),
+                             tbl.seconds.avg().with_alias('mean_seconds'),
+                             tbl.seconds.max().with_alias('max_seconds'),
+                             tbl.seconds.sum().with_alias('total_seconds'),
+                             tbl.peak_memory.max().with_alias('max_memory'),
+                             groupby=[tbl.validator_version, tbl.stage],
+                             orderby=[~tbl.validator_version, tbl.stage])
+    
+    summary_table = TABLE(TR(TH('Validator version'), TH('Stage'), TH('Submissions'),
+                             TH('Mean seconds'), TH('Max seconds'), TH('Total seconds'),
+                             TH('Max peak memory')),
+                          *[TR(r.dataset_check_timings.validator_version,
+                               r.dataset_check_timings.stage,
+                               r.n_checks,
+                               '{:0.3f}'.format(r.mean_seconds),
+                               '{:0.3f}'.format(r.max_seconds),
+                               '{:0.1f}'.format(r.total_seconds),
+                               _mb(r.max_memory)) for r in summary],
+                          _class='table table-striped')
+    
+    return dict(record_table=record_table, summary_table=summary_table)
 
 
 @auth.requires_membership('admin')
@@ -372,6 +522,9 @@ def change_dataset_access():
             
             response.flash = 'Failed to update Zenodo ({status}): {message}'.format(**content)
             db.rollback()
+        else:
+            log_catalogue_changes([record.zenodo_record_id], 'access')
+            bump_catalogue_generation()
     
     elif form.errors:
         response.flash = 'Errors in upload'
@@ -681,6 +834,10 @@ def submitted_dataset_status():
 
     # Check report    
     if record.dataset_check_outcome == 'PENDING':
+        # Show how far the check has got
+        if record.dataset_check_progress:
+            status_table.append(_row('Check progress', record.dataset_check_progress))
+        
         # Set the heading for the form
         panel_head = DIV(DIV(H4('Dataset awaiting verification', _class="panel-title col-sm-8"),
                              _class='row'),
@@ -774,7 +931,7 @@ def run_verify_dataset():
         email = True if email == '1' else False
     
     if len(err) == 0:
-        res = verify_dataset(record_id, email)
+        res = verify_dataset_task(record_id, email)
     else:
         res = ', '.join(err)
     
@@ -785,6 +942,38 @@ def run_verify_dataset():
         return res
 
 
+def __reset_stale_publications():
+    """
+    Marks records that are shown as being published as failed if no scheduler
+    task to publish them is queued or running. This happens if a scheduler worker
+    is stopped or a publication task times out, which leaves the record in 
+    ZEN_RUN. The publication state of the record is kept, so it can be resumed.
+    """
+    
+    running = db(db.submitted_datasets.zenodo_submission_status == 'ZEN_RUN'
+                 ).select(db.submitted_datasets.id)
+    
+    if len(running) == 0:
+        return
+    
+    tasks = db((db.scheduler_task.function_name.belongs(['submit_dataset_to_zenodo',
+                                                         'publish_datasets'])) &
+               (db.scheduler_task.status.belongs(['QUEUED', 'ASSIGNED', 'RUNNING']))
+               ).select(db.scheduler_task.vars)
+    
+    active = set()
+    for task in tasks:
+        task_vars = loads_json(task.vars)
+        active.update(task_vars.get('record_ids', [task_vars.get('record_id')]))
+    
+    stale = [row.id for row in running if row.id not in active]
+    
+    if stale:
+        db(db.submitted_datasets.id.belongs(stale)
+           ).update(zenodo_submission_status='ZEN_FAIL',
+                    zenodo_error='The publication task stopped before completing')
+
+
 @auth.requires_membership('admin')
 def run_submit_dataset_to_zenodo():
     """
@@ -793,10 +982,18 @@ def run_submit_dataset_to_zenodo():
     in as well - this is used to adopt existing zenodo deposits to allow
     for non-Excel datasets. The app config contains a switch that allows
     the application to use the Zenodo sandbox rather than the main site.
+    
+    Publication is run as a scheduler task, so this returns immediately and
+    the progress of each publication step is shown on administer_datasets.
+    A failed publication resumes from the failed step, unless 'restart' is 
+    passed, which discards the partial publication. Passing 'resume' allows 
+    a publication that appears to still be running to be requeued, for example
+    if the scheduler worker was stopped.
     """
 
     record_id = request.vars['id']
     manage = 'manage' in request.vars
+    restart = 'restart' in request.vars
     err = []
 
     if 'zenodo' in request.vars:
@@ -813,7 +1010,26 @@ def run_submit_dataset_to_zenodo():
             err += ["Record ID not an integer"]
 
     if len(err) == 0:
-        res = submit_dataset_to_zenodo(record_id, deposit_id=deposit_id)
+        record = db.submitted_datasets[record_id]
+        
+        if record is None:
+            res = 'Publishing dataset: unknown record ID {}'.format(record_id)
+        elif record.zenodo_submission_status == 'ZEN_RUN' and 'resume' not in request.vars:
+            res = 'Publishing dataset: record ID {} is already being published'.format(record_id)
+        else:
+            record.update_record(zenodo_submission_status='ZEN_RUN')
+            
+            # schedule the publication
+            #  - set timeout to allow for large file uploads.
+            #  - no start_time, so defaults to now.
+            scheduler.queue_task('submit_dataset_to_zenodo',
+                                 pvars={'record_id': record_id, 'deposit_id': deposit_id,
+                                        'restart': restart},
+                                 timeout=60*60,
+                                 repeats=1,
+                                 immediate=True)
+            
+            res = 'Publishing dataset: record ID {} queued for publication'.format(record_id)
     else:
         res = ', '.join(err)
     
@@ -824,6 +1040,99 @@ def run_submit_dataset_to_zenodo():
         return res
 
 
+@auth.requires_membership('admin')
+def update_search_documents():
+    
+    """
+    This controller rebuilds the full text search documents for all published
+    datasets, which are used by the api/search/text endpoint. The search index is
+    created from the dataset_indexes page. Documents are built when a dataset is published, so
+    this is only needed to populate the documents for existing datasets or after
+    changing the way that documents are built.
+    """
+    
+    rebuild_search_documents()
+    bump_catalogue_generation()
+    
+    session.flash = 'Search documents rebuilt for {} datasets'.format(db(db.dataset_search).count())
+    redirect(URL('datasets', 'administer_datasets'))
+
+
+@auth.requires_membership('admin')
+def update_taxon_tables():
+    
+    """
+    This controller rebuilds the taxon closure table, which is used by the 
+    descendants option of the api/search/taxa endpoint, and the taxon summary 
+    table, which provides the api/taxa endpoint, from the taxa of all published 
+    datasets. The tables are updated when a dataset is published, so this is 
+    only needed to populate the tables for existing datasets.
+    """
+    
+    rebuild_taxon_closure()
+    rebuild_taxon_summary()
+    bump_catalogue_generation()
+    
+    session.flash = 'Taxon tables rebuilt with {} closure rows and {} taxa'.format(
+                        db(db.taxon_closure).count(), db(db.taxon_summary).count())
+    redirect(URL('datasets', 'administer_datasets'))
+
+
+@auth.requires_membership('admin')
+def dataset_indexes():
+    
+    """
+    Shows the state of the database indexes used by the dataset API and which
+    indexes are used by example API requests. Passing 'create' queues a scheduler
+    task to create any missing indexes, as building large indexes concurrently
+    takes much longer than a request should.
+    """
+    
+    # Find any index creation task that has not yet finished
+    pending = db((db.scheduler_task.task_name == 'create_indexes') &
+                 (db.scheduler_task.status.belongs(['QUEUED', 'ASSIGNED', 'RUNNING']))
+                 ).select(db.scheduler_task.id).first()
+    
+    if 'create' in request.vars:
+        if pending is None:
+            scheduler.queue_task('create_indexes',
+                                 timeout=6*60*60,
+                                 repeats=1,
+                                 immediate=True)
+            session.flash = 'Index creation queued'
+        else:
+            session.flash = 'Index creation is already queued'
+        redirect(URL('datasets', 'dataset_indexes'))
+    
+    def _mb(value):
+        return '' if value is None else '{:0.2f} MB'.format(value / 1024.0 ** 2)
+    
+    status = check_indexes()
+    
+    index_table = TABLE(TR(TH('Index'), TH('Table'), TH('Method'), TH('Columns'),
+                           TH('Status'), TH('Size'), TH('Scans')),
+                        *[TR(idx['name'], idx['table'], idx['method'], idx['columns'],
+                             approval_icons['PASS'] if idx['valid'] else approval_icons['FAIL'],
+                             _mb(idx['size']), idx['scans'] if idx['exists'] else '')
+                          for idx in status],
+                        _class='table table-striped')
+    
+    plans = explain_api_queries()
+    
+    plan_table = TABLE(TR(TH('API request'), TH('Estimated cost'), TH('Indexes used'),
+                          TH('Sequential scans')),
+                       *[TR(pln['request'], '{:0.1f}'.format(pln['cost']),
+                            CAT(*[CAT(idx, BR()) for idx in pln['indexes']]),
+                            CAT(*[CAT(tbl, BR()) for tbl in pln['seq_scans']]))
+                         for pln in plans],
+                       _class='table table-striped')
+    
+    n_missing = len([idx for idx in status if not idx['valid']])
+    
+    return dict(index_table=index_table, plan_table=plan_table, n_missing=n_missing,
+                pending=pending is not None)
+
+
 def xml_metadata():
     
     """
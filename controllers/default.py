@@ -5,13 +5,18 @@ from collections import Counter
 import random
 import datetime
 import inspect
+import hashlib
+import email.utils
 from gluon.contrib import simplejson
 from gluon.serializers import json, loads_json
 from safe_web_global_functions import thumbnail
+from safe_web_gazetteer import get_gazetteer
 from safe_web_datasets import (dataset_taxon_search, dataset_author_search, dataset_date_search, 
                                dataset_text_search, dataset_field_search, dataset_locations_search, 
                                dataset_spatial_search, dataset_spatial_bbox_search, dataset_query_to_json,
-                               get_index)
+                               get_index, cached_search, shared_cache,
+                               get_catalogue_last_modified, get_index_changes, get_records,
+                               dataset_compound_search, get_taxon_summary)
 
 ## -----------------------------------------------------------------------------
 ## Default page controllers
@@ -453,19 +458,37 @@ def api():
     if not len(request.args):
         
         # return the docstrings as HTML to populate the API html description
-        docs = CAT([H4(ky) + PRE(inspect.getdoc(fn)) for ky, fn in  search_func.items()])
+        docs = CAT([H4(ky) + PRE(inspect.getdoc(fn)) for ky, fn in  search_func.items()] +
+                   [H4('compound') + PRE(inspect.getdoc(dataset_compound_search))])
         return dict(docs=docs)
     
     elif request.args[0] == 'index_hashes':
         
-        # This retrieves the current version hashs from the ram cache.
+        # This retrieves the current version hashs from the shared cache.
         
-        # NOTE: the expiry time of None means these never expire and so functions
-        # that update versions (publishing a record, reloading gazetteer) need
-        # to clear this variable so that it will be reset by the next call to this
-        # API.
+        # NOTE: these never expire and so functions that update versions (publishing 
+        # a record, reloading gazetteer) need to bump the catalogue generation so 
+        # that it will be reset by the next call to this API in every process.
         
-        val = cache.ram('index', get_index, time_expire=None)['hashes']
+        val = shared_cache('index', get_index)['hashes']
+    
+    elif request.args[0] == 'index_changes':
+        
+        # /api/index_changes?since_hash=hash or ?since_generation=123 provides the
+        # index entries for records that have been published or changed since the
+        # client last synchronised its copy of the index, using the change log 
+        # filled in at publication. This includes older versions that are no longer
+        # the most recent version. The client replaces its entries for the changed
+        # records with the returned entries and uses the returned generation for 
+        # the next synchronisation.
+        
+        unknown_args = set(request.vars) - {'since_hash', 'since_generation'}
+        
+        if unknown_args:
+            raise HTTP(400, 'Unknown query parameters to endpoint'
+                       ' /{}: {}'.format(request.args[0],','.join(unknown_args)))
+        
+        val = get_index_changes(**request.vars)
     
     elif request.args[0] == 'record' and len(request.args) == 2:
         # /api/record/zenodo_record_id endpoint provides a machine readable
@@ -489,6 +512,33 @@ def api():
                 val['locations'] = record.dataset_locations.select(db.dataset_locations.name,
                                                                    db.dataset_locations.new_location,
                                                                    db.dataset_locations.wkt_wgs84)
+                
+                body = json(val).encode('utf-8')
+                return _conditional_json(body, hashlib.md5(body).hexdigest(),
+                                         get_catalogue_last_modified([record.publication_date]))
+    
+    elif request.args[0] == 'records':
+        
+        # /api/records?ids=1&ids=2 provides the record metadata of many records, as
+        # provided by /api/record, with the most_recent flag or without ids to get 
+        # the whole catalogue. The records are loaded in chunks and streamed as JSON
+        # Lines, one record per line. 
+        
+        if request.vars:
+            raise HTTP(400, 'Unknown query parameters to endpoint'
+                       ' /{}: {}'.format(request.args[0],','.join(request.vars)))
+        
+        # web2py closes the database connection when the controller returns and
+        # before the body is sent, so the stream reconnects to load the records.
+        def _stream():
+            db._adapter.reconnect()
+            try:
+                for rec in get_records(ids, most_recent):
+                    yield (json(rec) + '\n').encode('utf-8')
+            finally:
+                db._adapter.close()
+        
+        raise HTTP(200, _stream(), **{'Content-Type': 'application/x-ndjson'})
     
     elif request.args[0] == 'access_status' and len(request.args) == 2:
     
@@ -531,6 +581,11 @@ def api():
         entries = val['entries'].as_list()
         [r['published_datasets'].update(r.pop('dataset_files')) for r in entries]
         val['entries'] = [r['published_datasets'] for r in entries]
+        
+        body = json(val).encode('utf-8')
+        return _conditional_json(body, hashlib.md5(body).hexdigest(),
+                                 get_catalogue_last_modified([r['publication_date'] 
+                                                              for r in val['entries']]))
 
     elif request.args[0] == 'index':
 
@@ -539,38 +594,26 @@ def api():
         # details and accessibility.
         
         # The output from this endpoint is used as the core index for the safedata
-        # R package. The output is therefore cached in ram: i) to speed up access and
-        # ii) to provide an MD5 hash of the contents to provide a version stamp. Note
-        # the expiry date of None in the cache means that it never expires - publishing
-        # a new dataset therefore needs to clear the ram cache to reset these version
-        # stamps
-
-        val = cache.ram('index', get_index, time_expire=None)['index']
+        # R package. The output is therefore cached: i) to speed up access and
+        # ii) to provide an MD5 hash of the contents to provide a version stamp. The
+        # cache is shared between processes and never expires - publishing a new 
+        # dataset therefore bumps the catalogue generation to reset these version
+        # stamps. The cache also holds the serialised index and compressed copies,
+        # which are sent directly, and the index hash is used as the ETag, so that 
+        # clients can check for a new version without downloading the index.
+
+        index = shared_cache('index', get_index)
+        return _conditional_json(index['body'], index['hashes']['index'], index['last_modified'],
+                                 encoded={'br': index['brotli'], 'gzip': index['gzip']})
 
     elif request.args[0] == 'validator_locations':
         
         # This provides a dictionary using valid location names as keys to their bounding
         # boxes and a dictionary using aliases as keys to their canonical names. It is 
-        # primarily intended for use by the safedata-validator package
+        # primarily intended for use by the safedata-validator package. Both come from 
+        # the in memory gazetteer, which is reloaded when the gazetteer is updated.
         
-        locations = db().select(db.gazetteer.location, 
-                                db.gazetteer.bbox_xmin,
-                                db.gazetteer.bbox_xmax,
-                                db.gazetteer.bbox_ymin,
-                                db.gazetteer.bbox_ymax)
-    
-        # reformat to a dictionary of bbox tuples
-        locations = {r.location: (r.bbox_xmin, r.bbox_xmax, r.bbox_ymin, r.bbox_ymax) 
-                     for r in locations}
-    
-        # Add aliases dictionary - aliases are unique so use them as key to locations, which
-        # might have more than one alias
-        aliases = db().select(db.gazetteer_alias.location, 
-                              db.gazetteer_alias.alias)
-    
-        aliases = {r.alias: r.location for r in aliases}
-    
-        val = {'locations': locations, 'aliases': aliases}
+        val = get_gazetteer().validator_locations()
     
     elif request.args[0] == 'gazetteer':
         
@@ -599,43 +642,136 @@ def api():
     elif request.args[0] == 'taxa':
         
         # Get all taxa across studies - retrieve gbif codes, names and status along
-        # with the number of datasets the taxon appears in
+        # with the number of datasets the taxon appears in. This is read from the 
+        # taxon summary table, which is updated at publication, and is cached until
+        # the catalogue changes. The optional limit and offset parameters page
+        # through the taxa and the total number of taxa is given in a header.
         
-        taxon_fields = [db.dataset_taxa.gbif_id, db.dataset_taxa.taxon_rank,
-                        db.dataset_taxa.taxon_name, db.dataset_taxa.gbif_status,
-                        db.dataset_taxa.gbif_parent_id]
+        unknown_args = set(request.vars) - {'limit', 'offset'}
         
-        taxon_count = [db.dataset_taxa.taxon_name.count().with_alias('n_datasets')]
+        if unknown_args:
+            raise HTTP(400, 'Unknown query parameters to endpoint'
+                       ' /{}: {}'.format(request.args[0],','.join(unknown_args)))
+        
+        try:
+            offset = int(request.vars.offset or 0)
+            limit = None if request.vars.limit is None else int(request.vars.limit)
+        except ValueError:
+            raise HTTP(400, 'Invalid limit or offset value')
+        
+        if offset < 0 or (limit is not None and limit < 1):
+            raise HTTP(400, 'Invalid limit or offset value')
         
-        val = db(db.dataset_taxa).select(*taxon_fields + taxon_count,
-                                         groupby=taxon_fields).as_list()
+        taxa = shared_cache('taxa:{}:{}'.format(offset, limit), 
+                            lambda: get_taxon_summary(offset, limit))
         
-        # repackage the Rows to provide a flat json per taxon format.
-        for txn in val:
-            txn.update(txn.pop('dataset_taxa'))
-            del txn['_extra']
+        response.headers['X-Total-Count'] = str(taxa['total'])
+        return _conditional_json(taxa['body'], taxa['hash'], taxa['last_modified'])
 
-    elif request.args[0] == 'search' and len(request.args) == 2 and request.args[1] in search_func:
-            
-        # validate the remaining query search parameters to the search function arguments
-        func = search_func[request.args[1]]
-        fn_args = inspect.getargspec(func).args
-        unknown_args = set(request.vars) - set(fn_args)
+    elif (request.args[0] == 'search' and len(request.args) == 2 and 
+          (request.args[1] in search_func or request.args[1] == 'compound')):
+        
+        if request.args[1] == 'compound':
+            # The compound search combines the other searches into a single query
+            # and validates its own parameters
+            func = lambda **params: dataset_compound_search(search_func, **params)
+            unknown_args = set()
+        else:
+            # validate the remaining query search parameters to the search function arguments
+            func = search_func[request.args[1]]
+            fn_args = inspect.getargspec(func).args
+            unknown_args = set(request.vars) - set(fn_args)
         
         if unknown_args:
             raise HTTP(400, 'Unknown query parameters to endpoint'
                        ' /{}: {}'.format(request.args[0],','.join(unknown_args)))
         else:
-            try:
+            def _search():
                 qry = func(**request.vars)
-                # does the function return a query or an error dictionary
+                # does the function return a query, a query and ranking or an 
+                # error dictionary
                 if isinstance(qry, dict):
-                    val = qry
+                    return qry
+                elif isinstance(qry, tuple):
+                    val = dataset_query_to_json(qry[0], most_recent, ids, orderby=qry[1])
                 else:
                     val = dataset_query_to_json(qry, most_recent, ids)
+                
+                # Store plain lists rather than Rows in the cache
+                val['entries'] = val['entries'].as_list()
+                return val
+            
+            # Results are cached until the published catalogue changes
+            try:
+                val = cached_search(request.args[1], request.vars, most_recent, ids, _search)
             except TypeError as e:
                 raise HTTP(400, 'Could not parse api request: {}'.format(e))
     else:
         raise HTTP(400, 'Unknown endpoint {}'.format(request.env.web2py_original_uri))
     
     return response.json(val)
+
+
+def _conditional_json(body, etag, last_modified=None, encoded=None):
+    
+    """
+    Returns a serialised JSON body from the API, supporting conditional requests.
+    The ETag and Last-Modified headers are set and, if the client already has the
+    current version according to If-None-Match or If-Modified-Since, an empty 304
+    response is sent instead. Precompressed copies of the body can be provided, as
+    a dictionary keyed by content encoding, and are sent to clients that accept 
+    that encoding, with the encoding appended to the ETag.
+    """
+    
+    headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    
+    if last_modified is not None:
+        # The catalogue times are naive local times from datetime.now(), which
+        # astimezone() treats as local times when converting them to UTC.
+        last_modified = last_modified.astimezone(datetime.timezone.utc).replace(microsecond=0)
+        headers['Last-Modified'] = email.utils.format_datetime(last_modified, usegmt=True)
+    
+    # Find the accepted encodings, ignoring those with zero quality
+    accepted = []
+    for enc in (request.env.http_accept_encoding or '').split(','):
+        enc = enc.split(';')
+        if not (len(enc) > 1 and enc[1].strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')):
+            accepted.append(enc[0].strip())
+    
+    encoding = None
+    for enc in ['br', 'gzip']:
+        if encoded and encoded.get(enc) is not None and enc in accepted:
+            encoding = enc
+            break
+    
+    headers['ETag'] = '"{}"'.format(etag if encoding is None else etag + '-' + encoding)
+    
+    # Check the conditional headers, with If-None-Match taking precedence. The
+    # entity tags for all encodings of the body match.
+    if_none_match = request.env.http_if_none_match
+    if_modified_since = request.env.http_if_modified_since
+    not_modified = False
+    
+    if if_none_match is not None:
+        tags = [tg.strip() for tg in if_none_match.split(',')]
+        tags = [tg[2:] if tg.startswith('W/') else tg for tg in tags]
+        tags = [tg.strip('"').rsplit('-', 1)[0] if tg.endswith(('-br"', '-gzip"')) 
+                else tg.strip('"') for tg in tags]
+        not_modified = '*' in tags or etag in tags
+    elif if_modified_since is not None and last_modified is not None:
+        try:
+            not_modified = last_modified <= email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            pass
+    
+    if not_modified:
+        raise HTTP(304, **headers)
+    
+    response.headers.update(headers)
+    response.headers['Content-Type'] = 'application/json'
+    
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+        return encoded[encoding]
+    
+    return body
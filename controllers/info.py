@@ -6,6 +6,8 @@ from gluon.serializers import json, loads_json
 import os
 from gpxpy import gpx
 from safe_web_global_functions import get_frm
+from safe_web_datasets import bump_catalogue_generation, get_gazetteer_version
+from safe_web_gazetteer import get_gazetteer, write_gazetteer_stamp
 from shapely.geometry import shape
 
 ## -----------------------------------------------------------------------------
@@ -129,34 +131,45 @@ def gazetteer():
     """
     
     # If the grid has set up some search keywords, and the keywords aren't an empty 
-    # string then use them to select those rows, otherwise get all rows
+    # string then use them to select those rows, otherwise get all rows. Keyword 
+    # searches use the in memory gazetteer, searching the string fields as the grid
+    # does, but expressions from the grid query builder (which quote values) need
+    # the grid query parser and so the database.
     sfields = [db.gazetteer.location, db.gazetteer.type, db.gazetteer.plot_size, 
                db.gazetteer.fractal_order, db.gazetteer.transect_order]
+    gazetteer = get_gazetteer()
+    keywords = request.vars.keywords
     
-    if 'keywords' in request.get_vars and request.vars.keywords != '':
-        qry = SQLFORM.build_query(sfields, keywords=request.vars.keywords)
+    if isinstance(keywords, list):
+        keywords = keywords[0]
+    
+    if 'keywords' in request.get_vars and keywords.strip() != '':
+        if '"' in keywords:
+            qry = SQLFORM.build_query(sfields, keywords=keywords)
+            names = [r.location for r in db(qry).select(db.gazetteer.location)]
+        else:
+            names = gazetteer.search(keywords, [fld.name for fld in sfields 
+                                                if fld.type == 'string'])
     else:
-        qry = db.gazetteer
+        names = None
     
-    # get the (selected) rows and turn them into geojson, ordering them
+    # get the (selected) locations as geojson from the in memory gazetteer, ordered
     # so that the bottom ones get added to the leaflet map first
-    rws = db(qry).select(db.gazetteer.ALL, 
-                         db.gazetteer.wkt_wgs84.st_asgeojson().with_alias('geojson'), 
-                         orderby=db.gazetteer.display_order)
+    features = gazetteer.features(names)
     
     # Need to put together the tooltip for the gazetteer
     # using a subset of the available columns
-    loc = ['<B>' + rw.gazetteer['location'] + '</B></BR>' for rw in rws]
-    info = [[key + ': ' + str(rw.gazetteer[key]) 
+    loc = ['<B>' + ft['properties']['location'] + '</B></BR>' for ft in features]
+    info = [[key + ': ' + str(ft['properties'][key]) 
              for key in ['type','plot_size','parent','fractal_order','transect_order']
-             if rw.gazetteer[key] is not None] for rw in rws]
+             if ft['properties'][key] is not None] for ft in features]
     
     # combine, removing trailing break
     tooltips = [l + '</BR>'.join(i) for l, i in zip(loc, info)]
     
     rws = [{"type": "Feature", "tooltip": tl, 
-            "geometry": loads_json(r.geojson)}
-            for r, tl in zip(rws, tooltips)]
+            "geometry": ft['geometry']}
+            for ft, tl in zip(features, tooltips)]
     
     # provide GPX and GeoJSON downloaders and use the magic 
     # 'with_hidden_cols' suffix to allow the Exporter to access
@@ -292,9 +305,11 @@ def update_gazetteer():
     This controller reloads the contents of the gazetteer table and the alias
     table from the files provided in static and then updates the UTM50N geometry 
     field. The geojson file used here is the one provided by the api/locations
-    endpoint, and so this function also clears the ram cache providing the
-    file hash of gazetteer.geojson, so that the next call to versions_index will
-    repopulate it with the new file hash
+    endpoint, and so this function also clears the shared cache providing the
+    file hash of gazetteer.geojson, by bumping the catalogue generation, so that 
+    the next call to index_hashes will repopulate it with the new file hash. It 
+    also writes a new gazetteer version stamp, so that each process reloads its 
+    in memory copy of the gazetteer.
     
     Note that this relies on web2py 2.18.5+, which includes a version of PyDAL
     that supports st_transform.
@@ -329,8 +344,14 @@ def update_gazetteer():
     gazetteer_alias_csv = os.path.join(request.folder, 'static', 'files', 'gis', 'location_aliases.csv')
     db.gazetteer_alias.import_from_csv_file(open(gazetteer_alias_csv, 'r'), null='null')
     
-    # Clear the ram cache of the outdated version.
-    cache.ram('version_stamps', None)
+    # Update the catalogue generation to discard the cached version hashes
+    # and cached searches using the gazetteer in all processes.
+    bump_catalogue_generation()
+    
+    # Commit before updating the version stamp, so that other processes reload 
+    # their in memory gazetteer from the new contents.
+    db.commit()
+    write_gazetteer_stamp(get_gazetteer_version())
     
 # def calendars():
 #
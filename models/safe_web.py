@@ -102,6 +102,9 @@ approval_icons = {'Approved': SPAN('', _class="glyphicon glyphicon-ok-sign",
                   'ZEN_PEND': SPAN('', _class="glyphicon glyphicon-question-sign",
                                    _style="color:grey;font-size: 1.3em;",
                                    _title='Not yet submitted to Zenodo'),
+                  'ZEN_RUN': SPAN('', _class="glyphicon glyphicon-refresh",
+                                  _style="color:orange;font-size: 1.3em;",
+                                  _title='Publishing to Zenodo'),
                   'ZEN_PASS': SPAN('', _class="glyphicon glyphicon-ok-sign",
                                    _style="color:green;font-size: 1.3em;",
                                    _title='Published on Zenodo'),
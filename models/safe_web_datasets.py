@@ -1,5 +1,6 @@
 import os
 from gluon import current
+from gluon.dal import SQLCustomType
 
 # -----------------------------------------------------------------------------
 # DATASETS
@@ -39,13 +40,53 @@ db.define_table('submitted_datasets',
                       requires=IS_IN_SET(['PENDING', 'FAIL', 'ERROR', 'PASS'])),
                 Field('dataset_check_error', 'text', default=''),
                 Field('dataset_check_report', 'text', default=''),
+                Field('dataset_check_timings', 'json'),
+                Field('dataset_check_progress', 'string'),
+                Field('dataset_check_worksheets', 'json'),
                 # These two fields hold the outputs of dataset checking until the dataset is published
                 Field('dataset_metadata', 'json'),
                 Field('dataset_title', 'string'),
                 # fields to handle publication outcome
                 Field('zenodo_submission_status', 'string', default="ZEN_PEND",
-                      requires=IS_IN_SET(['ZEN_PEND', 'ZEN_FAIL', 'ZEN_PASS'])),
-                Field('zenodo_error', 'json'))
+                      requires=IS_IN_SET(['ZEN_PEND', 'ZEN_RUN', 'ZEN_FAIL', 'ZEN_PASS'])),
+                Field('zenodo_error', 'json'),
+                # holds the completed steps of publication to Zenodo, to allow resumption
+                Field('zenodo_publication', 'json'),
+                # holds the state of a multipart file upload to Zenodo, to allow resumption
+                Field('zenodo_upload', 'json'))
+
+# Holds the outcome of checking submitted files, so that resubmissions of identical
+# files can reuse the outcome. The outcome of a check depends on the file contents, the
+# project it is submitted under and the versions of the validator, gazetteer, location
+# aliases and GBIF database.
+
+db.define_table('dataset_check_cache',
+                Field('file_hash', 'string'),
+                Field('project_id', 'integer'),
+                Field('validator_version', 'string'),
+                Field('gazetteer_version', 'string'),
+                Field('location_aliases_version', 'string'),
+                Field('gbif_version', 'string'),
+                Field('file_name', 'string'),
+                Field('dataset_check_outcome', 'string'),
+                Field('dataset_check_report', 'text'),
+                Field('dataset_title', 'string'),
+                Field('dataset_metadata', 'json'),
+                Field('created', 'datetime'))
+
+# Holds the time and peak memory used by each stage of dataset checking. These
+# are kept after publication, so that the performance of checking can be followed
+# across submissions and validator versions.
+
+db.define_table('dataset_check_timings',
+                Field('submission_id', 'integer'),
+                Field('validator_version', 'string'),
+                Field('check_datetime', 'datetime'),
+                Field('outcome', 'string'),
+                Field('stage', 'string'),
+                Field('worksheet', 'string'),
+                Field('seconds', 'double'),
+                Field('peak_memory', 'bigint'))
 
 db.define_table('published_datasets',
                 # fields to handle the file upload and checking
@@ -62,6 +103,8 @@ db.define_table('published_datasets',
                 Field('dataset_conditions', 'text'),
                 Field('dataset_description', 'text'),
                 Field('dataset_metadata', 'json'),
+                # The sheet checks from the submission, used to check new versions
+                Field('dataset_check_worksheets', 'json'),
                 # Fields to hold publication data - most data is stored in the metadata
                 # field as JSON, but for quick recall, a few are stored directly.
                 Field('most_recent', 'boolean'),                
@@ -79,6 +122,28 @@ db.define_table('published_datasets',
                 Field('temporal_extent_end', 'date'),
                 Field('dataset_history', 'text'))
 
+# Holds a single row with a generation number for the published catalogue, which
+# is incremented whenever the published datasets or gazetteer change. This is used
+# to tag cached API search results, so that cached results are never out of date.
+db.define_table('catalogue_generation',
+                Field('generation', 'integer', default=0),
+                Field('updated', 'datetime'))
+
+# A log of changes to the published catalogue, used to send clients the index
+# entries that have changed since they last synchronised. Changes are recorded
+# with a null generation, which is filled in when the generation is bumped.
+db.define_table('catalogue_changes',
+                Field('generation', 'integer'),
+                Field('change_datetime', 'datetime'),
+                Field('zenodo_record_id', 'integer'),
+                Field('change', 'string', requires=IS_IN_SET(['published', 'superseded', 'access'])))
+
+# Records the hash of the dataset index at each catalogue generation, so that a 
+# client can synchronise from the index hash that it holds.
+db.define_table('catalogue_index_hashes',
+                Field('generation', 'integer'),
+                Field('index_hash', 'string'))
+
 # Used to link project ids to zenodo concept_ids
 db.define_table('project_datasets',
                 Field('project_id', 'reference project_id', notnull=True),
@@ -159,6 +224,30 @@ db.define_table('dataset_taxa',
                 Field('taxon_rank', 'string'),
                 Field('gbif_status', 'string'))
 
+# The transitive closure of the GBIF taxon hierarchy across all published datasets, 
+# built from the gbif_id and gbif_parent_id pairs in dataset_taxa. Each row links a 
+# taxon to one of its descendants, with a row of depth zero linking each taxon to 
+# itself, so that a search can find all of the taxa within a taxon with an indexed 
+# lookup. This is maintained by update_taxon_closure when a dataset is published.
+db.define_table('taxon_closure',
+                Field('ancestor_id', 'integer'),
+                Field('descendant_id', 'integer'),
+                Field('depth', 'integer'))
+
+# A summary of the taxa across the most recent published datasets, with the number
+# of distinct datasets using each taxon, used by the api/taxa endpoint. This is 
+# maintained by update_taxon_summary when a dataset is published or superseded, 
+# rather than grouping the whole dataset_taxa table on every request. The taxon key
+# is a hash of the taxon fields, with a unique index used to match taxa to the summary.
+db.define_table('taxon_summary',
+                Field('taxon_key', 'string', length=32, unique=True),
+                Field('gbif_id', 'integer'),
+                Field('gbif_parent_id', 'integer'),
+                Field('taxon_name', 'string'),
+                Field('taxon_rank', 'string'),
+                Field('gbif_status', 'string'),
+                Field('n_datasets', 'integer'))
+
 db.define_table('dataset_files',
                 Field('dataset_id', 'reference published_datasets'),
                 Field('checksum', 'string', length=32),
@@ -217,3 +306,11 @@ db.define_table('dataset_permits',
                 Field('authority', 'string'),
                 Field('number', 'string'),
                 Field('type', 'string'))
+
+# A full text search document for each published dataset, built from the dataset
+# title, description and keywords and the worksheet and field descriptions. This
+# needs a GIN index on search_vector, which is created by update_search_documents.
+
+db.define_table('dataset_search',
+                Field('dataset_id', 'reference published_datasets'),
+                Field('search_vector', SQLCustomType(type='text', native='tsvector')))
@@ -1,5 +1,7 @@
 from gluon.scheduler import Scheduler
-from safe_web_datasets import verify_dataset
+from safe_web_datasets import submit_dataset_to_zenodo, publish_datasets
+from safe_web_validator_service import verify_dataset_task
+from safe_web_db_indexes import create_indexes
 from safe_web_scheduler import remind_about_unknowns, send_weekly_summary, outdated_health_and_safety
 
 # The scheduler is loaded and defined in a model, so that it can register the
@@ -15,7 +17,10 @@ from safe_web_scheduler import remind_about_unknowns, send_weekly_summary, outda
 scheduler = Scheduler(db,
                       tasks=dict(remind_about_unknowns=remind_about_unknowns,
                                  send_weekly_summary=send_weekly_summary,
-                                 verify_dataset=verify_dataset,
+                                 verify_dataset=verify_dataset_task,
+                                 submit_dataset_to_zenodo=submit_dataset_to_zenodo,
+                                 publish_datasets=publish_datasets,
+                                 create_indexes=create_indexes,
                                  outdated_health_and_safety=outdated_health_and_safety))
 
 # These tasks then need to be queued using scheduler.queue_task or manually via
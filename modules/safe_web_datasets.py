@@ -3,14 +3,34 @@ import datetime
 from lxml import etree
 import simplejson
 import copy
-import safedata_validator
+from safedata_validator.safedata_validator import load_config
 from io import StringIO
 import requests
 from safe_web_global_functions import safe_mailer
 from itertools import groupby
 from shapely import geometry
 import hashlib
+import time
+import threading
+import random
+import tracemalloc
+from collections import defaultdict, deque
+from importlib.metadata import version
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gzip
 from gluon.serializers import json
+from gluon.dal import Query
+import shapely
+from safe_web_gazetteer import get_gazetteer, get_validator_locations_file
+from safe_web_multipart import multipart_part_size, multipart_parts
+from safe_web_worksheet_checks import (ValidatorResources, timed_stage, get_sheet_fingerprints,
+                                       sheet_check_keys, load_metadata_sheets, load_worksheets)
+
+# Brotli compression of API responses is optional
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # The web2py HTML helpers are provided by gluon. This also provides the 'current' object, which
 # provides the web2py 'request' API (note the single letter difference from the requests package!).
@@ -26,7 +46,7 @@ such as the scheduler, so are defined here in their own module.
 """
 
 
-def verify_dataset(record_id, email=False):
+def verify_dataset(record_id, email=False, resources=None):
     """
     Function to run safedata_validator on an uploaded file. There
     are three possible outcomes for a dataset: PASS; FAIL, if the check
@@ -49,6 +69,8 @@ def verify_dataset(record_id, email=False):
     Args:
         record_id: The id of the record from the dataset table that is to be checked.
         email: Should the dataset uploader be emailed the outcome?
+        resources: An optional ValidatorResources instance, used by a process
+            that checks many datasets to hold the validator resources between checks.
     
     Returns:
         A string describing the outcome of the check that gets stored in the
@@ -67,6 +89,21 @@ def verify_dataset(record_id, email=False):
     except BaseException:
         raise RuntimeError('Site config does provide not the host name')
     
+    # The number of processes used to check data worksheets concurrently. This is
+    # optional in the config and defaults to checking worksheets one at a time.
+    try:
+        n_workers = int(current.myconf.take('validation.worksheet_workers'))
+    except BaseException:
+        n_workers = 1
+    
+    # Tracing memory allocations gives the peak memory of each stage but slows
+    # checking down considerably, so is optional and off by default. Otherwise,
+    # the maximum resident memory of the checking process is recorded.
+    try:
+        trace_memory = bool(int(current.myconf.take('validation.trace_memory')))
+    except BaseException:
+        trace_memory = False
+    
     # get the record
     record = current.db.submitted_datasets[record_id]
     
@@ -90,41 +127,115 @@ def verify_dataset(record_id, email=False):
                                        scheme=True, host=host)}
         outcome = 'ERROR'
     
-    # Initialise the dataset checker:
+    # Look for the stored outcome of checking an identical file. The cache key
+    # includes the versions of the validator, gazetteer, location aliases and 
+    # GBIF database, so updates to any of those resources will cause the file 
+    # to be checked again.
+    cached = None
     if not error:
+        cache_key = dict(file_hash=record.file_hash,
+                         project_id=record.project_id,
+                         validator_version=version('safedata_validator'),
+                         gazetteer_version=get_gazetteer_version(),
+                         location_aliases_version=get_location_aliases_version(),
+                         gbif_version=get_gbif_database_version())
+        cached = get_cached_check(**cache_key)
+    
+    if cached is not None:
+        # Substitute the current user filename into the stored report and metadata
+        report_text = cached.dataset_check_report.replace(cached.file_name, record.file_name)
+        dataset_metadata = cached.dataset_metadata
+        dataset_metadata['metadata']['filename'] = record.file_name
+        
+        outcome = cached.dataset_check_outcome
+        ret_dict['report'] = XML(report_text)
+        ret_msg = 'Verifying dataset {}: dataset checking {} (cached)'.format(
+                    record.id, 'PASSED' if outcome == 'PASS' else 'FAILED')
+        
+        record.update_record(dataset_check_outcome=outcome,
+                             dataset_check_report=report_text,
+                             dataset_check_error='',
+                             dataset_title=cached.dataset_title,
+                             dataset_metadata=dataset_metadata)
+    
+    # Initialise the dataset checker:
+    if not error and cached is None:
         # - get paths to dataset file. Failure to find is handled by safedata_validator methods.
         fname = os.path.join(current.request.folder, 'uploads', 'submitted_datasets', record.file)
-        # get the Dataset object from the file checker
+        
+        # - start recording the time and memory used by each stage of the check
+        timings = []
+        if trace_memory:
+            tracemalloc.start()
+        
+        # get the Dataset object from the file checker, using a local file of
+        # the validator locations from the in memory gazetteer. The resources
+        # are loaded again if the locations file or GBIF database have changed.
+        if resources is None:
+            resources = ValidatorResources()
+        
         try:
-            dataset = safedata_validator.Dataset(fname, verbose=False)
+            with timed_stage(timings, 'initialise'):
+                locations_file = get_validator_locations_file()
+                dataset = resources.dataset(fname, [locations_file, cache_key['gbif_version']],
+                                            locations=locations_file)
         except Exception as e:
             # We don't want to bail here because we might want to email the uploader,
             # but we do want to record what went wrong. We store it in the dataset record, which
             # is the only venue when run from a controller. If I could work out where the scheduler 
             # run output comes from, I'd do that too.
             record.update_record(dataset_check_outcome='ERROR',
-                                 dataset_check_error=repr(e))
+                                 dataset_check_error=repr(e),
+                                 dataset_check_timings=timings)
+            tracemalloc.stop()
             ret_msg = 'Verifying dataset {}: error initialising dataset checker'
             ret_msg = ret_msg.format(record.id)
             error = True
     
     # main processing of the dataset
-    if not error:
+    if not error and cached is None:
+        sheet_checks = {}
         try:
-            # load the metadata sheets
-            dataset.load_summary(validate_doi=True, project_id=record.project_id)
+            # load the summary sheet
+            with timed_stage(timings, 'load_summary'):
+                dataset.load_summary(validate_doi=True, project_id=record.project_id)
+            
+            # Fingerprint the sheets in the workbook, so that the checks of the 
+            # taxa, locations and data worksheets that are unchanged from the 
+            # previous version of the dataset can be reused
+            fingerprints = get_sheet_fingerprints(dataset)
+            keys = sheet_check_keys(dataset, fingerprints, cache_key)
+            previous = get_previous_sheet_checks(record)
             
-            dataset.load_taxa()
-            dataset.load_locations()
+            # load the taxa and locations sheets
+            sheet_checks = load_metadata_sheets(dataset, keys, previous, timings)
             
             # check the dataset worksheets, after checking there are some
             # as the metadata might only document external data files
             if dataset.dataworksheet_summaries is not None:
-                for ws in dataset.dataworksheet_summaries:
-                    dataset.load_data_worksheet(ws)
+                
+                # Report progress on each worksheet to the record, using the
+                # row counts from the fingerprints to describe each sheet
+                n_sheets = len(dataset.dataworksheet_summaries)
+                
+                def _progress(idx):
+                    ws_name = dataset.dataworksheet_summaries[idx]['name']
+                    record.update_record(dataset_check_progress=(
+                        'Checked worksheet {} of {}: {} ({} rows)'.format(
+                            idx + 1, n_sheets, ws_name,
+                            fingerprints.get(ws_name, {}).get('rows'))))
+                    current.db.commit()
+                
+                sheet_checks['worksheets'] = load_worksheets(dataset, fname, keys['worksheets'],
+                                                             previous.get('worksheets', {}),
+                                                             n_workers, timings,
+                                                             progress=_progress,
+                                                             trace_memory=trace_memory,
+                                                             resources=resources)
             
             # cross check the taxa and locations
-            dataset.final_checks()
+            with timed_stage(timings, 'final_checks'):
+                dataset.final_checks()
             
         except Exception as e:
             ret_msg = 'Verifying dataset {}: error running dataset checking'
@@ -140,6 +251,8 @@ def verify_dataset(record_id, email=False):
             
             dataset_check_error = ''
         
+        tracemalloc.stop()
+        
         # At this point, we have a Dataset object, so can populate the record with 
         # what information is available, regardless of Error, Fail or Pass
         # - The DAL handles conversion of the python structure into JSON, so
@@ -174,10 +287,38 @@ def verify_dataset(record_id, email=False):
         record.update_record(dataset_check_outcome=outcome,
                              dataset_check_report=report_text,
                              dataset_check_error=dataset_check_error,
+                             dataset_check_timings=timings,
+                             dataset_check_worksheets=sheet_checks,
                              dataset_title=dataset.title,
                              dataset_metadata={'metadata': dataset_metadata,
                                                'taxa': dataset.taxon_index,
                                                'locations': dataset.location_index})
+        
+        # Keep a log of the timings that persists after publication, to allow
+        # the performance of different validator versions to be compared.
+        check_datetime = datetime.datetime.now()
+        current.db.dataset_check_timings.bulk_insert(
+            [dict(submission_id=record.id,
+                  validator_version=version('safedata_validator'),
+                  check_datetime=check_datetime,
+                  outcome=outcome,
+                  **stage) for stage in timings])
+        
+        # Store completed checks. Errors are not stored and nor are checks that 
+        # used the network, to validate publication DOIs or taxa using the GBIF
+        # web API, as the outcome may be caused by transient network problems.
+        used_network = bool(dataset.publication_doi) or not dataset.use_local_gbif
+        
+        if outcome != 'ERROR' and not used_network:
+            current.db.dataset_check_cache.update_or_insert(
+                cache_key,
+                file_name=record.file_name,
+                dataset_check_outcome=outcome,
+                dataset_check_report=str(report_text),
+                dataset_title=dataset.title,
+                dataset_metadata=record.dataset_metadata,
+                created=datetime.datetime.now(),
+                **cache_key)
     
     # notify the user
     if email:
@@ -200,11 +341,123 @@ def verify_dataset(record_id, email=False):
     return ret_msg
 
 
+def get_cached_check(file_hash, project_id, validator_version, gazetteer_version,
+                     location_aliases_version, gbif_version):
+    """
+    Looks up a stored dataset check outcome for a file. Checking depends on
+    the file contents, the project the dataset is submitted under, the version
+    of the validator, the versions of the gazetteer and location aliases used 
+    to check locations and the version of the GBIF database used to check taxa,
+    so all of these are used as the cache key.
+    
+    Returns:
+        A row from db.dataset_check_cache or None if there is no match.
+    """
+    
+    db = current.db
+    
+    return db((db.dataset_check_cache.file_hash == file_hash) &
+              (db.dataset_check_cache.project_id == project_id) &
+              (db.dataset_check_cache.validator_version == validator_version) &
+              (db.dataset_check_cache.gazetteer_version == gazetteer_version) &
+              (db.dataset_check_cache.location_aliases_version == location_aliases_version) &
+              (db.dataset_check_cache.gbif_version == gbif_version)
+              ).select().first()
+
+
+def get_gazetteer_version():
+    """
+    Returns the MD5 hash of the static gazetteer geojson file, which is
+    used as a version stamp for the gazetteer.
+    """
+    
+    gazetteer_file = os.path.join(current.request.folder, 'static', 'files', 'gis', 'gazetteer.geojson')
+    with open(gazetteer_file) as f:
+        return hashlib.md5(f.read().encode('utf-8')).hexdigest()
+
+
+def get_location_aliases_version():
+    """
+    Returns the MD5 hash of the static location aliases csv file, which is
+    used as a version stamp for the location aliases.
+    """
+    
+    location_aliases_file = os.path.join(current.request.folder, 'static', 'files', 'gis', 
+                                         'location_aliases.csv')
+    with open(location_aliases_file) as f:
+        return hashlib.md5(f.read().encode('utf-8')).hexdigest()
+
+
+def get_gbif_database_version():
+    """
+    Returns a version stamp for the local GBIF database set in the validator 
+    config, using the path, size and modification time of the database file 
+    rather than hashing a very large file. If no local database is configured,
+    the validator uses the GBIF web API and this returns 'api'.
+    """
+    
+    gbif_database = load_config().get('gbif_database')
+    
+    if gbif_database is None:
+        return 'api'
+    
+    try:
+        stat = os.stat(gbif_database)
+    except OSError:
+        return 'missing'
+    
+    stamp = '{}:{}:{}'.format(gbif_database, stat.st_size, stat.st_mtime)
+    return hashlib.md5(stamp.encode('utf-8')).hexdigest()
+
+
+def get_previous_sheet_checks(record):
+    """
+    Finds the stored sheet checks from the previous version of a submitted
+    dataset. For updates to a published dataset, this is the most recent 
+    submission of an update to the same concept or, failing that, the most 
+    recent published version. For new datasets, it is the most recent other 
+    submission of the same file name to the same project by the same uploader.
+    
+    Returns:
+        A dictionary of the stored checks of the 'taxa' and 'locations' sheets
+        and of the data worksheets, under 'worksheets' keyed by worksheet name,
+        which is empty if there is no previous version.
+    """
+    
+    db = current.db
+    
+    if record.concept_id is not None:
+        qry = (db.submitted_datasets.concept_id == record.concept_id)
+    else:
+        qry = ((db.submitted_datasets.concept_id == None) &
+               (db.submitted_datasets.project_id == record.project_id) &
+               (db.submitted_datasets.uploader_id == record.uploader_id) &
+               (db.submitted_datasets.file_name == record.file_name))
+    
+    previous = db(qry & 
+                  (db.submitted_datasets.id != record.id) &
+                  (db.submitted_datasets.dataset_check_worksheets != None)
+                  ).select(db.submitted_datasets.dataset_check_worksheets,
+                           orderby=~db.submitted_datasets.upload_datetime).first()
+    
+    if previous is None and record.concept_id is not None:
+        previous = db((db.published_datasets.zenodo_concept_id == record.concept_id) &
+                      (db.published_datasets.most_recent == True)
+                      ).select(db.published_datasets.dataset_check_worksheets).first()
+    
+    if previous is None or previous.dataset_check_worksheets is None:
+        return {}
+    
+    return previous.dataset_check_worksheets
+
+
 def get_zenodo_api():
     """
     Function to provide the zenodo API endpoint and the access token
     from the site config. The config specifies whether the testing
-    sandbox or the live site is to be used.
+    sandbox or the live site is to be used. The config can also provide
+    an alternative API URL, which is used to publish to a local Zenodo
+    emulator (private/zenodo_emulator.py) for testing and benchmarking.
     """
     
     try:
@@ -227,10 +480,194 @@ def get_zenodo_api():
 
         api = 'https://zenodo.org/api/'
     
+    try:
+        api = current.myconf.take('zenodo.api_url')
+    except BaseException:
+        pass
+    
     return api, token
 
 
-def submit_dataset_to_zenodo(record_id, deposit_id=None):
+class ZenodoClient(object):
+    """
+    A shared HTTP client for the Zenodo API. This uses a single requests Session, 
+    so connections to Zenodo are pooled and kept alive between calls, and adds
+    a timeout to every call. Calls that fail with a connection error, a rate
+    limit (429) or a server error (5xx) are retried with exponential backoff and
+    random jitter. POST requests create or change deposits, so these are only 
+    retried when Zenodo cannot have acted on them: connection timeouts and rate 
+    limiting.
+    
+    The client also keeps a count of calls, retries and errors and the latency
+    of each named API call, available through the stats attribute.
+    
+    The client is shared by the threads used by publish_datasets. Sessions are
+    not thread safe, so each thread uses its own session, and the stats are 
+    updated under a lock.
+    
+    Args:
+        timeout: The requests timeout, a tuple of connect and read timeouts.
+        max_retries: The maximum number of times a call is retried.
+        backoff: The base delay in seconds for the exponential backoff.
+        max_backoff: The maximum delay in seconds between retries.
+    """
+    
+    retry_status = {429, 500, 502, 503, 504}
+    
+    def __init__(self, timeout=(10, 300), max_retries=4, backoff=1.0, max_backoff=60):
+        
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats = defaultdict(lambda: {'calls': 0, 'retries': 0, 'errors': 0,
+                                          'seconds': 0.0, 'max_seconds': 0.0})
+    
+    @property
+    def session(self):
+        """
+        The requests Session for the calling thread, created on first use.
+        """
+        
+        session = getattr(self._local, 'session', None)
+        
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+        
+        return session
+    
+    def _record(self, call, **counts):
+        """
+        Adds counts to the stats for an API call, keeping the maximum of the
+        max_seconds count.
+        """
+        
+        with self._stats_lock:
+            stats = self.stats[call]
+            for key, value in counts.items():
+                if key == 'max_seconds':
+                    stats[key] = max(stats[key], value)
+                else:
+                    stats[key] += value
+    
+    def request(self, call, method, url, **kwargs):
+        """
+        Makes a request to the Zenodo API, retrying on transient failures.
+        
+        Args:
+            call: A name for the API call, used to record stats
+            method: The HTTP method
+            url: The URL to request
+            kwargs: Other arguments to requests.Session.request
+        
+        Returns:
+            A requests.Response object for the final attempt. If the final 
+            attempt fails with a connection error, that error is raised.
+        """
+        
+        kwargs.setdefault('timeout', self.timeout)
+        
+        # If the request is uploading from a file, keep the start position
+        # so that the file can be rewound for a retry.
+        data = kwargs.get('data')
+        data_start = data.tell() if hasattr(data, 'seek') else None
+        
+        for attempt in range(self.max_retries + 1):
+            
+            if data_start is not None:
+                data.seek(data_start)
+            
+            start = time.perf_counter()
+            error = None
+            
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectTimeout as e:
+                resp, error, retry = None, e, True
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                resp, error, retry = None, e, method != 'POST'
+            else:
+                retry = (resp.status_code == 429 or 
+                         (resp.status_code in self.retry_status and method != 'POST'))
+            
+            elapsed = time.perf_counter() - start
+            self._record(call, calls=1, seconds=elapsed, max_seconds=elapsed)
+            
+            if not retry or attempt == self.max_retries:
+                break
+            
+            self._record(call, retries=1)
+            
+            # Use the Retry-After header for rate limiting if it is provided,
+            # otherwise use exponential backoff with full jitter.
+            delay = None
+            if resp is not None and resp.headers.get('Retry-After', '').isdigit():
+                delay = int(resp.headers['Retry-After'])
+            
+            if delay is None:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            
+            time.sleep(delay)
+        
+        if error is not None or resp.status_code >= 400:
+            self._record(call, errors=1)
+        
+        if error is not None:
+            raise error
+        
+        return resp
+    
+    def get(self, call, url, **kwargs):
+        return self.request(call, 'GET', url, **kwargs)
+    
+    def post(self, call, url, **kwargs):
+        return self.request(call, 'POST', url, **kwargs)
+    
+    def put(self, call, url, **kwargs):
+        return self.request(call, 'PUT', url, **kwargs)
+    
+    def delete(self, call, url, **kwargs):
+        return self.request(call, 'DELETE', url, **kwargs)
+
+
+# A single client is shared by all Zenodo calls from a process
+_zenodo_client = None
+
+
+def get_zenodo_client():
+    """
+    Function to provide the shared ZenodoClient for this process, creating it 
+    on first use. The site config can optionally provide the read timeout and
+    the number of retries for Zenodo calls.
+    """
+    
+    global _zenodo_client
+    
+    if _zenodo_client is None:
+        
+        try:
+            timeout = (10, int(current.myconf.take('zenodo.timeout')))
+        except BaseException:
+            timeout = (10, 300)
+        
+        try:
+            max_retries = int(current.myconf.take('zenodo.max_retries'))
+        except BaseException:
+            max_retries = 4
+        
+        _zenodo_client = ZenodoClient(timeout=timeout, max_retries=max_retries)
+    
+    return _zenodo_client
+
+
+def submit_dataset_to_zenodo(record_id, deposit_id=None, restart=False):
     
     """
     Function that attempts to publish a dataset record to Zenodo and 
@@ -238,10 +675,18 @@ def submit_dataset_to_zenodo(record_id, deposit_id=None):
     This handles the logic of selecting which method to use: create excel, 
     update excel or adopt external.
     
+    Publication works through a sequence of Zenodo API steps and the outcome
+    of each step is stored in the zenodo_publication field of the record as it
+    completes. If a step fails, the deposit is kept and running this function
+    again resumes from the failed step. This function is also used as a scheduler
+    task, so the record is committed after each step to show progress.
+    
     Args:
         record_id: The id of the dataset table record to be submitted
         deposit_id: An integer giving the id of an existing Zenodo deposit to adopt
             using this dataset record.
+        restart: Discard any partially completed publication of the record and
+            start again.
     Returns:
         A string describing the outcome.
     """
@@ -267,215 +712,637 @@ def submit_dataset_to_zenodo(record_id, deposit_id=None):
     # 2) an update to an existing excel-only dataset,
     # 3) a brand new dataset with external files and
     # 4) an update to an existing dataset with online files.
+    # external_files contains an empty list or a list of dictionaries
 
     metadata = record.dataset_metadata['metadata']
 
-    # external_files contains an empty list or a list of dictionaries
     if metadata['external_files']:
-        code, links, response = adopt_external_zenodo(api, token, record, deposit_id)
-        external = True
-    else:
-        if record.concept_id is None:
-            code, links, response = create_excel_zenodo(api, token, record)
-        else:
-            code, links, response = update_excel_zenodo(api, token, record)
-        external = False
-
-    if code > 0:
-        # There has been a problem. If this is an internal Excel file only, then try
-        # and delete the failed deposit and update the record
-        if links is not None and not external:
-            # This can fail and leave a hanging deposit, but we won't let that stop the function
-            _, _ = delete_deposit(links, token)
-
-        # update the record
-        record.update_record(zenodo_submission_status='ZEN_FAIL',
-                             zenodo_submission_date=datetime.datetime.now(),
-                             zenodo_error=response)
-        return "Failed to publish record"
+        route = 'adopt'
+    elif record.concept_id is None:
+        route = 'create'
     else:
-                
-        # Set the most recent flag for existing published versions to False
-        if record.concept_id is not None:
-            db(db.published_datasets.zenodo_concept_id == record.concept_id
-               ).update(most_recent = False)
-        
-        # remove the dataset metadata from the zenodo response, since the
-        # contents is information we have already, so we can store the rest
-        del response['metadata']
-        
-        # Now create a published datasets entry 
-        published_record = db.published_datasets.insert(
-                                     uploader_id=record.uploader_id,
-                                     upload_datetime=record.upload_datetime,
-                                     submission_id=record.id,
-                                     dataset_title=metadata['title'],
-                                     dataset_access=metadata['access'],
-                                     dataset_embargo=metadata['embargo_date'],
-                                     dataset_conditions=metadata['access_conditions'],
-                                     dataset_description=metadata['description'],
-                                     dataset_metadata=record.dataset_metadata['metadata'],
-                                     temporal_extent_start=metadata['temporal_extent'][0],
-                                     temporal_extent_end=metadata['temporal_extent'][1],
-                                     geographic_extent= geometry.box(metadata['longitudinal_extent'][0],
-                                                                     metadata['latitudinal_extent'][0],
-                                                                     metadata['longitudinal_extent'][1],
-                                                                     metadata['latitudinal_extent'][1]).wkt,
-                                     publication_date=datetime.datetime.now(),
-                                     most_recent=True,
-                                     zenodo_record_id=response['record_id'],
-                                     zenodo_record_doi=response['doi_url'],
-                                     zenodo_record_badge=response['links']['badge'],
-                                     zenodo_concept_id=response['conceptrecid'],
-                                     zenodo_concept_doi=response['links']['conceptdoi'],
-                                     zenodo_concept_badge=response['links']['conceptbadge'],
-                                     zenodo_metadata=response)            
-        
-        # add an associated project link to the dataset concept 
-        # if one does not already exist
-        project_link = db((db.project_datasets.project_id == record.project_id) &
-                          (db.project_datasets.concept_id == response['conceptrecid'])
-                          ).select()
-
-        if not project_link:
-            db.project_datasets.insert(project_id=record.project_id,
-                                       concept_id=response['conceptrecid'],
-                                       user_id=record.uploader_id,
-                                       date_added=datetime.date.today())
-        
-        # update to include the UTM 50N bbox geometry
-        db(db.published_datasets.id == published_record).update(
-            geographic_extent_utm50n=db.published_datasets.geographic_extent.st_transform(32650))
-        
-        # populate index tables
-        # A) Taxa
-        taxa = record.dataset_metadata['taxa']
-        taxa = [dict(list(zip(['dataset_id', 'worksheet_name', 'gbif_id', 'gbif_parent_id',
-                          'taxon_name', 'taxon_rank', 'gbif_status'], 
-                         [published_record] + tx))) for tx in taxa]
-        
-        db.dataset_taxa.bulk_insert(taxa)
-        
-        # B) Files, using the Zenodo response
-        files = response['files']
-        for each_file in files:
-            each_file['dataset_id'] = published_record
-            each_file['download_link'] = each_file['links']['download']
-            each_file['file_zenodo_id'] = each_file.pop('id')
-        
-        db.dataset_files.bulk_insert(files)
-        
-        # C) Locations
-        locations = record.dataset_metadata['locations']
-        locations = [dict(list(zip(['dataset_id', 'name','new_location','type','wkt_wgs84'], 
-                              [published_record] + loc))) for loc in locations]
-        
-        new_locs = db.dataset_locations.bulk_insert(locations)
-        
-        # update the UTM 50 N geometry where possible
-        db(db.dataset_locations.id.belongs(new_locs)).update(
-            wkt_utm50n=db.dataset_locations.wkt_wgs84.st_transform(32650))
-        
-        # D) Dataworksheets and fields
-        for data in metadata['dataworksheets']:
-        
-            worksheet_id = db.dataset_worksheets.insert(dataset_id=published_record, **data)
-            
-            for fld in data['fields']:
-                fld['dataset_id'] = published_record
-                fld['worksheet_id'] = worksheet_id
-            
-            db.dataset_fields.bulk_insert(data['fields'])
+        route = 'update'
+    
+    # Get the publication state, discarding it if requested or if it does
+    # not match the current route and deposit
+    state = record.zenodo_publication
+    
+    if state is not None and (restart or state['route'] != route or 
+                              state['deposit_id'] != deposit_id):
+        discard_publication(record, token)
+        state = None
+    
+    if state is None:
+        state = {'route': route, 'deposit_id': deposit_id, 'links': None,
+                 'zenodo_id': None, 'response': None, 'completed': [], 'current': None}
+    
+    # Work through the steps, skipping those already completed. The Zenodo
+    # client retries transient failures, but raises the connection error if 
+    # Zenodo is still unreachable, so treat that as a failure of the step.
+    for step_name, step in ZENODO_ROUTES[route]:
         
-        # E) Authors
-        for auth in metadata['authors']:
-            db.dataset_authors.insert(dataset_id=published_record, **auth)
+        if step_name in state['completed']:
+            continue
         
-        # F) Funders
-        if metadata['funders'] is not None:
-            for fndr in metadata['funders']:
-                db.dataset_funders.insert(dataset_id=published_record, **fndr)
+        state['current'] = step_name
+        record.update_record(zenodo_submission_status='ZEN_RUN', 
+                             zenodo_publication=state)
+        db.commit()
         
-        # G) Permits
-        if metadata['permits'] is not None:
-            for perm in metadata['permits']:
-                db.dataset_permits.insert(dataset_id=published_record, **perm)
+        try:
+            code, response = step(api, token, record, state)
+        except requests.exceptions.RequestException as e:
+            code, response = 1, repr(e)
         
-        # K) Keywords
-        if metadata['keywords'] is not None:        
-            for kywd in metadata['keywords']:
-                db.dataset_keywords.insert(dataset_id=published_record, keyword=kywd)
+        if code > 0:
+            record.update_record(zenodo_submission_status='ZEN_FAIL',
+                                 zenodo_error=response,
+                                 zenodo_publication=state)
+            db.commit()
+            return "Failed to publish record at step {}".format(step_name)
         
-        # remove the dataset from the submitted_datasets table
-        record.delete_record()
+        state['completed'].append(step_name)
+        record.update_record(zenodo_publication=state)
+        db.commit()
+    
+    # The deposit is now published, so populate the local index. This is done
+    # as a single transaction, so a failure leaves no partial index and can be
+    # retried without publishing again.
+    state['current'] = 'index'
+    record.update_record(zenodo_publication=state)
+    db.commit()
+    
+    try:
+        response = index_published_dataset(record, state['response'])
+    except Exception as e:
+        db.rollback()
+        record.update_record(zenodo_submission_status='ZEN_FAIL',
+                             zenodo_error=repr(e),
+                             zenodo_publication=state)
+        db.commit()
+        return "Published to Zenodo but failed to update the dataset index"
+    
+    # remove the dataset from the submitted_datasets table and update the
+    # catalogue generation, which discards the cached index in all processes
+    record.delete_record()
+    bump_catalogue_generation()
+    db.commit()
+    
+    return "Published dataset to {}".format(response['doi_url'])
+
+
+def publish_datasets(record_ids, max_in_flight=None):
+    """
+    Function to publish a batch of submitted datasets to Zenodo, intended to be
+    run as a scheduler task. Most of the time taken to publish a dataset is spent
+    waiting on Zenodo, so datasets are published concurrently using a pool of 
+    threads, which bounds the number of deposits in progress at any one time.
+    
+    Each dataset is published by submit_dataset_to_zenodo, so the steps are 
+    checkpointed and the local index for each dataset is updated in its own
+    transaction. Each thread uses its own database connection, so these transactions
+    are independent. Versions of the same concept are published in order within
+    a single thread, so that the most recent version is set correctly, and the
+    versions after a version that fails to publish are not published.
+    
+    Args:
+        record_ids: A list of ids of submitted_datasets records to be published
+        max_in_flight: The maximum number of datasets being published at once,
+            defaulting to the zenodo.max_in_flight setting or 4.
+    Returns:
+        A string summarising the successes and failures.
+    """
+    
+    db = current.db
+    
+    if max_in_flight is None:
+        try:
+            max_in_flight = int(current.myconf.take('zenodo.max_in_flight'))
+        except BaseException:
+            max_in_flight = 4
+    
+    # Group the records by concept, keeping submission order within concepts
+    records = db(db.submitted_datasets.id.belongs(record_ids)
+                 ).select(orderby=db.submitted_datasets.upload_datetime)
+    
+    groups = []
+    concepts = {}
+    for rec in records:
+        if rec.concept_id is None:
+            groups.append([rec.id])
+        elif rec.concept_id in concepts:
+            concepts[rec.concept_id].append(rec.id)
+        else:
+            concepts[rec.concept_id] = [rec.id]
+            groups.append(concepts[rec.concept_id])
+    
+    # Create the shared Zenodo client before starting any threads
+    get_zenodo_client()
+    
+    start = time.perf_counter()
+    outcomes = {}
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, len(groups)))) as pool:
         
-        # Flush the cached index of published datasets
-        current.cache.ram('index', None)
+        futures = {pool.submit(_publish_group, ids, current.request, current.myconf,
+                               current.cache, db): ids for ids in groups}
         
-        return "Published dataset to {}".format(response['doi_url'])
+        for fut in as_completed(futures):
+            try:
+                outcomes.update(fut.result())
+            except Exception as e:
+                outcomes.update({rid: 'Failed to publish record: {!r}'.format(e)
+                                 for rid in futures[fut]})
+    
+    # End the transaction used to select the records
+    db.commit()
+    
+    missing = set(int(r) for r in record_ids) - set(outcomes)
+    outcomes.update({rid: 'Publishing dataset: unknown record ID {}'.format(rid) 
+                     for rid in missing})
+    
+    published = [rid for rid, res in outcomes.items() if res.startswith('Published dataset')]
+    
+    summary = ['Published {} of {} datasets in {:0.1f} seconds'.format(
+                   len(published), len(outcomes), time.perf_counter() - start)]
+    summary += ['{}: {}'.format(rid, outcomes[rid]) for rid in sorted(outcomes)]
+    
+    return '\n'.join(summary)
 
 
-def create_excel_zenodo(api, token, record):
+def _publish_group(record_ids, request, myconf, cache, db):
+    """
+    Publishes a group of datasets in order from a publish_datasets thread. The
+    web2py current object is local to each thread, so is populated from the 
+    calling thread, and the thread opens its own database connection. The group
+    holds versions of a single concept, so it stops at the first version that
+    fails to publish and marks the later versions as failed, rather than 
+    publishing them out of order.
     """
-    A function to work through the Zenodo API steps to publish an new Excel only dataset.
-    It works through the publication steps as long as each step keeps returning a zero
-    success code, otherwise we get to the end with the most recent failure
+    
+    current.request = request
+    current.myconf = myconf
+    current.cache = cache
+    current.db = db
+    
+    db._adapter.reconnect()
+    
+    outcomes = {}
+    
+    try:
+        for idx, rid in enumerate(record_ids):
+            outcomes[rid] = submit_dataset_to_zenodo(rid)
+            
+            if not outcomes[rid].startswith('Published dataset'):
+                skipped = record_ids[idx + 1:]
+                msg = 'Not published as an earlier version (record ID {}) failed'.format(rid)
+                db(db.submitted_datasets.id.belongs(skipped)
+                   ).update(zenodo_submission_status='ZEN_FAIL', zenodo_error=msg)
+                db.commit()
+                outcomes.update({skip: msg for skip in skipped})
+                break
+    finally:
+        db._adapter.close()
+    
+    return outcomes
 
+
+def index_published_dataset(record, response):
+    """
+    Function to populate the published_datasets table and dataset index tables
+    from a submitted dataset record and the Zenodo response from publishing it.
+    
+    The rows for each table are written using multi-row inserts, with the UTM50N
+    geometries calculated by PostGIS as the rows are inserted. The caller is
+    expected to run this in a single transaction, so that a failure does not
+    leave a partially populated index.
+    
+    Args:
+        record: The submitted_datasets row that has been published
+        response: The Zenodo response from the publish step.
+    Returns:
+        The Zenodo response, without the metadata.
+    """
+    
+    db = current.db
+    metadata = record.dataset_metadata['metadata']
+    
+    # Copy the response, so that the stored publication state is not altered
+    response = copy.deepcopy(response)
+    
+    # Set the most recent flag for existing published versions to False
+    if record.concept_id is not None:
+        superseded = db((db.published_datasets.zenodo_concept_id == record.concept_id) &
+                        (db.published_datasets.most_recent == True))
+        superseded_rows = superseded.select(db.published_datasets.id,
+                                            db.published_datasets.zenodo_record_id)
+        log_catalogue_changes([r.zenodo_record_id for r in superseded_rows], 'superseded')
+        superseded.update(most_recent = False)
+        
+        # The taxon summary only counts the most recent versions
+        update_taxon_summary([r.id for r in superseded_rows], remove=True)
+    
+    # remove the dataset metadata from the zenodo response, since the
+    # contents is information we have already, so we can store the rest
+    del response['metadata']
+    
+    # Now create a published datasets entry, including the UTM 50N bbox geometry
+    published = dict(uploader_id=record.uploader_id,
+                     upload_datetime=record.upload_datetime,
+                     submission_id=record.id,
+                     dataset_title=metadata['title'],
+                     dataset_access=metadata['access'],
+                     dataset_embargo=metadata['embargo_date'],
+                     dataset_conditions=metadata['access_conditions'],
+                     dataset_description=metadata['description'],
+                     dataset_metadata=record.dataset_metadata['metadata'],
+                     dataset_check_worksheets=record.dataset_check_worksheets,
+                     temporal_extent_start=metadata['temporal_extent'][0],
+                     temporal_extent_end=metadata['temporal_extent'][1],
+                     geographic_extent= geometry.box(metadata['longitudinal_extent'][0],
+                                                     metadata['latitudinal_extent'][0],
+                                                     metadata['longitudinal_extent'][1],
+                                                     metadata['latitudinal_extent'][1]).wkt,
+                     publication_date=datetime.datetime.now(),
+                     most_recent=True,
+                     zenodo_record_id=response['record_id'],
+                     zenodo_record_doi=response['doi_url'],
+                     zenodo_record_badge=response['links']['badge'],
+                     zenodo_concept_id=response['conceptrecid'],
+                     zenodo_concept_doi=response['links']['conceptdoi'],
+                     zenodo_concept_badge=response['links']['conceptbadge'],
+                     zenodo_metadata=response)
+    
+    published_record = bulk_insert_rows(db.published_datasets, [published],
+                                        transforms={'geographic_extent_utm50n': 
+                                                    ('geographic_extent', 32650)})[0]
+    
+    # add an associated project link to the dataset concept 
+    # if one does not already exist
+    project_link = db((db.project_datasets.project_id == record.project_id) &
+                      (db.project_datasets.concept_id == response['conceptrecid'])
+                      ).select()
+
+    if not project_link:
+        db.project_datasets.insert(project_id=record.project_id,
+                                   concept_id=response['conceptrecid'],
+                                   user_id=record.uploader_id,
+                                   date_added=datetime.date.today())
+    
+    # populate index tables
+    # A) Taxa
+    taxa = record.dataset_metadata['taxa']
+    taxa = [dict(list(zip(['dataset_id', 'worksheet_name', 'gbif_id', 'gbif_parent_id',
+                      'taxon_name', 'taxon_rank', 'gbif_status'], 
+                     [published_record] + tx))) for tx in taxa]
+    
+    bulk_insert_rows(db.dataset_taxa, taxa)
+    update_taxon_closure([published_record])
+    update_taxon_summary([published_record])
+    
+    # B) Files, using the Zenodo response
+    files = response['files']
+    for each_file in files:
+        each_file['dataset_id'] = published_record
+        each_file['download_link'] = each_file['links']['download']
+        each_file['file_zenodo_id'] = each_file.pop('id')
+    
+    bulk_insert_rows(db.dataset_files, files)
+    
+    # C) Locations, including the UTM 50 N geometry where possible
+    locations = record.dataset_metadata['locations']
+    locations = [dict(list(zip(['dataset_id', 'name','new_location','type','wkt_wgs84'], 
+                          [published_record] + loc))) for loc in locations]
+    
+    bulk_insert_rows(db.dataset_locations, locations,
+                     transforms={'wkt_utm50n': ('wkt_wgs84', 32650)})
+    
+    # D) Dataworksheets and fields, using the returned worksheet ids
+    #    to link the fields to the worksheets
+    worksheets = [dict(data, dataset_id=published_record) for data in metadata['dataworksheets']]
+    worksheet_ids = bulk_insert_rows(db.dataset_worksheets, worksheets)
+    
+    fields = []
+    for data, worksheet_id in zip(metadata['dataworksheets'], worksheet_ids):
+        fields += [dict(fld, dataset_id=published_record, worksheet_id=worksheet_id)
+                   for fld in data['fields']]
+    
+    bulk_insert_rows(db.dataset_fields, fields)
+    
+    # E) Authors
+    bulk_insert_rows(db.dataset_authors, [dict(auth, dataset_id=published_record)
+                                          for auth in metadata['authors']])
+    
+    # F) Funders
+    if metadata['funders'] is not None:
+        bulk_insert_rows(db.dataset_funders, [dict(fndr, dataset_id=published_record)
+                                              for fndr in metadata['funders']])
+    
+    # G) Permits
+    if metadata['permits'] is not None:
+        bulk_insert_rows(db.dataset_permits, [dict(perm, dataset_id=published_record)
+                                              for perm in metadata['permits']])
+    
+    # K) Keywords
+    if metadata['keywords'] is not None:
+        bulk_insert_rows(db.dataset_keywords, [dict(keyword=kywd, dataset_id=published_record)
+                                               for kywd in metadata['keywords']])
+    
+    # L) Full text search document
+    update_search_documents([published_record])
+    
+    # M) Catalogue change log
+    log_catalogue_changes([response['record_id']], 'published')
+    
+    return response
+
+
+def bulk_insert_rows(table, rows, transforms=None, chunk_size=1000):
+    """
+    Inserts a list of rows into a table using multi-row INSERT statements, which
+    is much faster than the DAL bulk_insert, which inserts each row separately on
+    PostgreSQL. Keys that are not fields in the table are ignored and values are
+    represented by the DAL adapter, so JSON, boolean and geometry fields are handled 
+    as for a normal insert. The transforms argument can be used to fill geometry
+    fields by transforming another geometry field as the rows are inserted.
+    
     Args:
-        api: The API URL to use: sandbox or main site
-        token: A dictionary containing the key 'access_token'
-        record: The dataset row for the record to publish
+        table: A DAL table
+        rows: A list of dictionaries of field values
+        transforms: A dictionary mapping a geometry field name to a tuple of the 
+            source geometry field name and the SRID to transform to.
+        chunk_size: The maximum number of rows inserted by a single statement.
     Returns:
-        i) An integer code indicating success or failure,
-        ii) the links object for the deposit - which is needed to delete
-            partially created deposits and
-        iii) A response object from Zenodo - which will contain either a
-            failure message or the publication details.
+        A list of the ids of the inserted rows, in the order of the rows.
     """
+    
+    if not rows:
+        return []
+    
+    db = table._db
+    transforms = transforms or {}
+    
+    # Get the fields used by any row, in table order
+    used = set().union(*rows)
+    columns = [f for f in table.fields if f in used and f != 'id' and f not in transforms]
+    
+    def _values(row):
+        vals = [db._adapter.represent(row.get(col), table[col].type) for col in columns]
+        for src, srid in transforms.values():
+            vals.append('ST_Transform({}, {})'.format(
+                            db._adapter.represent(row.get(src), table[src].type), srid))
+        return '(' + ', '.join(vals) + ')'
+    
+    sql = 'INSERT INTO {} ({}) VALUES '.format(table._tablename, 
+                                               ', '.join(columns + list(transforms)))
+    ids = []
+    
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        ids += [r[0] for r in db.executesql(sql + ', '.join(_values(row) for row in chunk) + 
+                                            ' RETURNING id;')]
+    
+    return ids
 
-    # create the new deposit
-    code, response, zenodo_id = create_deposit(api, token)
 
-    # upload the record metadata
-    if code == 0:
-        # store previous response containing the links dictionary
-        links = response
-        code, response = upload_metadata(links, token, record, zenodo_id)
+def update_search_documents(dataset_ids=None):
+    """
+    Builds the full text search documents for published datasets from the
+    dataset index tables, replacing any existing documents. The text is weighted 
+    so that matches in the title rank above keywords, then descriptions of the 
+    dataset and worksheets and lastly field names and descriptions.
+    
+    Args:
+        dataset_ids: A list of published_datasets ids to update. If this is None,
+            all documents are rebuilt. The GIN index on the documents is created 
+            with the other API indexes by safe_web_db_indexes.create_indexes.
+    """
+    
+    db = current.db
+    
+    if dataset_ids is None:
+        where = ''
+        db.dataset_search.truncate()
+    elif not dataset_ids:
+        return
     else:
-        links = None
+        where = 'WHERE pd.id IN ({})'.format(', '.join(str(int(i)) for i in dataset_ids))
+        db(db.dataset_search.dataset_id.belongs(dataset_ids)).delete()
+    
+    db.executesql("""
+        INSERT INTO dataset_search (dataset_id, search_vector)
+        SELECT pd.id,
+            setweight(to_tsvector('english', coalesce(pd.dataset_title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(
+                (SELECT string_agg(kw.keyword, ' ') FROM dataset_keywords kw 
+                 WHERE kw.dataset_id = pd.id), '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(pd.dataset_description, '') || ' ' || 
+                coalesce((SELECT string_agg(concat_ws(' ', ws.title, ws.description), ' ')
+                          FROM dataset_worksheets ws WHERE ws.dataset_id = pd.id), '')), 'C') ||
+            setweight(to_tsvector('english', coalesce(
+                (SELECT string_agg(concat_ws(' ', fd.field_name, fd.description), ' ')
+                 FROM dataset_fields fd WHERE fd.dataset_id = pd.id), '')), 'D')
+        FROM published_datasets pd {};""".format(where))
+
+
+def update_taxon_closure(dataset_ids=None):
+    """
+    Maintains the taxon_closure table, which holds every ancestor and descendant 
+    pair in the GBIF taxon hierarchy described by the gbif_id and gbif_parent_id
+    pairs in dataset_taxa, along with the number of steps between them. 
+    
+    When dataset ids are provided, the taxa in those datasets are added to the
+    existing closure: each parent and child link that is not already present joins 
+    the ancestors of the parent to the descendants of the child. Without dataset
+    ids, the table is rebuilt from all published datasets using a recursive query.
+    
+    Taxa that are not in GBIF, such as morphospecies, are given a gbif_id of -1
+    or another non-positive id by the validator, so the same id is used by many
+    unrelated taxa. Only positive ids are included in the closure, otherwise
+    those shared ids would link every parent used by such a taxon. Searches 
+    match those taxa using their GBIF parent instead.
+    
+    Args:
+        dataset_ids: A list of published_datasets ids to add, or None to rebuild 
+            the closure table.
+    """
+    
+    db = current.db
+    
+    if dataset_ids is None:
+        db.taxon_closure.truncate()
+        
+        # The depth limit guards against cycles in inconsistent parent ids
+        db.executesql("""
+            WITH RECURSIVE links AS (
+                SELECT DISTINCT gbif_id AS child, gbif_parent_id AS parent FROM dataset_taxa
+                WHERE gbif_id > 0 AND gbif_parent_id > 0 AND gbif_id <> gbif_parent_id),
+            closure (ancestor_id, descendant_id, depth) AS (
+                SELECT gbif_id, gbif_id, 0 FROM dataset_taxa WHERE gbif_id > 0
+                UNION 
+                SELECT parent, parent, 0 FROM links
+                UNION
+                SELECT links.parent, closure.descendant_id, closure.depth + 1
+                FROM closure JOIN links ON links.child = closure.ancestor_id
+                WHERE closure.depth < 50)
+            INSERT INTO taxon_closure (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, descendant_id, min(depth) FROM closure 
+            GROUP BY ancestor_id, descendant_id;""")
+        return
+    elif not dataset_ids:
+        return
+    
+    where = 'dataset_id IN ({})'.format(', '.join(str(int(i)) for i in dataset_ids))
+    
+    # Add the depth zero rows for new taxa
+    db.executesql("""
+        INSERT INTO taxon_closure (ancestor_id, descendant_id, depth)
+        SELECT taxon_id, taxon_id, 0 
+        FROM (SELECT gbif_id AS taxon_id FROM dataset_taxa WHERE {0}
+              UNION SELECT gbif_parent_id FROM dataset_taxa WHERE {0}) AS taxa
+        WHERE taxon_id > 0 AND NOT EXISTS (
+            SELECT 1 FROM taxon_closure tc 
+            WHERE tc.ancestor_id = taxon_id AND tc.descendant_id = taxon_id);""".format(where))
+    
+    # Find the parent and child links that are not yet in the closure
+    links = db.executesql("""
+        SELECT DISTINCT gbif_id, gbif_parent_id FROM dataset_taxa dt
+        WHERE {} AND gbif_id > 0 AND gbif_parent_id > 0 
+            AND gbif_id <> gbif_parent_id AND NOT EXISTS (
+                SELECT 1 FROM taxon_closure tc 
+                WHERE tc.ancestor_id = dt.gbif_parent_id AND tc.descendant_id = dt.gbif_id);
+        """.format(where))
+    
+    # Each new link connects every ancestor of the parent to every descendant of 
+    # the child, skipping pairs that are already connected.
+    for child, parent in links:
+        db.executesql("""
+            INSERT INTO taxon_closure (ancestor_id, descendant_id, depth)
+            SELECT anc.ancestor_id, desc_.descendant_id, anc.depth + desc_.depth + 1
+            FROM taxon_closure anc, taxon_closure desc_
+            WHERE anc.descendant_id = %s AND desc_.ancestor_id = %s AND NOT EXISTS (
+                SELECT 1 FROM taxon_closure tc 
+                WHERE tc.ancestor_id = anc.ancestor_id 
+                    AND tc.descendant_id = desc_.descendant_id);""",
+                      placeholders=[parent, child])
+
+
+# The normalised key of a taxon in taxon_summary, which is the MD5 hash of the 
+# quoted taxon fields. quote_nullable() gives NULL for null fields and escaped 
+# quoted values otherwise, so null fields match each other and no two distinct
+# combinations of fields give the same text. The key has a unique index, so new
+# taxa can be matched to the summary using an upsert.
+TAXON_SUMMARY_KEY = """md5(concat_ws(',', quote_nullable(gbif_id), quote_nullable(gbif_parent_id),
+                                    quote_nullable(taxon_name), quote_nullable(taxon_rank),
+                                    quote_nullable(gbif_status)))"""
+
+
+def update_taxon_summary(dataset_ids=None, remove=False):
+    """
+    Maintains the taxon_summary table, which holds each distinct combination of 
+    the taxon fields in dataset_taxa and the number of distinct most recent 
+    published datasets using it.
+    
+    When dataset ids are provided, these must either be newly indexed datasets, 
+    and each taxon used in them has its count incremented or is added with a 
+    count of one, or datasets that have been superseded or are being removed from
+    the index, and each taxon used in them has its count decremented and is 
+    removed when no datasets use it. Without dataset ids, the table is rebuilt 
+    from all most recent published datasets.
+    
+    Args:
+        dataset_ids: A list of published_datasets ids, or None to rebuild the 
+            summary table.
+        remove: Should the datasets be removed from the summary, rather than added.
+    """
+    
+    db = current.db
+    
+    if dataset_ids is None:
+        db.taxon_summary.truncate()
+        db.executesql("""
+            INSERT INTO taxon_summary (taxon_key, gbif_id, gbif_parent_id, taxon_name, 
+                                       taxon_rank, gbif_status, n_datasets)
+            SELECT {}, gbif_id, gbif_parent_id, taxon_name, taxon_rank, gbif_status,
+                   count(DISTINCT dataset_id)
+            FROM dataset_taxa dt JOIN published_datasets pd ON pd.id = dt.dataset_id
+            WHERE pd.most_recent
+            GROUP BY gbif_id, gbif_parent_id, taxon_name, taxon_rank, gbif_status
+            ORDER BY min(dt.id);""".format(TAXON_SUMMARY_KEY))
+        return
+    elif not dataset_ids:
+        return
+    
+    ids = ', '.join(str(int(i)) for i in dataset_ids)
+    
+    # Add the change in the count of each taxon, inserting new taxa in the
+    # order that they were first used
+    db.executesql("""
+        INSERT INTO taxon_summary (taxon_key, gbif_id, gbif_parent_id, taxon_name, 
+                                   taxon_rank, gbif_status, n_datasets)
+        SELECT {0}, gbif_id, gbif_parent_id, taxon_name, taxon_rank, gbif_status,
+               {1} count(DISTINCT dataset_id)
+        FROM dataset_taxa WHERE dataset_id IN ({2})
+        GROUP BY gbif_id, gbif_parent_id, taxon_name, taxon_rank, gbif_status
+        ORDER BY min(id)
+        ON CONFLICT (taxon_key) 
+        DO UPDATE SET n_datasets = taxon_summary.n_datasets + EXCLUDED.n_datasets;
+        """.format(TAXON_SUMMARY_KEY, '-' if remove else '', ids))
+    
+    if remove:
+        db.executesql("""
+            DELETE FROM taxon_summary 
+            WHERE n_datasets <= 0 AND taxon_key IN (SELECT {} FROM dataset_taxa 
+                                                    WHERE dataset_id IN ({}));
+            """.format(TAXON_SUMMARY_KEY, ids))
+
+
+def discard_publication(record, token):
+    """
+    Function to discard a partially completed publication of a dataset. If the 
+    deposit was created for this record, rather than adopted, and has not been 
+    published, the deposit is deleted. This can fail and leave a hanging deposit, 
+    but that is not allowed to block a new attempt.
+    
+    Args:
+        record: The submitted_datasets row
+        token: The access token to be used
+    """
+    
+    state = record.zenodo_publication
+    
+    if (state is not None and state['links'] is not None and 
+            state['route'] != 'adopt' and 'publish_deposit' not in state['completed']):
+        try:
+            _, _ = delete_deposit(state['links'], token)
+        except requests.exceptions.RequestException:
+            pass
+    
+    record.update_record(zenodo_publication=None, zenodo_upload=None)
 
-    # upload the file
-    if code == 0:
-        code, response = upload_file(links, token, record)
 
-    # publish the deposit
-    if code == 0:
-        code, response = publish_deposit(links, token)
+"""
+Zenodo publication steps. Each step takes the API, token, record and the
+publication state dictionary and returns an integer code indicating success (0)
+or failure (1) and a response. Steps store anything needed by later steps in
+the publication state, which is saved to the record after each step.
+"""
 
-    # Return what we've got
-    if code > 0:
-        return 1, links, response
-    else:
-        return 0, links, response
 
+def _step_create_deposit(api, token, record, state):
+    
+    # create the new deposit
+    code, response, zenodo_id = create_deposit(api, token)
+    
+    if code == 0:
+        state['links'] = response
+        state['zenodo_id'] = zenodo_id
+    
+    return code, response
 
-def update_excel_zenodo(api, token, record):
-    """
-    A function to work through the Zenodo API steps to publish a new version of an Excel
-    only dataset. It works through the publication steps as long as each step keeps returning
-    a zero success code, otherwise we get to the end with the most recent failure
 
-    Args:
-        api: The API URL to use: sandbox or main site
-        token: A dictionary containing the key 'access_token'
-        record: The dataset row for the record to publish
-    Returns:
-        i) An integer code indicating success or failure,
-        ii) the links object for the deposit - which is needed to delete
-            partially created deposits and
-        iii) A response object from Zenodo - which will contain either a
-            failure message or the publication details.
-    """
+def _step_create_deposit_draft(api, token, record, state):
+    
     # get a new draft of the existing record from the zenodo id of the
     # most recent published record (can't create a draft from a concept id)
     most_recent = current.db((current.db.published_datasets.zenodo_concept_id == record.concept_id) &
@@ -483,94 +1350,78 @@ def update_excel_zenodo(api, token, record):
                              ).select().first()
     
     code, response, zenodo_id = create_deposit_draft(api, token, most_recent.zenodo_record_id)
-
-    # upload the record metadata
-    if code == 0:
-        # store previous response containing the links dictionary
-        links = response
-        code, response = upload_metadata(links, token, record, zenodo_id)
-    else:
-        links = None
-
-    # delete the existing file
+    
     if code == 0:
-        code, response = delete_previous_file(links, token)
+        state['links'] = response
+        state['zenodo_id'] = zenodo_id
+    
+    return code, response
 
-    # upload the new file
-    if code == 0:
-        code, response = upload_file(links, token, record)
 
-    # publish the deposit
-    if code == 0:
-        code, response = publish_deposit(links, token)
-
-    # Return what we've got
+def _step_adopt_deposit(api, token, record, state):
+    
+    # get the deposit
+    code, response = get_deposit(api, token, state['deposit_id'])
+    
     if code > 0:
-        return 1, links, response
-    else:
-        return 0, links, response
-
+        return code, response
+    
+    # check the files found in the deposit match with the external
+    # files specified in the record metadata.
+    remote_filenames = {rfile['filename'] for rfile in response['files']}
+    external_files = set([r['file'] for r in record.dataset_metadata['metadata']['external_files']])
+    
+    if not remote_filenames == external_files:
+        return 1, "Files in deposit do not match external files listed in Excel file"
+    
+    state['links'] = response['links']
+    state['zenodo_id'] = state['deposit_id']
+    
+    return 0, 'success'
 
-def adopt_external_zenodo(api, token, record, deposit_id):
 
-    """
-    A function to work through the Zenodo API steps to publish a dataset that adopts
-    external files in an existing deposit. It works through the publication steps as
-    long as each step keeps returning a zero success code, otherwise we get to the end
-    with the most recent failure
+def _step_upload_metadata(api, token, record, state):
+    
+    return upload_metadata(state['links'], token, record, state['zenodo_id'])
 
-    Args:
-        api: The API URL to use: sandbox or main site
-        token: A dictionary containing the key 'access_token'
-        record: The dataset row for the record to publish
-        deposit_id: An integer giving the id of an existing Zenodo deposit to adopt
-            using this dataset record.
-    Returns:
-        i) An integer code indicating success or failure,
-        ii) the links object for the deposit - which is needed to delete
-            partially created deposits and
-        iii) A response object from Zenodo - which will contain either a
-            failure message or the publication details.
-    """
 
-    # get the deposit
-    code, response = get_deposit(api, token, deposit_id)
+def _step_delete_previous_file(api, token, record, state):
+    
+    return delete_previous_file(state['links'], token)
 
-    # upload the record metadata
-    if code == 0:
-        # store previous response containing the links dictionary
-        # and the list of remote files
-        remote_files = response['files']
-        links = response['links']
-        code, response = upload_metadata(links, token, record, deposit_id)
-
-        # If we got a deposit, check the files found in the deposit match
-        # with the external files specified in the record metadata.
-        remote_filenames = {rfile['filename'] for rfile in remote_files}
-        external_files = set([r['file'] for r in record.dataset_metadata['metadata']['external_files']])
-        
-        if not remote_filenames == external_files:
-            code = 1
-            response = "Files in deposit do not match external files listed in Excel file"
-            links = None
-    else:
-        links = None
 
-    # Upload the Excel file - the expectation here is that the Excel file
+def _step_upload_file(api, token, record, state):
+    
+    # For adopted deposits, the expectation here is that the Excel file
     # associated with previous drafts is deleted as part of the manual file
     # update process, so we only have to upload the one submitted to the website
-    if code == 0:
-        code, response = upload_file(links, token, record)
+    return upload_file(state['links'], token, record)
+
 
-    # publish the deposit
+def _step_publish_deposit(api, token, record, state):
+    
+    code, response = publish_deposit(state['links'], token)
+    
     if code == 0:
-        code, response = publish_deposit(links, token)
+        state['response'] = response
+    
+    return code, response
 
-    # Return what we've got
-    if code > 0:
-        return 1, links, response
-    else:
-        return 0, links, response
+
+# The sequence of steps used to publish each kind of dataset
+ZENODO_ROUTES = {'create': [('create_deposit', _step_create_deposit),
+                            ('upload_metadata', _step_upload_metadata),
+                            ('upload_file', _step_upload_file),
+                            ('publish_deposit', _step_publish_deposit)],
+                 'update': [('create_deposit_draft', _step_create_deposit_draft),
+                            ('upload_metadata', _step_upload_metadata),
+                            ('delete_previous_file', _step_delete_previous_file),
+                            ('upload_file', _step_upload_file),
+                            ('publish_deposit', _step_publish_deposit)],
+                 'adopt': [('adopt_deposit', _step_adopt_deposit),
+                           ('upload_metadata', _step_upload_metadata),
+                           ('upload_file', _step_upload_file),
+                           ('publish_deposit', _step_publish_deposit)]}
 
 
 """
@@ -581,8 +1432,9 @@ Zenodo action functions
 def get_deposit(api, token, deposit_id):
 
     # request the deposit
-    dep = requests.get(api + 'deposit/depositions/{}'.format(deposit_id), params=token, json={},
-                       headers={"Content-Type": "application/json"})
+    zenodo = get_zenodo_client()
+    dep = zenodo.get('get_deposit', api + 'deposit/depositions/{}'.format(deposit_id),
+                     params=token, json={}, headers={"Content-Type": "application/json"})
 
     # check for success and return the information.
     if dep.status_code != 200:
@@ -603,8 +1455,9 @@ def create_deposit(api, token):
     """
 
     # get a new deposit resource
-    dep = requests.post(api + '/deposit/depositions', params=token, json={},
-                        headers={"Content-Type": "application/json"})
+    zenodo = get_zenodo_client()
+    dep = zenodo.post('create_deposit', api + '/deposit/depositions', params=token, json={},
+                      headers={"Content-Type": "application/json"})
 
     # trap errors in creating the resource - successful creation of new deposits returns 201
     if dep.status_code != 201:
@@ -626,9 +1479,11 @@ def create_deposit_draft(api, token, deposit_id):
     """
 
     # get the draft api
-    new_draft = requests.post(api + '/deposit/depositions/{}/actions/newversion'.format(deposit_id), 
-                              params=token, json={},
-                              headers={"Content-Type": "application/json"})
+    zenodo = get_zenodo_client()
+    new_draft = zenodo.post('create_deposit_draft',
+                            api + '/deposit/depositions/{}/actions/newversion'.format(deposit_id), 
+                            params=token, json={},
+                            headers={"Content-Type": "application/json"})
 
     # trap errors in creating the new version
     if new_draft.status_code != 201:
@@ -636,8 +1491,8 @@ def create_deposit_draft(api, token, deposit_id):
 
     # now get the newly created version
     api = new_draft.json()['links']['latest_draft']
-    dep = requests.get(api, params=token, json={},
-                       headers={"Content-Type": "application/json"})
+    dep = zenodo.get('get_deposit', api, params=token, json={},
+                     headers={"Content-Type": "application/json"})
 
     # trap errors in creating the resource - successful creation of new version
     #  drafts returns 200
@@ -706,8 +1561,10 @@ def upload_metadata(links, token, record, zenodo_id):
     zen_md['metadata']['description'] = str(dataset_description(record, gemini_id=zenodo_id))
 
     # attach the metadata to the deposit resource
-    mtd = requests.put(links['self'], params=token, data=simplejson.dumps(zen_md),
-                       headers={"Content-Type": "application/json"})
+    zenodo = get_zenodo_client()
+    mtd = zenodo.put('upload_metadata', links['self'], params=token, 
+                     data=simplejson.dumps(zen_md),
+                     headers={"Content-Type": "application/json"})
 
     # trap errors in uploading metadata and tidy up
     if mtd.status_code != 200:
@@ -738,7 +1595,8 @@ def update_published_metadata(zenodo_record_id, new_values):
     metadata = dep['metadata']
     
     # Unlock the published deposit for editing
-    edt = requests.post(links['edit'], params=token)
+    zenodo = get_zenodo_client()
+    edt = zenodo.post('edit_deposit', links['edit'], params=token)
     
     if edt.status_code != 201:
         return 1, edt.json()
@@ -753,16 +1611,16 @@ def update_published_metadata(zenodo_record_id, new_values):
     # If any API calls from now fail, we need to tidy up the edit
     # status of the record, or it will block subsequent attempts
             
-    upd = requests.put(links['self'], params=token,
-                       headers = {"Content-Type": "application/json"}, 
-                       data=simplejson.dumps({'metadata': metadata}))
+    upd = zenodo.put('update_published_metadata', links['self'], params=token,
+                     headers = {"Content-Type": "application/json"}, 
+                     data=simplejson.dumps({'metadata': metadata}))
     
     success_so_far = 0 if upd.status_code != 200 else 1
     ret = upd.json()
 
     # Republish to save the changes
     if success_so_far:
-        pub = requests.post(links['publish'], params=token)
+        pub = zenodo.post('publish_deposit', links['publish'], params=token)
         success_so_far = 0 if pub.status_code != 202 else 1
         ret = pub.json()
         
@@ -773,7 +1631,7 @@ def update_published_metadata(zenodo_record_id, new_values):
     if success_so_far:
         return 0, ret
     else:
-        dsc = requests.post(links['discard'], params=token)
+        dsc = zenodo.post('discard_deposit', links['discard'], params=token)
         success_so_far = 0 if dsc.status_code != 201 else 1
         if not success_so_far:
             ret = dsc.json()
@@ -781,22 +1639,6 @@ def update_published_metadata(zenodo_record_id, new_values):
         return 1, ret
 
 
-# # Untested snippet from: https://gist.github.com/tyhoff/b757e6af83c1fd2b7b83057adf02c139
-# # possibly of use when and if this module gets built into safedata_validator,
-# # to provide user feedback on uploading bulk data to drafts.
-# 
-# from tqdm import tqdm
-# from tqdm.utils import CallbackIOWrapper
-#
-# file_path = os.path.abspath(__file__)
-# upload_url = https://some-bucket.s3.amazonaws.com
-#
-# file_size = os.stat(file_path).st_size
-# with open(file_path, "rb") as f:
-#     with tqdm(total=file_size, unit="B", unit_scale=True, unit_divisor=1024) as t:
-#         wrapped_file = CallbackIOWrapper(t.update, f, "read")
-#         requests.put(upload_url, data=wrapped_file)
-
 def upload_file(links, token, record):
     """
     Function to upload the Excel datafile submitted for a record to Zenodo deposit.
@@ -815,10 +1657,21 @@ def upload_file(links, token, record):
     bucket_url = links['bucket']
     fname = os.path.join(current.request.folder, 'uploads', 'submitted_datasets', record.file)
     
+    # Files larger than a single part use a resumable multipart upload
+    try:
+        part_size = int(current.myconf.take('zenodo.upload_part_mb')) * 1024 ** 2
+    except BaseException:
+        part_size = 64 * 1024 ** 2
+    
+    if os.path.getsize(fname) > part_size:
+        return upload_file_multipart(bucket_url, token, record, fname, part_size)
+    
+    # Otherwise stream the file in a single request
+    zenodo = get_zenodo_client()
     with open(fname, 'rb') as fp:
-        fls = requests.put(bucket_url + '/' + record.file_name,
-                           data=fp,
-                           params=token)
+        fls = zenodo.put('upload_file', bucket_url + '/' + record.file_name,
+                         data=fp,
+                         params=token)
     
     # trap errors in uploading file
     # - no success or mismatch in md5 checksums
@@ -830,6 +1683,126 @@ def upload_file(links, token, record):
         return 0, 'success'
 
 
+def upload_file_multipart(bucket_url, token, record, fname, part_size):
+    """
+    Function to upload a large file to a Zenodo deposit bucket as a multipart
+    upload, using the Invenio files REST API. The file is read from disk one
+    part at a time, so only a single part is held in memory. The multipart 
+    upload id is stored in the record, so if an upload is interrupted, a retry
+    lists the parts already uploaded to the bucket and only sends the missing
+    parts.
+    
+    Once all parts are uploaded, the MD5 hash of the local file is checked against
+    the hash recorded at submission and the upload is completed. Zenodo merges 
+    the parts after completion, so the bucket is checked for a short time until
+    the merged file reports a checksum, which is then checked against the local
+    hash. The stored upload records that the upload was completed, so if the 
+    checksum is not yet available, a retry only checks the bucket again.
+    
+    Args:
+        bucket_url: The bucket link from a created deposit
+        token: The access token to be used
+        record: The database record for the dataset
+        fname: The path to the local file
+        part_size: The size of each part in bytes
+    
+    Returns:
+        An integer indicating success (0) or failure (1) and either 'success' 
+        or an error message
+    """
+    
+    zenodo = get_zenodo_client()
+    object_url = bucket_url + '/' + record.file_name
+    size = os.path.getsize(fname)
+    
+    # Invenio rejects the last part of a file that is an exact multiple of the
+    # part size, so those files use a slightly smaller part size
+    part_size = multipart_part_size(size, part_size)
+    if part_size is None:
+        return 1, 'No part size can be used to upload {} in parts'.format(record.file_name)
+    
+    n_parts = multipart_parts(size, part_size)
+    
+    # Look for an interrupted upload of the file to the same bucket
+    state = record.zenodo_upload
+    uploaded = set()
+    
+    if (state is not None and state['bucket'] == bucket_url and 
+            state['part_size'] == part_size):
+        if not state.get('completed'):
+            parts = zenodo.get('upload_file_parts', object_url,
+                               params=dict(token, uploadId=state['upload_id']))
+            if parts.status_code == 200:
+                uploaded = {prt['part_number'] for prt in parts.json()}
+            else:
+                state = None
+    else:
+        state = None
+    
+    # Otherwise, start a new multipart upload and store it so it can be resumed
+    if state is None:
+        init = zenodo.post('upload_file_init', object_url,
+                           params=dict(token, uploads='', size=size, partSize=part_size))
+        if init.status_code not in (200, 201):
+            return 1, init.json()
+        
+        state = {'bucket': bucket_url, 'upload_id': init.json()['id'], 'part_size': part_size}
+        record.update_record(zenodo_upload=state)
+        current.db.commit()
+    
+    if not state.get('completed'):
+        # Upload the missing parts, reading every part to calculate the local hash
+        local_md5 = hashlib.md5()
+        
+        with open(fname, 'rb') as fp:
+            for part in range(n_parts):
+                chunk = fp.read(part_size)
+                local_md5.update(chunk)
+                
+                if part in uploaded:
+                    continue
+                
+                prt = zenodo.put('upload_file_part', object_url, data=chunk,
+                                 params=dict(token, uploadId=state['upload_id'], 
+                                             partNumber=part))
+                if prt.status_code != 200:
+                    return 1, prt.json()
+        
+        if local_md5.hexdigest() != record.file_hash:
+            return 1, "Local file does not match the MD5 hash recorded at submission"
+        
+        # Complete the upload and record that it is complete
+        cmp = zenodo.post('upload_file_complete', object_url,
+                          params=dict(token, uploadId=state['upload_id']))
+        if cmp.status_code != 200:
+            return 1, cmp.json()
+        
+        state = dict(state, completed=True)
+        record.update_record(zenodo_upload=state)
+        current.db.commit()
+    
+    # Wait for the merged file to report a checksum, for up to about a minute
+    for attempt in range(8):
+        bucket = zenodo.get('upload_file_checksum', bucket_url, params=token)
+        if bucket.status_code != 200:
+            return 1, bucket.json()
+        
+        checksum = [obj['checksum'] for obj in bucket.json()['contents']
+                    if obj['key'] == record.file_name]
+        
+        if checksum and checksum[0] is not None:
+            record.update_record(zenodo_upload=None)
+            current.db.commit()
+            
+            if checksum[0] != 'md5:' + record.file_hash:
+                return 1, "Mismatch in local and uploaded MD5 hashes"
+            return 0, 'success'
+        
+        time.sleep(min(2 ** attempt, 10))
+    
+    return 1, "Uploaded file checksum not available from Zenodo"
+
+
 def delete_deposit(links, token):
     """
     Function to delete an (unpublished) partially created deposit if the publication
@@ -844,7 +1817,8 @@ def delete_deposit(links, token):
         deposit links dictionary or an error message
     """
 
-    delete = requests.delete(links['self'], params=token)
+    zenodo = get_zenodo_client()
+    delete = zenodo.delete('delete_deposit', links['self'], params=token)
 
     if delete.status_code != 204:
         return 1, delete.json()
@@ -866,7 +1840,8 @@ def publish_deposit(links, token):
     """
 
     # publish
-    pub = requests.post(links['publish'], params=token)
+    zenodo = get_zenodo_client()
+    pub = zenodo.post('publish_deposit', links['publish'], params=token)
 
     # trap errors in publishing, otherwise return the publication metadata
     if pub.status_code != 202:
@@ -890,7 +1865,8 @@ def delete_previous_file(links, token):
     """
 
     # get the existing files
-    files = requests.get(links['files'], params=token)
+    zenodo = get_zenodo_client()
+    files = zenodo.get('delete_previous_file', links['files'], params=token)
 
     # check the result of the files request
     if files.status_code != 200:
@@ -902,7 +1878,7 @@ def delete_previous_file(links, token):
 
     # get the delete link to the file and call
     delete_api = files.json()[0]['links']['self']
-    file_del = requests.delete(delete_api, params=token)
+    file_del = zenodo.delete('delete_previous_file', delete_api, params=token)
 
     if file_del.status_code != 204:
         return 1, file_del.json()
@@ -922,7 +1898,8 @@ def taxon_index_to_text(taxa):
     of the taxonomic hierarchy used in the dataset. Takes a list
     of dicts keyed by the fields of dataset_taxa - this could come 
     from db.datasets_taxa for a published dataset but also from 
-    the dataset_metadata of submitted datasets.
+    the dataset_metadata of submitted datasets. A taxon is shown with 
+    the next sibling taxon sharing its worksheet name, as a synonym pair.
     """
     
     def indent(n):
@@ -945,23 +1922,55 @@ def taxon_index_to_text(taxa):
     # group by parent taxon, subsitituting 0 for None
     taxa.sort(key=lambda x: x['gbif_parent_id'] or 0)
     grouped = {k: list(v) for k, v in groupby(taxa, lambda x: x['gbif_parent_id'])}
+    
+    # Index the positions of the taxa in each group by worksheet name, so that the 
+    # next sibling sharing a worksheet name can be found without scanning siblings.
+    positions = {}
+    for parent_id, group in grouped.items():
+        positions[parent_id] = defaultdict(list)
+        for idx, tx in enumerate(group):
+            if tx['worksheet_name'] is not None:
+                positions[parent_id][tx['worksheet_name']].append(idx)
+    
+    def start(parent_id):
+        
+        # A frame holds a group of siblings, the position of the current taxon, the 
+        # positions already taken as name pairs and queues of the remaining positions 
+        # for each worksheet name, which are created as they are needed.
+        group = grouped[parent_id]
+        return {'group': group, 'pos': 0, 'positions': positions[parent_id],
+                'used': [False] * len(group), 'queues': {}}
 
     # start the stack with the kingdoms - these taxa will have None as a parent
-    stack = [{'current': grouped[None][0], 'next': grouped[None][1:]}]
+    stack = [start(None)]
 
     while stack:
     
         # Handle the current top of the stack: format the canonical name
-        current = stack[-1]['current']
+        frame = stack[-1]
+        group, pos, used = frame['group'], frame['pos'], frame['used']
+        current = group[pos]
         canon_name = format_name(current)
-
-        # Look for a non-None entry in next that shares the same worksheet name
-        next_ws_names = [tx['worksheet_name'] for tx in stack[-1]['next'] 
-                         if tx['worksheet_name'] is not None]
         
-        if current['worksheet_name'] in next_ws_names:
-            # pop out the matching entry and find which is 'accepted'
-            name_pair = stack[-1]['next'].pop(next_ws_names.index(current['worksheet_name']))
+        # Look for a later unused sibling that shares the same worksheet name, 
+        # dropping positions that have been passed from the front of the queue.
+        match = None
+        ws_name = current['worksheet_name']
+        
+        if ws_name is not None:
+            queue = frame['queues'].get(ws_name)
+            if queue is None:
+                queue = frame['queues'][ws_name] = deque(frame['positions'][ws_name])
+            while queue and (queue[0] <= pos or used[queue[0]]):
+                queue.popleft()
+            if queue:
+                match = queue.popleft()
+        
+        if match is not None:
+            # take the matching sibling as the name pair and find which is 'accepted'
+            used[match] = True
+            name_pair = group[match]
+            
             if current['gbif_status'] == 'accepted':
                 as_name = format_name(name_pair)
                 as_status = name_pair['gbif_status']
@@ -977,17 +1986,21 @@ def taxon_index_to_text(taxa):
         html.write(txt)
         
         # Is this taxon a parent for other taxa - if so add that taxon to the top of
-        # the stack, otherwise start looking for a next taxon to push onto the stack.
-        # If there is none at the top, pop and look down.
+        # the stack, otherwise move on to the next unused taxon in the group. If the 
+        # group is finished, pop it and look down.
         parent_id = current['gbif_id']        
         if parent_id in grouped:
-            stack.append({'current': grouped[parent_id][0], 'next': grouped[parent_id][1:]})
+            stack.append(start(parent_id))
         else:
             while stack:
-                push = stack.pop()
-                if push['next']:
-                    stack.append({'current': push['next'][0], 'next': push['next'][1:]})
+                frame = stack[-1]
+                pos = frame['pos'] + 1
+                while pos < len(frame['group']) and frame['used'][pos]:
+                    pos += 1
+                if pos < len(frame['group']):
+                    frame['pos'] = pos
                     break
+                stack.pop()
 
     return XML(html.getvalue())
 
@@ -1356,13 +2369,181 @@ def generate_inspire_xml(record):
 
 # API search functions
 
+def get_catalogue_generation():
+    """
+    Gets the current generation number of the published catalogue.
+    """
+    
+    db = current.db
+    row = db(db.catalogue_generation).select(db.catalogue_generation.generation,
+                                             orderby=db.catalogue_generation.id).first()
+    
+    return 0 if row is None else row.generation
+
+
+def get_catalogue_last_modified(dates=None):
+    """
+    Gets the time at which the published catalogue, or a part of it, was last
+    modified, for use in Last-Modified headers. This is the most recent of the 
+    provided publication dates, or of all publication dates if none are provided, 
+    and the last change in the catalogue generation, which also records changes 
+    to access and the gazetteer.
+    
+    Args:
+        dates: An optional list of publication datetimes
+    Returns:
+        A datetime or None if the catalogue is empty.
+    """
+    
+    db = current.db
+    
+    if dates is None:
+        dates = [db(db.published_datasets).select(
+                     db.published_datasets.publication_date.max()).first()[
+                     db.published_datasets.publication_date.max()]]
+    
+    updated = db(db.catalogue_generation).select(db.catalogue_generation.updated).first()
+    
+    if updated is not None:
+        dates.append(updated.updated)
+    
+    dates = [dt for dt in dates if dt is not None]
+    
+    return max(dates) if dates else None
+
+
+def bump_catalogue_generation():
+    """
+    Increments the generation number of the published catalogue. This needs to
+    be called by anything that changes the results of the API searches - publishing
+    datasets, changing dataset access or reloading the gazetteer - and is committed
+    along with those changes, so that cached search results are discarded. The
+    hash of the dataset index at the new generation is also recorded.
+    """
+    
+    db = current.db
+    gen = db.catalogue_generation
+    
+    updated = db(gen).update(generation=gen.generation + 1, 
+                             updated=datetime.datetime.now())
+    
+    if not updated:
+        gen.insert(generation=1, updated=datetime.datetime.now())
+    
+    # Assign any logged changes to the new generation
+    generation = get_catalogue_generation()
+    db(db.catalogue_changes.generation == None).update(generation=generation)
+    
+    # Record the hash of the index at the new generation, so that clients holding
+    # that index can synchronise from it. This is part of the same transaction as
+    # the changes, so the hash always matches the index at that generation.
+    _, body = serialise_index()
+    db.catalogue_index_hashes.insert(generation=generation,
+                                     index_hash=hashlib.md5(body).hexdigest())
+
+
+def log_catalogue_changes(zenodo_record_ids, change):
+    """
+    Records changes to published records in the catalogue change log. The changes
+    are assigned to a generation when the catalogue generation is next bumped.
+    
+    Args:
+        zenodo_record_ids: A list of Zenodo record ids
+        change: The type of change: published, superseded or access
+    """
+    
+    db = current.db
+    now = datetime.datetime.now()
+    
+    db.catalogue_changes.bulk_insert([dict(change_datetime=now, zenodo_record_id=rid,
+                                           change=change) for rid in zenodo_record_ids])
+
+
+# The catalogue generation last seen by this process
+_cache_generation = None
+
+
+def shared_cache(key, func, time_expire=None):
+    """
+    A cache for values that depend on the published catalogue, such as the
+    dataset index and API search results, that is shared between processes. 
+    Values are tagged with the catalogue generation number held in the database,
+    so when any process changes the catalogue and bumps the generation, every 
+    process stops using the old values. 
+    
+    Values are held in the disk cache, which is shared by all of the web server
+    processes on a host, so a value is only calculated once per generation, and
+    also in the ram cache of each process, to avoid reading from disk. When a 
+    process sees a new generation, it clears the older values from its ram cache
+    and from the disk cache.
+    
+    Args:
+        key: The cache key
+        func: A function with no arguments that calculates the value.
+        time_expire: An optional expiry time in seconds, otherwise values are 
+            kept until the catalogue generation changes.
+    Returns:
+        The cached value
+    """
+    
+    global _cache_generation
+    
+    cache = current.cache
+    generation = get_catalogue_generation()
+    
+    if generation != _cache_generation:
+        cache.ram.clear(regex='^catalogue:')
+        cache.disk.clear(regex='^catalogue:(?!{}:)'.format(generation))
+        _cache_generation = generation
+    
+    key = 'catalogue:{}:{}'.format(generation, key)
+    
+    return cache.ram(key, lambda: cache.disk(key, func, time_expire=time_expire),
+                     time_expire=time_expire)
+
+
+def cached_search(endpoint, params, most_recent, ids, search):
+    """
+    Returns the result of an API search from the shared cache, running the search
+    if needed. Results are keyed by the endpoint, the search parameters, the
+    most_recent flag and the ids and are discarded when the catalogue changes.
+    
+    Args:
+        endpoint: The search endpoint name
+        params: A dictionary of the search parameters
+        most_recent: The most_recent flag
+        ids: None or a list of record ids to search within
+        search: A function with no arguments that runs the search and returns
+            a JSON serialisable result.
+    Returns:
+        The search result
+    """
+    
+    # Normalise the parameters, so equivalent searches share a key
+    params = sorted((str(k), v if isinstance(v, str) else sorted(v)) 
+                    for k, v in params.items())
+    ids = None if ids is None else sorted(set(ids))
+    
+    key = 'api_search:' + simplejson.dumps([endpoint, params, most_recent, ids])
+    
+    try:
+        time_expire = int(current.myconf.take('api.search_cache_seconds'))
+    except BaseException:
+        time_expire = 3600
+    
+    return shared_cache(key, search, time_expire=time_expire)
+
+
 def dataset_query_to_json(qry, most_recent=False, ids=None,
                           fields=[('published_datasets','zenodo_concept_id'), 
                                   ('published_datasets','zenodo_record_id'),
-                                  ('published_datasets','dataset_title')]):
+                                  ('published_datasets','dataset_title')],
+                          orderby=None):
     """
     Shared function to take a Query including rows in db.published datasets
-    and return a standardised set of attributes and a count.
+    and return a standardised set of attributes and a count. Search functions
+    that rank their results provide an orderby, in which case the query must 
+    return distinct datasets.
     """
     
     db = current.db
@@ -1375,12 +2556,16 @@ def dataset_query_to_json(qry, most_recent=False, ids=None,
 
     # Turn fields argument into fields references and select
     fields = [db[t][f] for t, f in fields]
-    rows = db(qry).select(*fields, distinct=True)
+    
+    if orderby is None:
+        rows = db(qry).select(*fields, distinct=True)
+    else:
+        rows = db(qry).select(*fields, orderby=orderby)
         
     return {'count': len(rows), 'entries': rows}
     
 
-def dataset_taxon_search(gbif_id=None, name=None, rank=None):
+def dataset_taxon_search(gbif_id=None, name=None, rank=None, descendants='false'):
     
     """Search for datasets by taxon information
     
@@ -1388,27 +2573,52 @@ def dataset_taxon_search(gbif_id=None, name=None, rank=None):
         /api/search/taxa?name=Formicidae
         /api/search/taxa?gbif_id=4342
         /api/search/taxa?rank=Family
+        /api/search/taxa?name=Formicidae&descendants=true
     
     Args:
         gbif_id (int): A GBIF taxon id.
         name (str): A scientific name
         rank (str): A taxonomic rank. Note that GBIF only provides 
             kingdom, phylum, order, class, family, genus and species.
+        descendants (str): If 'true', also find datasets that include any taxa
+            within the matching taxa, such as species within a family, using 
+            the GBIF taxon hierarchy across all published datasets. Taxa that
+            are not in GBIF, such as morphospecies, are found using their GBIF
+            parent taxon.
     """
     
     db = current.db
-    qry = (db.published_datasets.id == db.dataset_taxa.dataset_id)
+    
+    if descendants not in ['true', 'false']:
+        return {'error': 400, 'message': "The descendants option must be 'true' or 'false'"}
+    
+    qry = None
     
     if gbif_id is not None:
-        qry &= (db.dataset_taxa.gbif_id == gbif_id)
+        qry = (db.dataset_taxa.gbif_id == gbif_id)
 
     if name is not None:
-        qry &= (db.dataset_taxa.taxon_name == name)
+        sub_qry = (db.dataset_taxa.taxon_name == name)
+        qry = sub_qry if qry is None else qry & sub_qry
 
     if rank is not None:
-        qry &= (db.dataset_taxa.taxon_rank == rank.lower())
-        
-    return qry
+        sub_qry = (db.dataset_taxa.taxon_rank == rank.lower())
+        qry = sub_qry if qry is None else qry & sub_qry
+    
+    if descendants == 'true' and qry is not None:
+        # Find the matching taxa and then any taxa that they contain, keeping the 
+        # matching rows themselves in case they have no GBIF id. Taxa without a
+        # GBIF id share placeholder ids, so are matched on their parent instead.
+        matched = db(qry)._select(db.dataset_taxa.gbif_id, distinct=True)
+        contained = db(db.taxon_closure.ancestor_id.belongs(matched)
+                       )._select(db.taxon_closure.descendant_id)
+        not_gbif = (db.dataset_taxa.gbif_id == None) | (db.dataset_taxa.gbif_id <= 0)
+        qry |= (db.dataset_taxa.gbif_id.belongs(contained) |
+                (not_gbif & db.dataset_taxa.gbif_parent_id.belongs(contained)))
+    
+    link = (db.published_datasets.id == db.dataset_taxa.dataset_id)
+    
+    return link if qry is None else link & qry
 
 
 def dataset_author_search(name=None):
@@ -1535,26 +2745,87 @@ def dataset_text_search(text=None):
     
     Examples:
         /api/search/text?text=humus
+        /api/search/text?text=soil+fungi
     
     Args:
-        text (str): A string to look within dataset, worksheet and field 
-        descriptions and titles and in dataset keywords.
+        text (str): Words to look for within dataset, worksheet and field 
+        descriptions and titles and in dataset keywords. Words are matched 
+        to their stems, so 'ants' also matches 'ant', and all of the words 
+        must be found in a dataset. Results are ordered by relevance.
     """
     
     db = current.db
     
-    qry = ((db.published_datasets.id == db.dataset_fields.dataset_id) & 
-           (db.published_datasets.id == db.dataset_worksheets.dataset_id) & 
-           (db.published_datasets.id == db.dataset_keywords.dataset_id) & 
-           ((db.dataset_fields.field_name.contains(text)) | 
-            (db.dataset_fields.description.contains(text)) |
-            (db.dataset_worksheets.title.contains(text)) | 
-            (db.dataset_worksheets.description.contains(text)) | 
-            (db.published_datasets.dataset_title.contains(text)) |
-            (db.published_datasets.dataset_description.contains(text)) |
-            (db.dataset_keywords.keyword.contains(text))
-            ))
+    if text is None:
+        return {'error': 400, 'message': 'No search text provided'}
+    
+    tsquery = "plainto_tsquery('english', {})".format(db._adapter.represent(text, 'string'))
+    
+    qry = ((db.published_datasets.id == db.dataset_search.dataset_id) &
+           Query(db, 'dataset_search.search_vector @@ {}'.format(tsquery)))
+    
+    rank = 'ts_rank(dataset_search.search_vector, {}) DESC'.format(tsquery)
+    
+    return qry, rank
+
 
+def dataset_compound_search(search_funcs, op='and', **params):
+    
+    """Search for datasets using several searches at once
+    
+    Examples:
+        /api/search/compound?taxa.name=Formicidae&dates.date=2014-06-12
+        /api/search/compound?taxa.gbif_id=4342&bbox.wkt=POINT(117 5)&bbox.distance=1000
+        /api/search/compound?authors.name=Wilk&text.text=humus&op=or
+    
+    Args:
+        op (str): One of 'and' or 'or', to find datasets that match all of 
+            the searches or any of the searches.
+        Other parameters are given as search.parameter, using the names and 
+        parameters of the other search endpoints.
+    """
+    
+    db = current.db
+    
+    if op not in ['and', 'or']:
+        return {'error': 400, 'message': 'Unknown compound search op: {}'.format(op)}
+    
+    # Group the parameters by search kind
+    searches = {}
+    for key, value in params.items():
+        kind, _, arg = key.partition('.')
+        if kind not in search_funcs or kind == 'compound' or not arg:
+            return {'error': 400, 'message': 'Unknown compound search parameter: {}'.format(key)}
+        searches.setdefault(kind, {})[arg] = value
+    
+    if not searches:
+        return {'error': 400, 'message': 'No searches provided'}
+    
+    # Build each search as a subquery of matching dataset ids and combine them
+    qry = None
+    
+    for kind, args in searches.items():
+        
+        try:
+            sub_qry = search_funcs[kind](**args)
+        except TypeError as e:
+            return {'error': 400, 'message': 'Could not parse {} search: {}'.format(kind, e)}
+        
+        # Return errors and ignore ranking from text searches
+        if isinstance(sub_qry, dict):
+            return sub_qry
+        elif isinstance(sub_qry, tuple):
+            sub_qry = sub_qry[0]
+        
+        sub_qry = db.published_datasets.id.belongs(db(sub_qry)._select(db.published_datasets.id))
+        
+        if qry is None:
+            qry = sub_qry
+        elif op == 'and':
+            qry &= sub_qry
+        else:
+            qry |= sub_qry
+    
     return qry
 
 
@@ -1562,7 +2833,9 @@ def dataset_parse_spatial(wkt=None, location=None):
     
     """
     Shared function to parse query geometry options - either a location or a WKT - and get 
-    # the query geometry as a UTM 50N geometry.
+    the query geometry as a UTM 50N geometry. Locations are taken from the in memory 
+    gazetteer. A WKT geometry is parsed, checked for lat/long coordinates and transformed to 
+    UTM 50N in a single statement. The geometry is returned as hex EWKB.
     """
     db = current.db
     
@@ -1571,34 +2844,60 @@ def dataset_parse_spatial(wkt=None, location=None):
     elif location is None and wkt is  None:
         return {'error': 400, 'message': 'Provide either a location name or a WKT geometry'}
     elif location is not None:
-        gazetteer_location = gazetteer_location = db(db.gazetteer.location == location).select(
-                                                     db.gazetteer.wkt_utm50n.st_aswkb().with_alias('wkb')).first()
-        if gazetteer_location is not None:
-            query_geom = gazetteer_location.wkb
+        gazetteer = get_gazetteer()
+        location = gazetteer.resolve(location)
+        if location is not None and gazetteer.wkb_utm50n[location] is not None:
+            query_geom = gazetteer.wkb_utm50n[location]
         else:
             return {'error': 400, 'message': "Unknown location"}
     elif wkt is not None:
-        # Validate the geometry - there isn't currently a validator, so use the DB (?shapely)
-        # i) Does the WKT parse correctly to a WKB string, assuming WGS84 for now
+        # Validate the geometry using the DB, assuming WGS84 coordinates: does the WKT 
+        # parse, do the coordinates seem like lat long and, if so, convert to UTM50N.
         try:
-            query_geom = db.executesql("select st_geomfromtext('{}', 4326);".format(wkt))[0][0]
+            query_geom, is_lat_long = db.executesql(
+                "SELECT CASE WHEN is_lat_long THEN encode(ST_AsEWKB(ST_Transform(g, 32650)), 'hex') "
+                "       END, is_lat_long "
+                "   FROM (SELECT g, ST_XMin(g) >= -180 AND ST_XMax(g) <= 180 AND "
+                "                   ST_YMin(g) >= -90 AND ST_YMax(g) <= 90 AS is_lat_long "
+                "         FROM (SELECT ST_GeomFromText(%s, 4326) AS g) AS parsed) AS checked;",
+                placeholders=[wkt])[0]
         except (db._adapter.driver.ProgrammingError, db._adapter.driver.InternalError):
+            # The failed statement aborts the transaction
+            db.rollback()
             return {'error': 400, 'message': "Could not parse WKT geometry"}
 
-        # ii) Do the coordinates seem like lat long?
-        is_lat_long = db.executesql("SELECT ST_XMin(g) >= -180 AND ST_XMax(g) <= 180 AND "
-                                    "   ST_YMin(g) >= -90 AND ST_YMax(g) <= 90 "
-                                    "   FROM (SELECT st_geomfromwkb(decode('{0}', 'hex')) "
-                                              "AS g) AS sel ;".format(query_geom))[0][0]
         if not is_lat_long:
             return {'error': 400, 'message': "WKT geometry coordinates not as lat/long"}
 
-        # iii) Convert to UTM50N
-        query_geom = db.executesql("SELECT st_transform(st_geomfromwkb(decode('{0}', 'hex')), 32650);".format(query_geom))[0][0]
-
     return query_geom
 
 
+def spatial_predicate(column, query_geom, predicate='intersects', distance=None):
+    """
+    Builds a Query testing a geometry column against a query geometry from 
+    dataset_parse_spatial. The PostGIS functions used here include a bounding box 
+    (&&) test, so they can use a GiST index on the column, unlike testing the 
+    result of ST_Distance.
+    
+    Args:
+        column: A geometry Field
+        query_geom: A hex EWKB geometry from dataset_parse_spatial
+        predicate: One of 'intersects', 'contains', 'within' or 'dwithin'
+        distance: The distance in metres for the 'dwithin' predicate
+    """
+    
+    query_geom = "'{}'::geometry".format(query_geom)
+    
+    if predicate == 'dwithin':
+        sql = 'ST_DWithin({}, {}, {})'.format(column.sqlsafe, query_geom, float(distance))
+    else:
+        func = {'intersects': 'ST_Intersects', 'contains': 'ST_Contains', 
+                'within': 'ST_Within'}[predicate]
+        sql = '{}({}, {})'.format(func, column.sqlsafe, query_geom)
+    
+    return Query(column._db, sql)
+
+
 def dataset_spatial_search(wkt=None, location=None, distance=0):
     
     """Spatial search for sampling locations.
@@ -1633,11 +2932,24 @@ def dataset_spatial_search(wkt=None, location=None, distance=0):
     query_geom = dataset_parse_spatial(wkt, location)
     if isinstance(query_geom, dict):
         return query_geom
-
-    qry = ((db.published_datasets.id == db.dataset_locations.dataset_id) &
-           (db.dataset_locations.name == db.gazetteer.location) &
-           ((db.gazetteer.wkt_utm50n.st_distance(query_geom) <= distance) |
-            (db.dataset_locations.wkt_utm50n.st_distance(query_geom) <= distance)))
+    
+    try:
+        distance = float(distance)
+    except (TypeError, ValueError):
+        return {'error': 400, 'message': "Could not parse distance: {}".format(distance)}
+    
+    # Match sampling locations with their own geometry within the distance or which
+    # use a gazetteer location within the distance. The gazetteer locations are
+    # found first from the in memory gazetteer, rather than joining every dataset 
+    # location to the gazetteer and testing both geometries.
+    near_gazetteer = get_gazetteer().query(shapely.from_wkb(query_geom), 'dwithin', distance)
+    
+    near = spatial_predicate(db.dataset_locations.wkt_utm50n, query_geom, 'dwithin', distance)
+    
+    if near_gazetteer:
+        near |= db.dataset_locations.name.belongs(near_gazetteer)
+    
+    qry = (db.published_datasets.id == db.dataset_locations.dataset_id) & near
         
     return qry
 
@@ -1662,10 +2974,12 @@ def dataset_spatial_bbox_search(wkt=None, location=None, match_type='intersect',
         wkt (str): A well-known text geometry. This is assumed to use latitude and longitude
             coordinates in WGS84 (EPSG:4326).
         location (str): A location name used to select a query geometry from the SAFE gazetteer.
-        match_type (str): One of 'intersect', 'contain' and 'within' to match the provided geometry
-            to the geographic extents of datasets. The 'contain' option returns datasets that 
-            completely cover the query geometry and 'within' returns datasets that fall entirely
-            within the query geometry.
+        match_type (str): One of 'intersect', 'contain', 'within' and 'distance' to match the 
+            provided geometry to the geographic extents of datasets. The 'contain' option returns 
+            datasets that completely cover the query geometry, 'within' returns datasets that fall 
+            entirely within the query geometry and 'distance' returns datasets within a distance
+            of the query geometry.
+        distance (float): The search distance in metres for the 'distance' match type.
         
     """
 
@@ -1681,31 +2995,93 @@ def dataset_spatial_bbox_search(wkt=None, location=None, match_type='intersect',
         return {'error': 400, 'message': "Unknown spatial match type: {}".format(match_type)} 
 
     # Query the geographic extents with the appropriate predicate
-    if match_type == 'intersect':
-        qry = (db.published_datasets.geographic_extent_utm50n.st_intersects(query_geom))
-    elif match_type == 'contain':
-        qry = (db.published_datasets.geographic_extent_utm50n.st_contains(query_geom))
-    elif match_type == 'within':
-        qry = (db.published_datasets.geographic_extent_utm50n.st_within(query_geom))
-    elif match_type == 'distance':
-        qry = (db.published_datasets.geographic_extent_utm50n.st_distance(query_geom) <= distance)
+    extent = db.published_datasets.geographic_extent_utm50n
+    
+    if match_type == 'distance':
+        try:
+            distance = float(distance)
+        except (TypeError, ValueError):
+            return {'error': 400, 'message': "Could not parse distance: {}".format(distance)}
+        
+        qry = spatial_predicate(extent, query_geom, 'dwithin', distance)
+    else:
+        predicate = {'intersect': 'intersects', 'contain': 'contains', 'within': 'within'}
+        qry = spatial_predicate(extent, query_geom, predicate[match_type])
         
     return qry
 
 
-def get_index():
+def get_records(ids=None, most_recent=False, chunk_size=200):
+    """
+    A generator of the metadata for published records, as provided by the 
+    /api/record endpoint, including the taxa and locations for each record. The 
+    records are loaded in chunks, using three queries per chunk to get the records,
+    taxa and locations, so that a full catalogue is not held in memory at once.
     
+    Args:
+        ids: An optional list of Zenodo record ids, otherwise all records are used.
+        most_recent: Only return the most recent versions of datasets.
+        chunk_size: The number of records loaded at once.
+    Yields:
+        A dictionary of record metadata.
     """
-    Function to generate a JSON string containing the formatted contents of the dataset files
-    table. This is used as the core index of the safedata package, so is cached in a file 
-    like format along with MD5 hashes of the index and other files to speed up checking for
-    updates and refreshing the index.
+    
+    db = current.db
+    pd = db.published_datasets
+    loc_fields = [db.dataset_locations.dataset_id, db.dataset_locations.name,
+                  db.dataset_locations.new_location, db.dataset_locations.wkt_wgs84]
+    
+    base_qry = (pd.most_recent == True) if most_recent else (pd.id > 0)
+    last_id = 0
+    
+    while True:
+        
+        # Use the primary key to page through the records
+        qry = base_qry & (pd.id > last_id)
+        if ids is not None:
+            qry &= pd.zenodo_record_id.belongs(ids)
+        
+        records = db(qry).select(pd.id, pd.dataset_metadata, pd.publication_date,
+                                 pd.zenodo_concept_id, pd.zenodo_record_id,
+                                 orderby=pd.id, limitby=(0, chunk_size))
+        
+        if not records:
+            return
+        
+        last_id = records.last().id
+        record_ids = [rec.id for rec in records]
+        
+        taxa = db(db.dataset_taxa.dataset_id.belongs(record_ids)
+                  ).select(orderby=db.dataset_taxa.id).as_list()
+        locations = db(db.dataset_locations.dataset_id.belongs(record_ids)
+                       ).select(*loc_fields, orderby=db.dataset_locations.id).as_list()
+        
+        taxa = {k: list(g) for k, g in groupby(sorted(taxa, key=lambda x: x['dataset_id']),
+                                               key=lambda x: x['dataset_id'])}
+        locations = {k: list(g) for k, g in groupby(sorted(locations, key=lambda x: x['dataset_id']),
+                                                    key=lambda x: x['dataset_id'])}
+        
+        for rec in records:
+            val = rec.dataset_metadata
+            val['publication_date'] = rec.publication_date
+            val['zenodo_concept_id'] = rec.zenodo_concept_id
+            val['zenodo_record_id'] = rec.zenodo_record_id
+            val['taxa'] = taxa.get(rec.id, [])
+            val['locations'] = [{k: v for k, v in loc.items() if k != 'dataset_id'}
+                                for loc in locations.get(rec.id, [])]
+            yield val
+
+
+def get_index_entries(ids=None):
     """
-
+    Gets the dataset index entries - one per published file - optionally
+    only for a set of Zenodo record ids.
+    """
+    
     # version of the data contained in the dataset description
     db = current.db
     qry = (db.published_datasets.id == db.dataset_files.dataset_id)
-    val = dataset_query_to_json(qry, 
+    val = dataset_query_to_json(qry, ids=ids,
                                 fields = [('published_datasets', 'publication_date'), 
                                           ('published_datasets', 'zenodo_concept_id'), 
                                           ('published_datasets', 'zenodo_record_id'), 
@@ -1722,23 +3098,149 @@ def get_index():
     [r['published_datasets'].update(r.pop('dataset_files')) for r in entries]
     val['entries'] = [r['published_datasets'] for r in entries]
     
-    # Find the hashes
-    index_hash = hashlib.md5(json(val).encode('utf-8')).hexdigest()
+    return val
+
+
+def get_index_changes(since_hash=None, since_generation=None):
+    """
+    Gets the changes to the dataset index since a client last synchronised, 
+    identified either by the index hash held by the client or by the catalogue
+    generation returned by the last synchronisation. Changes are logged as part 
+    of the transaction that publishes or changes a record and are assigned to a
+    generation when that transaction bumps the catalogue generation, so the 
+    generation is used as the cursor rather than the time of the change, which 
+    is set before the change is committed.
+    
+    Args:
+        since_hash: An index hash from /api/index_hashes
+        since_generation: A catalogue generation from a previous synchronisation
+    Returns:
+        A dictionary giving the current index hash and catalogue generation, 
+        which can be used for the next synchronisation, the Zenodo record ids of
+        all records that have changed and the current index entries for those 
+        records, which replace any entries held by the client for those records.
+        If the index hash is not known, an error dictionary is returned and the
+        client should download the full index.
+    """
+    
+    db = current.db
+    chg = db.catalogue_changes
+    
+    if (since_hash is None) == (since_generation is None):
+        return {'error': 400, 'message': 'Provide one of since_hash or since_generation'}
+    
+    if since_hash is not None:
+        hsh = db(db.catalogue_index_hashes.index_hash == since_hash
+                 ).select(db.catalogue_index_hashes.generation.max()).first()
+        generation = hsh[db.catalogue_index_hashes.generation.max()]
+        
+        if generation is None:
+            return {'error': 404, 'message': 'Unknown index hash, download the full index'}
+    else:
+        try:
+            generation = int(since_generation)
+        except ValueError:
+            return {'error': 400, 'message': 'Could not parse since_generation: {}'.format(
+                                                 since_generation)}
+    
+    # Read the current generation before finding the changes, so that the cursor
+    # returned to the client never includes changes that were not returned. 
+    current_generation = get_catalogue_generation()
+    
+    changed = db(chg.generation > generation).select(chg.zenodo_record_id, distinct=True)
+    changed = sorted(r.zenodo_record_id for r in changed)
+    
+    val = get_index_entries(ids=changed) if changed else {'count': 0, 'entries': []}
+    val['changed_records'] = changed
+    val['index_hash'] = shared_cache('index', get_index)['hashes']['index']
+    val['generation'] = current_generation
+    
+    return val
+
+
+def get_taxon_summary(offset=0, limit=None):
+    
+    """
+    Function to get the serialised contents of the taxon summary table, giving
+    the GBIF ids, names and status of taxa across all published datasets along 
+    with the number of datasets that use each taxon. The taxa are in the order
+    that they were first published, so that pages of taxa are stable as new 
+    taxa are added. This is cached with the MD5 hash of the body as an ETag.
+    
+    Args:
+        offset: The number of taxa to skip
+        limit: The maximum number of taxa to return, or None for all taxa.
+    """
+    
+    db = current.db
+    total = db(db.taxon_summary).count()
+    
+    # Clamp the page to the table, so that an offset past the end of the table 
+    # gives an empty page rather than a negative limit
+    end = total if limit is None else min(offset + limit, total)
+    
+    if offset >= end:
+        val = []
+    else:
+        val = db(db.taxon_summary).select(db.taxon_summary.gbif_id, db.taxon_summary.taxon_rank,
+                                          db.taxon_summary.taxon_name, 
+                                          db.taxon_summary.gbif_status,
+                                          db.taxon_summary.gbif_parent_id, 
+                                          db.taxon_summary.n_datasets,
+                                          orderby=db.taxon_summary.id, 
+                                          limitby=(offset, end)).as_list()
+    
+    body = json(val).encode('utf-8')
+    
+    return dict(body=body,
+                hash=hashlib.md5(body).hexdigest(),
+                total=total,
+                last_modified=get_catalogue_last_modified())
+
+
+def serialise_index():
+    """
+    Gets the dataset index entries and serialises them. The MD5 hash of the
+    serialised index is the index hash used by clients to check for updates.
+    
+    Returns:
+        A tuple of the index dictionary and the serialised index as bytes.
+    """
+    
+    val = get_index_entries()
+    
+    return val, json(val).encode('utf-8')
+
+
+def get_index():
+    
+    """
+    Function to generate a JSON string containing the formatted contents of the dataset files
+    table. This is used as the core index of the safedata package, so is cached in a file 
+    like format along with MD5 hashes of the index and other files to speed up checking for
+    updates and refreshing the index. The serialised index is also stored, along with gzip
+    and (if available) brotli compressed copies and the last modification time of the 
+    catalogue, so that the API can serve the index directly and handle conditional requests.
+    """
+
+    # Serialise the index and find the hashes
+    val, body = serialise_index()
+    index_hash = hashlib.md5(body).hexdigest()
     
     # Use the file hash of the static gazetteer geojson
-    gazetteer_file = os.path.join(current.request.folder, 'static', 'files', 'gis', 'gazetteer.geojson')
-    with open(gazetteer_file) as f:
-        gazetteer_hash = hashlib.md5(f.read().encode('utf-8')).hexdigest()
+    gazetteer_hash = get_gazetteer_version()
 
     # Use the file hash of the static locations alias csv
-    location_aliases_file = os.path.join(current.request.folder, 'static', 'files', 'gis', 'location_aliases.csv')
-    with open(location_aliases_file) as f:
-        location_aliases_hash = hashlib.md5(f.read().encode('utf-8')).hexdigest()
+    location_aliases_hash = get_location_aliases_version()
         
     return dict(hashes=dict(index=index_hash, 
                             gazetteer=gazetteer_hash,
                             location_aliases=location_aliases_hash),
-                index=val)
+                index=val,
+                body=body,
+                gzip=gzip.compress(body, 9),
+                brotli=None if brotli is None else brotli.compress(body),
+                last_modified=get_catalogue_last_modified())
 
     
     
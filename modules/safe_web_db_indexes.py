@@ -0,0 +1,247 @@
+"""
+This module manages the secondary indexes on the dataset index tables used by
+the dataset API. The DAL does not create indexes other than primary keys, so the
+indexes are checked from an admin page and created by a scheduler task queued 
+from that page. The module also explains the queries used by the API endpoints,
+to show which indexes are being used.
+"""
+
+import simplejson
+from gluon import current
+
+from safe_web_datasets import (dataset_taxon_search, dataset_author_search, dataset_date_search,
+                               dataset_text_search, dataset_field_search, dataset_locations_search,
+                               dataset_spatial_search, dataset_spatial_bbox_search)
+
+
+# The indexes used by the API, as tuples of index name, table name, index method
+# and the indexed column or expression. The trigram indexes (gin_trgm_ops) support
+# the ILIKE '%text%' queries used by the contains() searches and need the pg_trgm
+# extension. Geometry columns use GiST indexes for the spatial searches.
+
+DATASET_INDEXES = [
+    # published datasets - record lookup, versions and temporal and spatial extents
+    ('published_datasets_record_id_idx', 'published_datasets', 'btree', 'zenodo_record_id'),
+    ('published_datasets_concept_id_idx', 'published_datasets', 'btree', 'zenodo_concept_id'),
+    ('published_datasets_most_recent_idx', 'published_datasets', 'btree', 'most_recent'),
+    ('published_datasets_temporal_idx', 'published_datasets', 'btree',
+     'temporal_extent_start, temporal_extent_end'),
+    ('published_datasets_extent_gist', 'published_datasets', 'gist', 'geographic_extent'),
+    ('published_datasets_extent_utm50n_gist', 'published_datasets', 'gist',
+     'geographic_extent_utm50n'),
+    # taxa
+    ('dataset_taxa_dataset_id_idx', 'dataset_taxa', 'btree', 'dataset_id'),
+    ('dataset_taxa_gbif_id_idx', 'dataset_taxa', 'btree', 'gbif_id'),
+    ('dataset_taxa_taxon_name_idx', 'dataset_taxa', 'btree', 'taxon_name'),
+    ('dataset_taxa_taxon_rank_idx', 'dataset_taxa', 'btree', 'taxon_rank'),
+    ('taxon_closure_ancestor_idx', 'taxon_closure', 'btree', 'ancestor_id, descendant_id'),
+    ('taxon_closure_descendant_idx', 'taxon_closure', 'btree', 'descendant_id'),
+    ('taxon_summary_taxon_name_idx', 'taxon_summary', 'btree', 'taxon_name'),
+    # locations
+    ('dataset_locations_dataset_id_idx', 'dataset_locations', 'btree', 'dataset_id'),
+    ('dataset_locations_name_idx', 'dataset_locations', 'btree', 'name'),
+    ('dataset_locations_name_trgm', 'dataset_locations', 'gin', 'name gin_trgm_ops'),
+    ('dataset_locations_wgs84_gist', 'dataset_locations', 'gist', 'wkt_wgs84'),
+    ('dataset_locations_utm50n_gist', 'dataset_locations', 'gist', 'wkt_utm50n'),
+    # worksheets and fields
+    ('dataset_worksheets_dataset_id_idx', 'dataset_worksheets', 'btree', 'dataset_id'),
+    ('dataset_fields_dataset_id_idx', 'dataset_fields', 'btree', 'dataset_id'),
+    ('dataset_fields_worksheet_id_idx', 'dataset_fields', 'btree', 'worksheet_id'),
+    ('dataset_fields_field_name_trgm', 'dataset_fields', 'gin', 'field_name gin_trgm_ops'),
+    ('dataset_fields_description_trgm', 'dataset_fields', 'gin', 'description gin_trgm_ops'),
+    # authors, keywords, funders, permits and files
+    ('dataset_authors_dataset_id_idx', 'dataset_authors', 'btree', 'dataset_id'),
+    ('dataset_authors_name_trgm', 'dataset_authors', 'gin', 'name gin_trgm_ops'),
+    ('dataset_keywords_dataset_id_idx', 'dataset_keywords', 'btree', 'dataset_id'),
+    ('dataset_keywords_keyword_trgm', 'dataset_keywords', 'gin', 'keyword gin_trgm_ops'),
+    ('dataset_funders_dataset_id_idx', 'dataset_funders', 'btree', 'dataset_id'),
+    ('dataset_permits_dataset_id_idx', 'dataset_permits', 'btree', 'dataset_id'),
+    ('dataset_files_dataset_id_idx', 'dataset_files', 'btree', 'dataset_id'),
+    # full text search documents
+    ('dataset_search_dataset_id_idx', 'dataset_search', 'btree', 'dataset_id'),
+    ('dataset_search_vector_gin', 'dataset_search', 'gin', 'search_vector'),
+    # gazetteer locations, used by spatial searches by location name
+    ('gazetteer_location_idx', 'gazetteer', 'btree', 'location'),
+    ('gazetteer_utm50n_gist', 'gazetteer', 'gist', 'wkt_utm50n')]
+
+
+def create_indexes():
+    """
+    Creates any of the dataset API indexes that do not already exist, along with
+    the pg_trgm extension needed for the trigram indexes. The indexes are built
+    concurrently, so that the tables are not locked against writes while a large
+    index is built. Existing indexes are left unchanged, but invalid indexes, 
+    left by a failed concurrent build, are dropped and rebuilt.
+
+    Concurrent builds cannot run inside a transaction, so this commits any open
+    transaction and uses autocommit while the indexes are built. Building large
+    indexes takes a long time, so this is run as the create_indexes scheduler task.
+
+    Returns:
+        A list of the names of the indexes that were created.
+    """
+
+    db = current.db
+    db.executesql('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+
+    existing = {idx['name']: idx for idx in check_indexes()}
+    created = []
+
+    db.commit()
+    connection = db._adapter.connection
+    connection.autocommit = True
+
+    try:
+        for name, table, method, columns in DATASET_INDEXES:
+
+            if existing[name]['exists'] and existing[name]['valid']:
+                continue
+            elif existing[name]['exists']:
+                db.executesql('DROP INDEX CONCURRENTLY {};'.format(name))
+
+            db.executesql('CREATE INDEX CONCURRENTLY {} ON {} USING {} ({});'.format(
+                              name, table, method, columns))
+            created.append(name)
+
+        # Update the planner statistics for the indexed tables
+        for table in sorted(set(idx[1] for idx in DATASET_INDEXES)):
+            db.executesql('ANALYZE {};'.format(table))
+    finally:
+        connection.autocommit = False
+
+    return created
+
+
+def check_indexes():
+    """
+    Checks the state of the dataset API indexes in the database.
+
+    Returns:
+        A list of dictionaries, one for each index in DATASET_INDEXES, giving the
+        index name, table, method and columns, whether the index exists and is
+        valid, the index size in bytes and the number of index scans recorded by
+        the PostgreSQL statistics collector.
+    """
+
+    db = current.db
+    names = [idx[0] for idx in DATASET_INDEXES]
+
+    rows = db.executesql("""
+        SELECT c.relname, i.indisvalid, pg_relation_size(c.oid), coalesce(s.idx_scan, 0)
+        FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = c.oid
+        WHERE c.relname IN ({});""".format(', '.join(["'{}'".format(nm) for nm in names])))
+
+    found = {r[0]: r[1:] for r in rows}
+    status = []
+
+    for name, table, method, columns in DATASET_INDEXES:
+
+        valid, size, scans = found.get(name, (False, None, None))
+        status.append(dict(name=name, table=table, method=method, columns=columns,
+                           exists=name in found, valid=valid, size=size, scans=scans))
+
+    return status
+
+
+def api_queries():
+    """
+    Builds the SQL for a set of example API requests, using the same query building
+    functions as the API endpoints.
+
+    Returns:
+        A list of tuples of the API request and the SQL used.
+    """
+
+    db = current.db
+    pd = db.published_datasets
+    fields = [pd.zenodo_concept_id, pd.zenodo_record_id, pd.dataset_title]
+
+    # Use a published record, if there is one, for the record endpoint
+    record = db(pd).select(pd.id, pd.zenodo_record_id, limitby=(0, 1)).first()
+    record_id, zenodo_id = (record.id, record.zenodo_record_id) if record else (0, 0)
+
+    queries = [('/api/record/{}'.format(zenodo_id),
+                db(pd.zenodo_record_id == zenodo_id)._select()),
+               ('/api/record/{} (taxa)'.format(zenodo_id),
+                db(db.dataset_taxa.dataset_id == record_id)._select()),
+               ('/api/record/{} (locations)'.format(zenodo_id),
+                db(db.dataset_locations.dataset_id == record_id)._select()),
+               ('/api/files?most_recent',
+                db((pd.id == db.dataset_files.dataset_id) & (pd.most_recent == True)
+                   )._select(*fields + [db.dataset_files.filename], distinct=True))]
+
+    searches = [('/api/search/taxa?gbif_id=4342', dataset_taxon_search, {'gbif_id': 4342}),
+                ('/api/search/taxa?name=Formicidae', dataset_taxon_search, {'name': 'Formicidae'}),
+                ('/api/search/taxa?name=Formicidae&descendants=true', dataset_taxon_search,
+                 {'name': 'Formicidae', 'descendants': 'true'}),
+                ('/api/search/authors?name=Wilk', dataset_author_search, {'name': 'Wilk'}),
+                ('/api/search/dates?date=2014-06-12', dataset_date_search, {'date': '2014-06-12'}),
+                ('/api/search/text?text=humus', dataset_text_search, {'text': 'humus'}),
+                ('/api/search/fields?text=temperature', dataset_field_search,
+                 {'text': 'temperature'}),
+                ('/api/search/locations?name=A_1', dataset_locations_search, {'name': 'A_1'}),
+                ('/api/search/spatial?wkt=POINT(117 5)&distance=1000', dataset_spatial_search,
+                 {'wkt': 'POINT(117 5)', 'distance': 1000}),
+                ('/api/search/bbox?wkt=POINT(117 5)', dataset_spatial_bbox_search,
+                 {'wkt': 'POINT(117 5)'}),
+                ('/api/search/bbox?wkt=POINT(117 5)&match_type=distance&distance=1000',
+                 dataset_spatial_bbox_search,
+                 {'wkt': 'POINT(117 5)', 'match_type': 'distance', 'distance': 1000})]
+
+    for request, func, kwargs in searches:
+
+        qry = func(**kwargs)
+
+        if isinstance(qry, tuple):
+            sql = db(qry[0])._select(*fields, orderby=qry[1])
+        elif isinstance(qry, dict):
+            continue
+        else:
+            sql = db(qry)._select(*fields, distinct=True)
+
+        queries.append((request, sql))
+
+    return queries
+
+
+def explain_api_queries():
+    """
+    Gets the query plans for the example API requests, to report which indexes
+    each request uses and which tables are still read by sequential scans. Note
+    that the planner will prefer sequential scans of small tables even when an
+    index is available.
+
+    Returns:
+        A list of dictionaries giving the request, the estimated total cost, and
+        the indexes used and tables scanned sequentially by the query plan.
+    """
+
+    db = current.db
+    report = []
+
+    def _walk(node, indexes, scans):
+        if 'Index Name' in node:
+            indexes.add(node['Index Name'])
+        if node['Node Type'] == 'Seq Scan':
+            scans.add(node['Relation Name'])
+        for child in node.get('Plans', []):
+            _walk(child, indexes, scans)
+
+    for request, sql in api_queries():
+
+        plan = db.executesql('EXPLAIN (FORMAT JSON) ' + sql)[0][0]
+
+        # psycopg2 decodes the JSON plan, but other drivers may not
+        if isinstance(plan, str):
+            plan = simplejson.loads(plan)
+
+        plan = plan[0]['Plan']
+        indexes, scans = set(), set()
+        _walk(plan, indexes, scans)
+
+        report.append(dict(request=request, cost=plan['Total Cost'],
+                           indexes=sorted(indexes), seq_scans=sorted(scans)))
+
+    return report
@@ -0,0 +1,266 @@
+"""
+This module holds a read-only copy of the gazetteer in the memory of each web
+server process, so that location lookups, spatial searches against gazetteer
+locations, the validator locations and the gazetteer map do not need to query
+the database. The gazetteer only changes when the update_gazetteer controller
+reloads it, which writes a version stamp file. Each process checks that stamp
+and reloads its copy when the stamp changes.
+"""
+
+import os
+import hashlib
+import threading
+import simplejson
+import shapely
+from shapely import STRtree
+from shapely.geometry import mapping
+from gluon import current
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+# The gazetteer fields held for each location, other than the geometries
+GAZETTEER_FIELDS = ['location', 'type', 'parent', 'display_order', 'region', 'plot_size',
+                    'fractal_order', 'transect_order', 'centroid_x', 'centroid_y',
+                    'bbox_xmin', 'bbox_xmax', 'bbox_ymin', 'bbox_ymax']
+
+
+class Gazetteer(object):
+    """
+    An in memory gazetteer, holding the gazetteer fields for each location, the
+    location geometries in WGS84 and UTM50N as shapely geometries, the UTM50N
+    geometries as hex EWKB for use in SQL, the location aliases and a spatial
+    index of the geometries in each projection. Instances are not modified after
+    they are created, so can be shared between threads.
+
+    Args:
+        version: The gazetteer version stamp
+        rows: A list of dictionaries of gazetteer fields, with the geometries
+            as hex EWKB in 'wkb_wgs84' and 'wkb_utm50n'.
+        aliases: A list of (alias, location) tuples.
+    """
+
+    def __init__(self, version, rows, aliases):
+
+        self.version = version
+        self.locations = {}
+        self.names = []
+        self.wkb_utm50n = {}
+
+        wgs84 = []
+        utm50n = []
+
+        for row in rows:
+            name = row['location']
+            self.names.append(name)
+            self.locations[name] = {fld: row[fld] for fld in GAZETTEER_FIELDS}
+            self.wkb_utm50n[name] = row['wkb_utm50n']
+            wgs84.append(row['wkb_wgs84'])
+            utm50n.append(row['wkb_utm50n'])
+
+        # from_wkb returns None for missing geometries, which the trees ignore
+        self.wgs84 = shapely.from_wkb(wgs84)
+        self.utm50n = shapely.from_wkb(utm50n)
+        self.wgs84_tree = STRtree(self.wgs84)
+        self.utm50n_tree = STRtree(self.utm50n)
+
+        # Aliases are unique, so are used as keys to locations
+        self.aliases = dict(aliases)
+
+    def resolve(self, name):
+        """
+        Returns the gazetteer location name for a location name or alias, or None
+        if the name is not known.
+        """
+
+        if name in self.locations:
+            return name
+
+        return self.aliases.get(name)
+
+    def get(self, name):
+        """
+        Returns a dictionary of the gazetteer fields for a location name or alias,
+        or None if the name is not known.
+        """
+
+        name = self.resolve(name)
+
+        return None if name is None else self.locations[name]
+
+    def query(self, geom, predicate='intersects', distance=None, utm50n=True):
+        """
+        Finds the gazetteer locations that match a query geometry, using the
+        spatial index. The predicate is applied as predicate(geom, location), so
+        'within' finds locations that contain the query geometry.
+
+        Args:
+            geom: A shapely geometry
+            predicate: A shapely binary predicate name or 'dwithin'
+            distance: The distance for the 'dwithin' predicate
+            utm50n: Should the query use the UTM50N (True) or WGS84 geometries.
+        Returns:
+            A list of location names, in gazetteer display order.
+        """
+
+        tree = self.utm50n_tree if utm50n else self.wgs84_tree
+        idx = tree.query(geom, predicate=predicate, distance=distance)
+
+        return [self.names[i] for i in sorted(idx)]
+
+    def locations_at(self, x, y):
+        """
+        Finds the gazetteer locations containing a WGS84 longitude and latitude.
+        """
+
+        return self.query(shapely.Point(x, y), predicate='intersects', utm50n=False)
+
+    def search(self, keywords, fields):
+        """
+        Finds the gazetteer locations matching a keyword search, in the same way
+        as a grid keyword search: every keyword must appear in one of the fields,
+        ignoring case.
+
+        Args:
+            keywords: A string of space separated keywords
+            fields: A list of the names of the gazetteer fields to search
+        Returns:
+            A list of location names, in gazetteer display order.
+        """
+
+        keywords = keywords.lower().split()
+        found = []
+
+        for name in self.names:
+            values = [str(self.locations[name][fld]).lower() for fld in fields
+                      if self.locations[name][fld] is not None]
+            if all(any(kw in val for val in values) for kw in keywords):
+                found.append(name)
+
+        return found
+
+    def validator_locations(self):
+        """
+        Returns the locations payload used by safedata_validator, which maps
+        location names to bounding box tuples and aliases to location names.
+        """
+
+        locations = {nm: (loc['bbox_xmin'], loc['bbox_xmax'], loc['bbox_ymin'], loc['bbox_ymax'])
+                     for nm, loc in self.locations.items()}
+
+        return {'locations': locations, 'aliases': self.aliases}
+
+    def features(self, names=None):
+        """
+        Returns GeoJSON features for the WGS84 geometries of all locations or of
+        a list of location names, in gazetteer display order.
+        """
+
+        if names is None:
+            idx = range(len(self.names))
+        else:
+            names = set(names)
+            idx = [i for i, nm in enumerate(self.names) if nm in names]
+
+        return [{'type': 'Feature', 'properties': self.locations[self.names[i]],
+                 'geometry': mapping(self.wgs84[i])}
+                for i in idx if self.wgs84[i] is not None]
+
+
+def load_gazetteer(version):
+    """
+    Loads a Gazetteer instance from the gazetteer and gazetteer_alias tables.
+    """
+
+    db = current.db
+
+    rows = db.executesql("SELECT {}, encode(ST_AsEWKB(wkt_wgs84), 'hex') AS wkb_wgs84, "
+                         "       encode(ST_AsEWKB(wkt_utm50n), 'hex') AS wkb_utm50n "
+                         "FROM gazetteer ORDER BY display_order, id;".format(
+                             ', '.join(GAZETTEER_FIELDS)),
+                         as_dict=True)
+
+    aliases = db(db.gazetteer_alias).select(db.gazetteer_alias.alias, db.gazetteer_alias.location,
+                                            orderby=db.gazetteer_alias.id)
+
+    return Gazetteer(version, rows, [(r.alias, r.location) for r in aliases])
+
+
+def _stamp_path():
+
+    return os.path.join(current.request.folder, 'cache', 'gazetteer_version')
+
+
+def get_gazetteer_stamp():
+    """
+    Reads the gazetteer version stamp written by write_gazetteer_stamp, which
+    is None if the gazetteer has not been reloaded since the stamp was added.
+    """
+
+    try:
+        with open(_stamp_path()) as stamp:
+            return stamp.read()
+    except IOError:
+        return None
+
+
+def write_gazetteer_stamp(version):
+    """
+    Writes a new gazetteer version stamp, which should be done whenever the
+    gazetteer tables are reloaded, so that each process reloads its in memory
+    copy. The stamp combines the gazetteer version and the time, so that a reload
+    of the same gazetteer file is also picked up.
+    """
+
+    path = _stamp_path()
+
+    # Write and rename, so that other processes never read a partial stamp
+    with open(path + '.tmp', 'w') as stamp:
+        stamp.write('{}:{}'.format(version, current.request.now.isoformat()))
+
+    os.replace(path + '.tmp', path)
+
+
+def get_validator_locations_file():
+    """
+    Returns the path to a local JSON file of the validator locations payload
+    for the current gazetteer, writing the file if it does not yet exist. Passing
+    this file to safedata_validator.Dataset avoids the validator downloading the
+    locations from the website for every dataset check.
+    """
+
+    gazetteer = get_gazetteer()
+    version = hashlib.md5(str(gazetteer.version).encode('utf-8')).hexdigest()
+    path = os.path.join(current.request.folder, 'cache',
+                        'validator_locations_{}.json'.format(version))
+
+    if not os.path.exists(path):
+        # Write and rename, so that other processes never read a partial file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as locations_file:
+            simplejson.dump(gazetteer.validator_locations(), locations_file)
+
+        os.replace(tmp_path, path)
+
+    return path
+
+
+def get_gazetteer():
+    """
+    Returns the in memory gazetteer for this process, loading it from the
+    database when this process has no copy or when the gazetteer version stamp
+    has changed.
+    """
+
+    global _gazetteer
+
+    stamp = get_gazetteer_stamp()
+    gazetteer = _gazetteer
+
+    if gazetteer is None or gazetteer.version != stamp:
+        with _gazetteer_lock:
+            if _gazetteer is None or _gazetteer.version != stamp:
+                _gazetteer = load_gazetteer(stamp)
+            gazetteer = _gazetteer
+
+    return gazetteer
@@ -0,0 +1,45 @@
+"""
+This module provides the part sizes used to upload large files to Zenodo as
+multipart uploads with the Invenio files REST API. These do not use the web2py
+environment, so that they can be tested outside of web2py. They are used by
+upload_file_multipart in safe_web_datasets.
+"""
+
+
+def multipart_part_size(size, part_size):
+    """
+    Returns the part size to use for a multipart upload of a file, which is the
+    requested part size unless the file size is an exact multiple of it.
+
+    Invenio numbers parts from zero and expects the last part to have the size
+    modulo the part size (MultipartObject.last_part_size in invenio-files-rest),
+    but counts an exact multiple as having a full sized last part
+    (MultipartObject.last_part_number). It therefore expects a last part of zero
+    bytes and rejects the upload of the full sized last part with
+    MultipartInvalidChunkSize. Files that are an exact multiple of the part size
+    use the largest smaller part size that does not divide the file size.
+
+    Args:
+        size: The size of the file in bytes
+        part_size: The requested size of each part in bytes
+
+    Returns:
+        The part size in bytes, or None if every smaller part size divides the
+        file size, which can only happen for very small part sizes.
+    """
+
+    while size % part_size == 0:
+        part_size -= 1
+        if part_size == 1:
+            return None
+
+    return part_size
+
+
+def multipart_parts(size, part_size):
+    """
+    Returns the number of parts needed to upload a file, using a part size from
+    multipart_part_size.
+    """
+
+    return (size + part_size - 1) // part_size
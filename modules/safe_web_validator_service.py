@@ -0,0 +1,218 @@
+"""
+This module provides a long running dataset validation service. Scheduler workers
+run each task in a new process, so every verify_dataset task has to import the
+validator and the application modules, load the gazetteer and load the validator
+resources before checking a file. The service instead runs as a single resident 
+process, started from the web2py shell with the application models loaded:
+
+    python web2py.py -S safe_web -M -R applications/safe_web/private/validator_service.py
+
+It listens on a local address for verification jobs and runs them one at a time, so
+the imports, the in memory gazetteer and the validator resources - the local GBIF 
+database connection and the locations - are held between jobs. The resources are
+only loaded again when the gazetteer or the GBIF database change. The verify_dataset
+scheduler task passes jobs to the service when the site config provides a service
+address and falls back to checking the dataset in the worker if the service is 
+unavailable or does not reply in time. The service logs to the web2py.app.safe_web
+logger.
+"""
+
+import time
+import logging
+from importlib.metadata import version
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, answer_challenge, deliver_challenge
+from safe_web_datasets import verify_dataset
+from safe_web_worksheet_checks import ValidatorResources
+
+# The web2py HTML helpers are provided by gluon. This also provides the 'current' object, which
+# provides the web2py 'request' API (note the single letter difference from the requests package!).
+# The 'current' object is also extended by models/db.py to include the current 'db' DAL object
+# and the 'myconf' AppConfig object so that they can accessed by this module
+
+from gluon import *
+
+logger = logging.getLogger('web2py.app.safe_web')
+
+# The number of pending connections that the service holds while checking a 
+# dataset. Each pending connection is a scheduler worker waiting for a result.
+SERVICE_BACKLOG = 16
+
+# The default number of seconds that a scheduler task waits for the service to
+# take and complete a job, before checking the dataset itself. This needs to 
+# leave time for the check within the five minute timeout of verify_dataset tasks.
+SERVICE_TIMEOUT = 120
+
+
+def get_service_config():
+    """
+    Function to provide the validation service address, authentication key and
+    timeout from the site config. The service is optional, so this returns None
+    if the config does not provide an address. The timeout is optional and 
+    defaults to SERVICE_TIMEOUT.
+    
+    Returns:
+        A tuple of the (host, port) address, the authkey as bytes and the timeout
+        in seconds, or None.
+    """
+    
+    try:
+        address = current.myconf.take('validation.service_address')
+    except BaseException:
+        return None
+    
+    if not address:
+        return None
+    
+    try:
+        authkey = current.myconf.take('validation.service_authkey')
+    except BaseException:
+        raise RuntimeError('Site config does not provide validation.service_authkey')
+    
+    try:
+        timeout = float(current.myconf.take('validation.service_timeout'))
+    except BaseException:
+        timeout = SERVICE_TIMEOUT
+    
+    host, port = address.split(':')
+    
+    return (host, int(port)), authkey.encode('utf-8'), timeout
+
+
+def _send_job(address, authkey, timeout, job):
+    """
+    Sends a job to the validation service and returns the outcome message. The
+    service only accepts a connection when it is ready for the next job, so the
+    authentication handshake that Client would run on connecting is run here 
+    once the service has replied, and the timeout covers both the wait for the
+    service to accept the job and the time taken to check the dataset.
+    
+    Raises:
+        TimeoutError: if the service does not reply within the timeout.
+        AuthenticationError, EOFError, OSError: if the service rejects or drops
+            the connection.
+    """
+    
+    deadline = time.monotonic() + timeout
+    
+    with Client(address) as conn:
+        
+        if not conn.poll(timeout):
+            raise TimeoutError('Validation service did not accept the job')
+        
+        answer_challenge(conn, authkey)
+        deliver_challenge(conn, authkey)
+        conn.send(job)
+        
+        if not conn.poll(max(deadline - time.monotonic(), 0)):
+            raise TimeoutError('Validation service did not complete the job')
+        
+        return conn.recv()
+
+
+def verify_dataset_task(record_id, email=False):
+    """
+    Scheduler task to verify a dataset. This passes the job to the resident
+    validation service if one is configured and running, otherwise it runs
+    verify_dataset directly in the scheduler worker. If the service fails or 
+    does not reply within the timeout, the dataset is also checked in the worker.
+    
+    Args:
+        record_id: The id of the record from the dataset table that is to be checked.
+        email: Should the dataset uploader be emailed the outcome?
+    
+    Returns:
+        The outcome message from verify_dataset.
+    """
+    
+    config = get_service_config()
+    
+    if config is not None:
+        try:
+            return _send_job(*config, job={'record_id': record_id, 'email': email})
+        except (AuthenticationError, EOFError, OSError) as e:
+            # Includes the service not running and timeouts, so check the dataset here.
+            logger.warning('Verifying dataset {}: validation service unavailable '
+                           '({}), checking in worker'.format(record_id, repr(e)))
+    
+    return verify_dataset(record_id, email)
+
+
+def _reset_connection(db):
+    """
+    Rolls back any open transaction on the service database connection. If the
+    connection has been lost, for example by a database restart, the rollback
+    fails and the connection is replaced, so that the service can continue.
+    """
+    
+    try:
+        db.rollback()
+    except Exception:
+        logger.exception('Validation service database connection lost, reconnecting')
+        try:
+            db.close()
+        except Exception:
+            pass
+        
+        db._adapter.reconnect()
+
+
+def serve():
+    """
+    Runs the validation service. This accepts connections on the configured
+    address and each connection sends a single job dictionary containing the 
+    record_id and email arguments to verify_dataset. Connections are handled 
+    in the order they arrive, so the listener backlog acts as the job queue.
+    The outcome message is sent back to the caller. The database connection is
+    checked before each job, as it may have been dropped while the service was
+    idle. The validator resources are held between jobs.
+    """
+    
+    config = get_service_config()
+    
+    if config is None:
+        raise RuntimeError('Site config does not provide validation.service_address')
+    
+    address, authkey, _ = config
+    db = current.db
+    resources = ValidatorResources()
+    
+    logger.info('Validation service using safedata_validator {} '
+                'listening on {}:{}'.format(version('safedata_validator'), *address))
+    
+    with Listener(address, backlog=SERVICE_BACKLOG, authkey=authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                # Failed authentication or a dropped connection, so wait for the next
+                logger.exception('Validation service connection failed')
+                continue
+            
+            with conn:
+                job = {}
+                try:
+                    job = conn.recv()
+                    _reset_connection(db)
+                    start = time.perf_counter()
+                    res = verify_dataset(job['record_id'], job['email'], resources=resources)
+                    logger.info('{} ({:0.2f}s)'.format(res, time.perf_counter() - start))
+                except Exception as e:
+                    # Don't let a bad job take down the service, but leave the
+                    # DB in a clean state and report the problem to the caller
+                    logger.exception('Validation service job failed: {}'.format(job))
+                    try:
+                        _reset_connection(db)
+                    except Exception:
+                        # The database is unavailable, so try again for the next job
+                        logger.exception('Validation service database unavailable')
+                    
+                    res = 'Verifying dataset {}: validation service error {}'.format(
+                            job.get('record_id'), repr(e))
+                
+                try:
+                    conn.send(res)
+                except (EOFError, OSError):
+                    # The caller has gone away - the record is already updated
+                    logger.warning('Verifying dataset {}: caller disconnected before '
+                                   'the outcome was sent'.format(job.get('record_id')))
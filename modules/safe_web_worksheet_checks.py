@@ -0,0 +1,570 @@
+"""
+This module provides the functions used to check the sheets of a dataset with 
+safedata_validator, reusing stored checks of unchanged sheets and checking data
+worksheets in a pool of processes. These only use the dataset file and the 
+validator, and not the web2py environment, so that they can be used by the 
+processes in the pool and tested outside of web2py. They are called by 
+verify_dataset in safe_web_datasets.
+"""
+
+import os
+import copy
+import datetime
+import hashlib
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import xlrd
+import simplejson
+import safedata_validator
+from safedata_validator.safedata_validator import CH, LOG, LOGGER, DataWorksheet
+
+
+@contextmanager
+def timed_stage(timings, stage, worksheet=None):
+    """
+    Context manager to record the time taken and peak memory used by a stage
+    of dataset checking. If tracemalloc has been started, this is the peak memory
+    allocated during the stage. Otherwise, it is the maximum resident memory of
+    the process so far, which is much cheaper to find but includes earlier stages.
+    
+    Args:
+        timings: A list to which a dictionary of the stage details is appended.
+        stage: The name of the stage.
+        worksheet: The name of the worksheet, for worksheet checking stages.
+    """
+    
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    
+    start = time.perf_counter()
+    
+    try:
+        yield
+    finally:
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+        else:
+            # ru_maxrss is in kilobytes on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        timings.append({'stage': stage,
+                        'worksheet': worksheet,
+                        'seconds': round(time.perf_counter() - start, 4),
+                        'peak_memory': peak})
+
+
+
+class ValidatorResources(object):
+    """
+    Holds the resources loaded by safedata_validator when a Dataset is created, 
+    so that later datasets can be created without loading them again. Creating a
+    Dataset reads the validator config, opens the local GBIF database and checks
+    its backbone table, which counts every row, and loads the locations file. A 
+    process that checks many datasets, such as the validation service, can keep 
+    one instance and create every dataset using it.
+    
+    The first dataset is created by safedata_validator and the state of that new
+    dataset, without the workbook, is kept as a template along with the report 
+    and error counts from loading the resources. Later datasets copy the template, 
+    sharing the GBIF connection and locations, and then open their own workbook. 
+    The template is replaced when the resources key changes.
+    
+    Instances can be pickled to pass to processes checking data worksheets, which
+    do not need the GBIF database, so the database connection is dropped.
+    """
+    
+    # Attributes of the template that are shared between datasets, not copied
+    SHARED = ['gbif_conn', 'valid_locations', 'aliases']
+    
+    def __init__(self):
+        
+        self.key = None
+        self.state = None
+        self.report = None
+        self.counters = None
+    
+    def __getstate__(self):
+        
+        state = dict(self.__dict__)
+        if state['state'] is not None:
+            state['state'] = dict(state['state'], gbif_conn=None)
+        
+        return state
+    
+    def dataset(self, fname, key, **kwargs):
+        """
+        Returns a new safedata_validator.Dataset for a file, using the held 
+        resources if they were loaded using the same key.
+        
+        Args:
+            fname: The path to the dataset file
+            key: A JSON value identifying the resources, such as the GBIF 
+                database version and the locations file
+            kwargs: Further arguments to safedata_validator.Dataset, used when
+                the resources are loaded.
+        """
+        
+        if self.state is not None and key == self.key:
+            return self.new_dataset(fname)
+        
+        dataset = safedata_validator.Dataset(fname, verbose=False, **kwargs)
+        
+        # Keep the report and error counts from before the file is opened
+        report = LOG.getvalue().replace('\x00', '')
+        self.report = report[:report.rindex("- Checking file '")]
+        self.counters = dict(CH.counters, INFO=CH.counters['INFO'] - 1)
+        state = {attr: val for attr, val in dataset.__dict__.items()
+                 if attr not in ('workbook', 'filename', 'sheet_names')}
+        self.state = self._copy_state(state)
+        self.key = key
+        
+        return dataset
+    
+    def _copy_state(self, state):
+        """
+        Returns a copy of the state of a dataset, sharing the loaded resources.
+        """
+        
+        memo = {id(state[attr]): state[attr] for attr in self.SHARED}
+        return copy.deepcopy(state, memo)
+    
+    def new_dataset(self, fname):
+        """
+        Returns a new safedata_validator.Dataset for a file using the template,
+        following the steps in Dataset.__init__ after the resources are loaded.
+        """
+        
+        if self.state is None:
+            raise RuntimeError('Validator resources have not been loaded')
+        
+        dataset = object.__new__(safedata_validator.Dataset)
+        dataset.__dict__.update(self._copy_state(self.state))
+        
+        CH.reset()
+        CH.counters.update(self.counters)
+        LOG.seek(0)
+        LOG.truncate(0)
+        LOG.write(self.report)
+        
+        try:
+            dataset.workbook = xlrd.open_workbook(filename=fname)
+        except IOError:
+            raise IOError('Could not open file {}'.format(fname))
+        
+        dataset.filename = os.path.basename(fname)
+        LOGGER.info("Checking file '{}'".format(fname),
+                    extra={'indent_before': 0, 'indent_after': 1})
+        dataset.sheet_names = set(dataset.workbook.sheet_names())
+        
+        return dataset
+
+
+def get_sheet_fingerprints(dataset):
+    """
+    Gets a fingerprint of each sheet in the workbook of a dataset, which is the 
+    MD5 hash of the cell types and values, and the number of rows in each sheet.
+    This uses the workbook already loaded by the dataset, rather than reading 
+    the file again.
+    
+    Returns:
+        A dictionary of dictionaries giving the md5 and number of rows, keyed
+        by sheet name.
+    """
+    
+    workbook = dataset.workbook
+    fingerprints = {}
+    
+    for sheet in workbook.sheets():
+        # Dates are stored as numbers, so the date mode is part of the contents 
+        md5 = hashlib.md5(repr(workbook.datemode).encode('utf-8'))
+        for row_idx in range(sheet.nrows):
+            row = (sheet.row_types(row_idx), sheet.row_values(row_idx))
+            md5.update(repr(row).encode('utf-8'))
+        
+        fingerprints[sheet.name] = {'md5': md5.hexdigest(), 'rows': sheet.nrows}
+    
+    return fingerprints
+
+
+def sheet_check_keys(dataset, fingerprints, cache_key):
+    """
+    Creates a key for the check of the taxa and locations sheets and of each 
+    data worksheet in a dataset. The outcome of checking the taxa depends on
+    the Taxa sheet and the validator and GBIF database versions, and the outcome
+    of checking the locations depends on the Locations sheet and the validator,
+    gazetteer and location aliases versions. The outcome of checking a data 
+    worksheet depends on the worksheet contents, the description of the worksheet
+    in the summary sheet, the taxa and locations sheets that the worksheet is 
+    checked against and all of the resource versions in the dataset check key.
+    
+    Taxa checked using the GBIF web API are not given a key, so are always 
+    checked again, as the outcome may be caused by transient network problems.
+    
+    Args:
+        dataset: A safedata_validator.Dataset that has loaded the summary sheet
+        fingerprints: The output of get_sheet_fingerprints for the dataset
+        cache_key: The dataset check cache key, providing the versions
+    
+    Returns:
+        A dictionary of MD5 hash keys for 'taxa' and 'locations' and of a 
+        dictionary of keys for 'worksheets', keyed by worksheet name.
+    """
+    
+    def _key(values):
+        key = simplejson.dumps(values, sort_keys=True, default=str)
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+    
+    taxa, locations = [fingerprints.get(sheet, {}).get('md5') for sheet in ('Taxa', 'Locations')]
+    
+    keys = {'taxa': None, 
+            'locations': _key([locations, cache_key['validator_version'],
+                               cache_key['gazetteer_version'],
+                               cache_key['location_aliases_version']]),
+            'worksheets': {}}
+    
+    if cache_key['gbif_version'] != 'api':
+        keys['taxa'] = _key([taxa, cache_key['validator_version'], cache_key['gbif_version']])
+    
+    shared = [taxa, locations, cache_key['validator_version'], cache_key['gazetteer_version'],
+              cache_key['location_aliases_version'], cache_key['gbif_version']]
+    
+    for ws in dataset.dataworksheet_summaries:
+        keys['worksheets'][ws['name']] = _key([fingerprints.get(ws['name'], {}).get('md5'), ws] 
+                                              + shared)
+    
+    return keys
+
+
+# The checks of the taxa and locations sheets, in the order they are run, giving
+# the Dataset method that checks each sheet and the types of the dataset attributes
+# it sets, other than the report, error counts and extents.
+METADATA_SHEETS = [('taxa', 'load_taxa', {'taxon_names': set, 'taxon_index': list}),
+                   ('locations', 'load_locations', {'locations': set, 'location_index': list})]
+
+
+def load_metadata_sheets(dataset, keys, previous, timings):
+    """
+    Checks the taxa and locations sheets of a dataset, reusing the stored check
+    of a sheet if it is unchanged from a previous version of the dataset. 
+    Checking the taxa validates every taxon against GBIF, so is usually the
+    slowest part of checking a dataset.
+    
+    Args:
+        dataset: A safedata_validator.Dataset that has loaded the summary sheet
+        keys: The sheet check keys from sheet_check_keys
+        previous: The stored sheet checks from a previous version
+        timings: A list of stage timings, which is extended with the timing
+            of each sheet
+    
+    Returns:
+        A dictionary of the checks of the 'taxa' and 'locations' sheets, for 
+        storage.
+    """
+    
+    checks = {}
+    
+    for sheet, method, attrs in METADATA_SHEETS:
+        prev = previous.get(sheet)
+        
+        if keys[sheet] is not None and prev is not None and prev['key'] == keys[sheet]:
+            _merge_check(dataset, prev)
+            
+            for attr, attr_type in attrs.items():
+                setattr(dataset, attr, attr_type(prev[attr]))
+            
+            timings.append({'stage': 'reuse_' + sheet, 'worksheet': None,
+                            'seconds': 0, 'peak_memory': None})
+            checks[sheet] = prev
+        else:
+            with timed_stage(timings, method):
+                res = _record_check(dataset, getattr(dataset, method))
+            
+            # Store sets of names as sorted lists
+            for attr, attr_type in attrs.items():
+                value = getattr(dataset, attr)
+                res[attr] = sorted(value) if attr_type is set else list(value)
+            
+            res['key'] = keys[sheet]
+            checks[sheet] = res
+    
+    return checks
+
+
+def load_worksheets(dataset, fname, keys, previous, n_workers, timings,
+                    progress=None, trace_memory=False, resources=None):
+    """
+    Checks the data worksheets in a dataset, reusing the stored checks of 
+    worksheets that are unchanged from a previous version of the dataset.
+    
+    Each worksheet is independent of the others - they are only checked against
+    the taxa and locations sheets - so the outcome of each worksheet check can be
+    stored and merged back into a dataset later. The safedata_validator logger is
+    a module level object and the outcome of a check is the worksheet metadata,
+    the taxa and locations used, the temporal and geographic extents of the data,
+        the report text and the changes in the error counts. The results are merged
+    in worksheet order, so that final_checks() gives the same report as checking
+    every worksheet one after another.
+    
+    Worksheets that need checking can also be checked using a pool of processes:
+    each process creates a dataset from the validator resources held by the calling
+    process, opens its own copy of the workbook and checks a single worksheet
+    against the taxa, locations and external files already loaded by the calling
+    process, so the resources, the metadata sheets and the GBIF validation of the
+    taxa are not loaded again. A pool is used when more than one worker is requested and more than
+    one worksheet needs checking.
+    
+    Args:
+        dataset: A safedata_validator.Dataset that has already loaded the
+            summary, taxa and locations sheets.
+        fname: The path to the dataset file
+        keys: A dictionary of worksheet check keys from sheet_check_keys
+        previous: A dictionary of stored worksheet checks from a previous version
+        n_workers: The maximum number of processes to use
+        timings: A list of stage timings, which is extended with the
+            timing of the individual worksheets
+        progress: An optional function, called with the index of each 
+            worksheet as its check completes.
+        trace_memory: Should worksheets checked in the pool trace memory
+            allocations to report the peak memory of each check.
+        resources: The ValidatorResources used to create the dataset, which
+            are passed to the processes in the pool. If this is not provided, the
+            processes load the resources given in the validator config.
+    
+    Returns:
+        A dictionary of worksheet checks keyed by worksheet name, for storage.
+    """
+    
+    summaries = dataset.dataworksheet_summaries
+    results = [None] * len(summaries)
+    
+    # Find worksheets that can reuse a previous check, ignoring stored checks 
+    # from before the worksheet extents were recorded
+    for idx, ws in enumerate(summaries):
+        prev = previous.get(ws['name'])
+        if prev is not None and prev['key'] == keys[ws['name']] and 'extents' in prev:
+            results[idx] = prev
+    
+    to_check = [idx for idx, res in enumerate(results) if res is None]
+    
+    if n_workers > 1 and len(to_check) > 1:
+        
+        # Check the changed worksheets in the pool and then merge all 
+        # worksheets into the dataset in order
+        n_workers = min(n_workers, len(to_check))
+        context = {attr: getattr(dataset, attr) for attr in WORKSHEET_CONTEXT}
+        
+        with timed_stage(timings, 'load_worksheets_parallel'):
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                
+                futures = {idx: pool.submit(_check_worksheet, fname, summaries[idx],
+                                            context, trace_memory, resources)
+                           for idx in to_check}
+                
+                for idx in range(len(summaries)):
+                    if idx in futures:
+                        try:
+                            results[idx] = futures[idx].result()
+                        except BrokenProcessPool:
+                            raise RuntimeError('The process checking worksheet {} stopped '
+                                               'unexpectedly'.format(summaries[idx]['name']))
+                    
+                    if progress is not None:
+                        progress(idx)
+        
+        for idx, res in enumerate(results):
+            _merge_worksheet(dataset, res, timings, reused=idx not in futures)
+    
+    else:
+        # Check the changed worksheets in this process, merging in
+        # the reused checks in order.
+        for idx, ws in enumerate(summaries):
+            if results[idx] is None:
+                results[idx] = _load_worksheet(dataset, ws)
+                timings.append(results[idx]['timing'])
+            else:
+                _merge_worksheet(dataset, results[idx], timings, reused=True)
+            
+            if progress is not None:
+                progress(idx)
+    
+    # Package the results for storage
+    checks = {}
+    for ws, res in zip(summaries, results):
+        res['key'] = keys[ws['name']]
+        checks[ws['name']] = res
+    
+    return checks
+
+
+# The dataset attributes set by loading the summary, taxa and locations sheets
+# that are used to check data worksheets.
+WORKSHEET_CONTEXT = ['taxon_names', 'locations', 'external_files']
+
+# The dataset extents that are updated by the locations and by the date and 
+# geographic fields in data worksheets, and the types used by Dataset.update_extent
+# for each extent.
+DATASET_EXTENTS = {'temporal_extent': datetime.datetime,
+                   'latitudinal_extent': float,
+                   'longitudinal_extent': float}
+
+
+def _extents_to_json(dataset):
+    """
+    Returns the extents of a dataset as JSON values, using ISO format strings
+    for datetimes, so that sheet checks can be stored in a JSON field.
+    """
+    
+    extents = {}
+    for which, val_type in DATASET_EXTENTS.items():
+        extent = getattr(dataset, which)
+        if extent is not None and val_type is datetime.datetime:
+            extent = [vl.isoformat() for vl in extent]
+        extents[which] = None if extent is None else list(extent)
+    
+    return extents
+
+
+def _update_extents(dataset, extents):
+    """
+    Updates the extents of a dataset with the extents from a sheet check,
+    as returned by _extents_to_json.
+    """
+    
+    for which, val_type in DATASET_EXTENTS.items():
+        extent = extents.get(which)
+        if extent is not None:
+            if val_type is datetime.datetime:
+                extent = [datetime.datetime.fromisoformat(vl) for vl in extent]
+            dataset.update_extent(tuple(extent), val_type, which)
+
+
+def _record_check(dataset, check, *args):
+    """
+    Runs a check on a dataset and returns the changes that the check made to the
+    extents of the dataset, the report text and the error counts. These are all 
+    JSON values, so that the check can be stored in a JSON field and merged into
+    a dataset later using _merge_check.
+    """
+    
+    report = dataset.report()
+    report_start = len(report.getvalue())
+    counters_start = dict(CH.counters)
+    
+    # Swap out the extents, to find the extents set by the check
+    extents = {which: getattr(dataset, which) for which in DATASET_EXTENTS}
+    for which in DATASET_EXTENTS:
+        setattr(dataset, which, None)
+    
+    try:
+        check(*args)
+    finally:
+        check_extents = _extents_to_json(dataset)
+        for which in DATASET_EXTENTS:
+            setattr(dataset, which, extents[which])
+        _update_extents(dataset, check_extents)
+    
+    counters = {level: count - counters_start.get(level, 0)
+                for level, count in CH.counters.items()}
+    
+    return {'extents': check_extents,
+            'report': report.getvalue()[report_start:],
+            'counters': counters}
+
+
+def _merge_check(dataset, res):
+    """
+    Merges the changes from a check recorded by _record_check into a dataset.
+    """
+    
+    _update_extents(dataset, res['extents'])
+    dataset.report().write(res['report'])
+    
+    counters = CH.counters
+    for level, count in res['counters'].items():
+        counters[level] += count
+
+
+def _load_worksheet(dataset, ws):
+    """
+    Checks a single data worksheet in a dataset and returns the changes that 
+    the check made to the dataset state: the changes recorded by _record_check,
+    the added worksheet metadata and the taxa and locations used by the worksheet.
+    """
+    
+    n_dataworksheets = len(dataset.dataworksheets)
+    
+    # Swap out the sets of names used, to find the names used by this worksheet
+    taxa_used, locations_used = dataset.taxon_names_used, dataset.locations_used
+    dataset.taxon_names_used, dataset.locations_used = set(), set()
+    timing = []
+    
+    try:
+        with timed_stage(timing, 'load_data_worksheet', ws['name']):
+            res = _record_check(dataset, dataset.load_data_worksheet, ws)
+        sheet_taxa, sheet_locations = dataset.taxon_names_used, dataset.locations_used
+    finally:
+        dataset.taxon_names_used = taxa_used | dataset.taxon_names_used
+        dataset.locations_used = locations_used | dataset.locations_used
+    
+    res.update({'dataworksheets': [dict(dwsh.__dict__)
+                                   for dwsh in dataset.dataworksheets[n_dataworksheets:]],
+                'taxon_names_used': sorted(sheet_taxa),
+                'locations_used': sorted(sheet_locations),
+                'timing': timing[0]})
+    
+    return res
+
+
+def _merge_worksheet(dataset, res, timings, reused=False):
+    """
+    Merges a worksheet check from _load_worksheet, run in another process or
+    stored from a previous check, into a dataset.
+    """
+    
+    # Rebuild the worksheet metadata objects from the stored attributes
+    for meta in res['dataworksheets']:
+        dwsh = DataWorksheet(meta)
+        dwsh.__dict__.update(meta)
+        dataset.dataworksheets.append(dwsh)
+    
+    dataset.taxon_names_used.update(res['taxon_names_used'])
+    dataset.locations_used.update(res['locations_used'])
+    _merge_check(dataset, res)
+    
+    if reused:
+        timings.append({'stage': 'reuse_data_worksheet',
+                        'worksheet': res['timing']['worksheet'],
+                        'seconds': 0,
+                        'peak_memory': None})
+    else:
+        timings.append(res['timing'])
+
+
+def _check_worksheet(fname, ws, context, trace_memory=False, resources=None):
+    """
+    Worker function for load_worksheets, which checks a single data worksheet 
+    in a separate process. This only uses the file and not the web2py environment.
+    The calling process has already checked the summary, taxa and locations 
+    sheets, so the dataset is given the resulting names and external files 
+    rather than loading those sheets again.
+    """
+    
+    if resources is not None:
+        dataset = resources.new_dataset(fname)
+    else:
+        dataset = safedata_validator.Dataset(fname, verbose=False)
+    
+    for attr, value in context.items():
+        setattr(dataset, attr, value)
+    
+    if trace_memory:
+        tracemalloc.start()
+    
+    res = _load_worksheet(dataset, ws)
+    tracemalloc.stop()
+    
+    return res
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Benchmarks the publication of datasets to Zenodo, using the local Zenodo
+# emulator in private/zenodo_emulator.py. This needs to be run from the web2py
+# shell with the application models loaded, against a development database, with
+# the [zenodo] api_url in appconfig.ini set to the emulator:
+#
+#   python zenodo_emulator.py --port 8090 --latency 0.2 --jitter 0.1 --quiet
+#   python web2py.py -S safe_web -M -R applications/safe_web/private/benchmark_publication.py \
+#       -A --template 123 -n 30 --in-flight 1 4 8
+#
+# The template is the id of a submitted dataset that has passed checking. For
+# each level of concurrency, N copies of the template are published using the
+# batch publication task, and the end-to-end throughput and latency of each
+# Zenodo API call are reported. The published copies are then removed from the
+# database, along with their entries in the tables derived from the index, unless
+# --keep is used. Publication commits each step, so the copies cannot simply be
+# rolled back.
+
+import io
+import sys
+import time
+import argparse
+
+from gluon import current
+from safe_web_datasets import (get_zenodo_api, get_zenodo_client, publish_datasets,
+                               update_taxon_closure, update_taxon_summary,
+                               bump_catalogue_generation)
+
+
+def copy_template(template, n):
+    """
+    Creates n copies of a submitted dataset, each with its own copy of the file.
+    """
+
+    filename, stream = db.submitted_datasets.file.retrieve(template.file)
+    data = stream.read()
+    stream.close()
+
+    skip = ['id', 'file', 'concept_id', 'zenodo_submission_status', 'zenodo_error',
+            'zenodo_publication', 'zenodo_upload']
+
+    values = {k: v for k, v in template.as_dict().items() if k not in skip}
+    ids = []
+
+    for idx in range(n):
+        stored = db.submitted_datasets.file.store(io.BytesIO(data), filename)
+
+        ids.append(db.submitted_datasets.insert(file=stored, **values))
+
+    db.commit()
+
+    return ids
+
+
+def remove_copies(ids):
+    """
+    Removes published copies from the index and any unpublished copies. The
+    search documents and catalogue change log entries of the copies are deleted
+    and the taxon closure and taxon summary tables are rebuilt without them. The
+    other index tables reference the published datasets, so are deleted along
+    with them. The catalogue generation is then bumped, so that no process
+    keeps cached results that include the copies.
+    """
+
+    published = db(db.published_datasets.submission_id.belongs(ids))
+    rows = published.select(db.published_datasets.id, db.published_datasets.zenodo_concept_id,
+                            db.published_datasets.zenodo_record_id)
+
+    db(db.dataset_search.dataset_id.belongs([r.id for r in rows])).delete()
+    db(db.catalogue_changes.zenodo_record_id.belongs([r.zenodo_record_id for r in rows])).delete()
+    db(db.project_datasets.concept_id.belongs([r.zenodo_concept_id for r in rows])).delete()
+    published.delete()
+    db(db.submitted_datasets.id.belongs(ids)).delete()
+
+    update_taxon_closure()
+    update_taxon_summary()
+    bump_catalogue_generation()
+    db.commit()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark dataset publication')
+    parser.add_argument('--template', type=int, required=True,
+                        help='The id of a submitted dataset that has passed checking')
+    parser.add_argument('-n', type=int, default=20, help='The number of datasets to publish')
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 4],
+                        help='The numbers of datasets to publish at once')
+    parser.add_argument('--keep', action='store_true', help='Keep the published copies')
+    args = parser.parse_args(sys.argv[1:])
+
+    api, token = get_zenodo_api()
+
+    if not api.startswith(('http://localhost', 'http://127.0.0.1')):
+        sys.exit('The Zenodo API is {}: set zenodo.api_url to a local emulator'.format(api))
+
+    template = db.submitted_datasets[args.template]
+
+    if template is None or template.dataset_check_outcome != 'PASS':
+        sys.exit('Template {} is not a submitted dataset that has passed checks'.format(args.template))
+
+    client = get_zenodo_client()
+
+    for in_flight in args.in_flight:
+
+        ids = copy_template(template, args.n)
+        client.stats.clear()
+
+        start = time.perf_counter()
+        summary = publish_datasets(ids, max_in_flight=in_flight)
+        elapsed = time.perf_counter() - start
+
+        print('\nPublishing {} datasets with {} in flight'.format(args.n, in_flight))
+        print(summary.splitlines()[0])
+        print('Throughput: {:0.2f} datasets per minute'.format(args.n * 60 / elapsed))
+
+        print('\n{:<28}{:>8}{:>9}{:>8}{:>10}{:>10}'.format('Call', 'Calls', 'Retries',
+                                                           'Errors', 'Mean (s)', 'Max (s)'))
+
+        for call, stats in sorted(client.stats.items()):
+            print('{:<28}{:>8}{:>9}{:>8}{:>10.3f}{:>10.3f}'.format(
+                      call, stats['calls'], stats['retries'], stats['errors'],
+                      stats['seconds'] / stats['calls'], stats['max_seconds']))
+
+        if not args.keep:
+            remove_copies(ids)
+
+
+main()
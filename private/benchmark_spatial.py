@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# Benchmarks the spatial search API queries on a synthetic catalogue. This needs
+# to be run from the web2py shell with the application models loaded, against a
+# development database with the gazetteer loaded:
+#
+#   python web2py.py -S safe_web -M -R applications/safe_web/private/benchmark_spatial.py \
+#       -A -n 10000 --queries 50
+#
+# The synthetic datasets, each with a random extent and set of sampling locations
+# across the SAFE region, are added within a transaction, along with any missing
+# GiST indexes, and the transaction is rolled back at the end so the database is
+# left unchanged. The script then times the previous spatial search SQL, which
+# parsed the query geometry in three statements and filtered on ST_Distance,
+# against the current search functions, and checks that both return the same
+# datasets for each query.
+#
+# The previous sampling location search joined every dataset location to the
+# gazetteer, so it silently dropped new locations that are not in the gazetteer.
+# The baseline used here keeps that ST_Distance filter but uses an outer join to
+# the gazetteer, so that it has the same semantics as the current search and the
+# speed up compares like with like.
+
+import sys
+import time
+import random
+import argparse
+
+from safe_web_datasets import dataset_parse_spatial, dataset_spatial_search, dataset_spatial_bbox_search
+from safe_web_db_indexes import DATASET_INDEXES
+
+# The approximate extent of the SAFE region in WGS84
+XMIN, XMAX, YMIN, YMAX = 116.5, 117.9, 4.4, 5.2
+
+SYNTHETIC_TITLE = 'Spatial benchmark dataset'
+
+
+def create_synthetic_catalogue(n, n_locations):
+    """
+    Adds n synthetic published datasets with random extents, and n_locations
+    sampling locations per dataset. Half of the locations are new point locations
+    and half are gazetteer locations.
+    """
+
+    db.executesql("""
+        INSERT INTO published_datasets (dataset_title, geographic_extent, geographic_extent_utm50n)
+            SELECT %s, ext, ST_Transform(ext, 32650)
+            FROM (SELECT ST_MakeEnvelope(x, y, x + random() * 0.1, y + random() * 0.1, 4326) AS ext
+                  FROM (SELECT %s + random() * %s AS x, %s + random() * %s AS y
+                        FROM generate_series(1, %s)) AS xy) AS envelopes;""",
+                  placeholders=[SYNTHETIC_TITLE, XMIN, XMAX - XMIN, YMIN, YMAX - YMIN, n])
+
+    db.executesql("""
+        INSERT INTO dataset_locations (dataset_id, name, new_location, wkt_wgs84, wkt_utm50n)
+            SELECT id, 'benchmark_' || id || '_' || idx, 'T', pt, ST_Transform(pt, 32650)
+            FROM (SELECT pd.id, idx, ST_SetSRID(ST_MakePoint(%s + random() * %s,
+                                                             %s + random() * %s), 4326) AS pt
+                  FROM published_datasets pd, generate_series(1, %s) AS idx
+                  WHERE pd.dataset_title = %s) AS points;""",
+                  placeholders=[XMIN, XMAX - XMIN, YMIN, YMAX - YMIN,
+                                (n_locations + 1) // 2, SYNTHETIC_TITLE])
+
+    db.executesql("""
+        INSERT INTO dataset_locations (dataset_id, name, new_location)
+            SELECT pd.id, gaz.locations[1 + floor(random() * array_length(gaz.locations, 1))::int], 'F'
+            FROM published_datasets pd, generate_series(1, %s) AS idx,
+                 (SELECT array_agg(location) AS locations FROM gazetteer) AS gaz
+            WHERE pd.dataset_title = %s;""",
+                  placeholders=[n_locations // 2, SYNTHETIC_TITLE])
+
+    for name, table, method, columns in DATASET_INDEXES:
+        if table in ('published_datasets', 'dataset_locations', 'gazetteer'):
+            db.executesql('CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({});'.format(
+                              name, table, method, columns))
+
+    for table in ('published_datasets', 'dataset_locations', 'gazetteer'):
+        db.executesql('ANALYZE {};'.format(table))
+
+
+def previous_parse_spatial(wkt):
+    """
+    The previous query geometry parsing, using three statements.
+    """
+
+    db.executesql("SELECT ST_GeomFromText('{}', 4326);".format(wkt))
+    db.executesql("SELECT ST_XMin(gm) >= -180 AND ST_XMax(gm) <= 180 AND ST_YMin(gm) >= -90 "
+                  "AND ST_YMax(gm) <= 90 FROM (SELECT ST_GeomFromText('{}', 4326) AS gm) AS gm;"
+                  .format(wkt))
+    return db.executesql("SELECT ST_Transform(ST_GeomFromText('{}', 4326), 32650);"
+                         .format(wkt))[0][0]
+
+
+def previous_spatial_search(wkt, distance):
+    """
+    The previous sampling location search SQL, testing the distance from both the
+    location and gazetteer geometries for every dataset location. This uses an
+    outer join to the gazetteer, rather than the previous inner join, so that new
+    locations are matched as they are by the current search.
+    """
+
+    query_geom = "'{}'::geometry".format(previous_parse_spatial(wkt))
+
+    return db.executesql("""
+        SELECT DISTINCT pd.zenodo_concept_id, pd.zenodo_record_id, pd.dataset_title
+        FROM published_datasets pd
+            JOIN dataset_locations dl ON pd.id = dl.dataset_id
+            LEFT JOIN gazetteer gz ON dl.name = gz.location
+        WHERE ST_Distance(gz.wkt_utm50n, {0}) <= {1} OR
+              ST_Distance(dl.wkt_utm50n, {0}) <= {1};""".format(query_geom, distance))
+
+
+def previous_bbox_search(wkt, distance):
+    """
+    The previous dataset extent distance search SQL.
+    """
+
+    query_geom = "'{}'::geometry".format(previous_parse_spatial(wkt))
+
+    return db.executesql("""
+        SELECT DISTINCT pd.zenodo_concept_id, pd.zenodo_record_id, pd.dataset_title
+        FROM published_datasets pd
+        WHERE ST_Distance(pd.geographic_extent_utm50n, {}) <= {};""".format(query_geom, distance))
+
+
+def current_search(func, wkt, distance, **kwargs):
+    """
+    Runs one of the current search functions, selecting the same fields as the API.
+    """
+
+    pd = db.published_datasets
+    qry = func(wkt=wkt, distance=distance, **kwargs)
+
+    if isinstance(qry, dict):
+        sys.exit('Search failed: {}'.format(qry['message']))
+
+    rows = db(qry).select(pd.zenodo_concept_id, pd.zenodo_record_id, pd.dataset_title,
+                          distinct=True)
+
+    return [(r.zenodo_concept_id, r.zenodo_record_id, r.dataset_title) for r in rows]
+
+
+def time_queries(label, func, queries):
+    """
+    Times a search function over a list of query geometries and distances,
+    reporting the mean and maximum time and the mean number of hits.
+
+    Returns:
+        The mean time and a list of the set of results for each query.
+    """
+
+    times = []
+    results = []
+
+    for wkt, distance in queries:
+        start = time.perf_counter()
+        res = func(wkt, distance)
+        times.append(time.perf_counter() - start)
+        results.append(set(tuple(r) for r in res))
+
+    mean = sum(times) / len(times)
+    hits = sum(len(res) for res in results) / len(queries)
+    print('{:<36}{:>10.2f}{:>10.2f}{:>10.1f}'.format(label, mean * 1000, max(times) * 1000, hits))
+
+    return mean, results
+
+
+def compare_results(label, previous, current):
+    """
+    Reports the number of queries for which two searches returned different results.
+    """
+
+    differ = sum(prev != curr for prev, curr in zip(previous, current))
+
+    if differ:
+        print('{}: results differ for {} of {} queries'.format(label, differ, len(previous)))
+    else:
+        print('{}: identical results for all {} queries'.format(label, len(previous)))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the spatial search queries')
+    parser.add_argument('-n', type=int, default=10000, help='The number of synthetic datasets')
+    parser.add_argument('--locations', type=int, default=6,
+                        help='The number of sampling locations per dataset')
+    parser.add_argument('--queries', type=int, default=50, help='The number of queries to time')
+    parser.add_argument('--distance', type=float, default=500, help='The search distance in metres')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed for the queries')
+    args = parser.parse_args(sys.argv[1:])
+
+    random.seed(args.seed)
+    queries = [('POINT({} {})'.format(random.uniform(XMIN, XMAX), random.uniform(YMIN, YMAX)),
+                args.distance) for idx in range(args.queries)]
+
+    try:
+        start = time.perf_counter()
+        create_synthetic_catalogue(args.n, args.locations)
+        print('Created {} synthetic datasets in {:0.1f} seconds'.format(
+                  args.n, time.perf_counter() - start))
+
+        print('\n{:<36}{:>10}{:>10}{:>10}'.format('Query', 'Mean (ms)', 'Max (ms)', 'Hits'))
+
+        old_parse, _ = time_queries('parse (previous)',
+                                    lambda wkt, d: [(previous_parse_spatial(wkt),)], queries)
+        new_parse, _ = time_queries('parse', lambda wkt, d: [(dataset_parse_spatial(wkt),)],
+                                    queries)
+
+        old_spatial, old_spatial_res = time_queries('spatial search (previous)',
+                                                    previous_spatial_search, queries)
+        new_spatial, new_spatial_res = time_queries(
+            'spatial search', lambda wkt, d: current_search(dataset_spatial_search, wkt, d),
+            queries)
+
+        old_bbox, old_bbox_res = time_queries('bbox distance search (previous)',
+                                              previous_bbox_search, queries)
+        new_bbox, new_bbox_res = time_queries(
+            'bbox distance search',
+            lambda wkt, d: current_search(dataset_spatial_bbox_search, wkt, d,
+                                          match_type='distance'),
+            queries)
+
+        print()
+        compare_results('Spatial search', old_spatial_res, new_spatial_res)
+        compare_results('Bbox distance search', old_bbox_res, new_bbox_res)
+
+        print('\nSpeed up: parse {:0.1f}x, spatial search {:0.1f}x, bbox distance search {:0.1f}x'
+              .format(old_parse / new_parse, old_spatial / new_spatial, old_bbox / new_bbox))
+
+    finally:
+        db.rollback()
+
+
+main()
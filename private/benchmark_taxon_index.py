@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Benchmarks the rendering of dataset taxon indices by taxon_index_to_text on
+# synthetic taxon indices, comparing the current implementation against the
+# previous one, which was quadratic in the number of sibling taxa, and checking
+# that both give the same HTML. The previous implementation could pair a taxon
+# with the wrong sibling when siblings without a worksheet name came before its
+# match, but the synthetic index has no such siblings. This needs to be run from
+# the web2py shell with the application models loaded:
+#
+#   python web2py.py -S safe_web -M -R applications/safe_web/private/benchmark_taxon_index.py \
+#       -A -n 50000 --siblings 5000
+#
+# The synthetic index has a GBIF style hierarchy down to genera, with species
+# spread across the genera, a small proportion of synonym pairs and a single
+# genus holding a large number of morphospecies. The taxa are shuffled, so that
+# sibling taxa are not adjacent in the index.
+
+import sys
+import copy
+import time
+import random
+import argparse
+from io import StringIO
+from itertools import groupby
+
+from gluon import XML
+from safe_web_datasets import taxon_index_to_text
+
+
+def previous_taxon_index_to_text(taxa):
+    """
+    The previous implementation of taxon_index_to_text.
+    """
+
+    def indent(n):
+
+        return('&ensp;-&ensp;' * n)
+
+    def format_name(tx):
+
+        # format the canonical name
+        if tx['taxon_rank'] in ['genus', 'species', 'subspecies']:
+            return '<i>{}</i>'.format(tx['taxon_name'])
+        elif tx['taxon_rank'] in ['morphospecies', 'functional group']:
+            return '[{}]'.format(tx['taxon_name'])
+        else:
+            return tx['taxon_name']
+
+    html = StringIO()
+
+    taxa.sort(key=lambda x: x['gbif_parent_id'] or 0)
+    grouped = {k: list(v) for k, v in groupby(taxa, lambda x: x['gbif_parent_id'])}
+
+    stack = [{'current': grouped[None][0], 'next': grouped[None][1:]}]
+
+    while stack:
+
+        current = stack[-1]['current']
+        canon_name = format_name(current)
+
+        next_ws_names = [tx['worksheet_name'] for tx in stack[-1]['next']
+                         if tx['worksheet_name'] is not None]
+
+        if current['worksheet_name'] in next_ws_names:
+            name_pair = stack[-1]['next'].pop(next_ws_names.index(current['worksheet_name']))
+            if current['gbif_status'] == 'accepted':
+                as_name = format_name(name_pair)
+                as_status = name_pair['gbif_status']
+            else:
+                as_name = canon_name
+                as_status = current['gbif_status']
+                canon_name = format_name(name_pair)
+
+            txt = '{} {} (as {}: {})<br>'.format(indent(len(stack)), canon_name, as_status, as_name)
+        else:
+            txt = '{} {} <br>'.format(indent(len(stack)), canon_name)
+
+        html.write(txt)
+
+        parent_id = current['gbif_id']
+        if parent_id in grouped:
+            stack.append({'current': grouped[parent_id][0], 'next': grouped[parent_id][1:]})
+        else:
+            while stack:
+                push = stack.pop()
+                if push['next']:
+                    stack.append({'current': push['next'][0], 'next': push['next'][1:]})
+                    break
+
+    return XML(html.getvalue())
+
+
+def synthetic_taxon_index(n, siblings, synonyms=0.02):
+    """
+    Creates a synthetic taxon index with about n taxa, including a genus with the
+    given number of morphospecies. Higher taxa have no worksheet name, as they
+    are added to the index as the parents of worksheet taxa.
+    """
+
+    taxa = []
+    next_id = [0]
+
+    def add(parent_id, name, rank, worksheet_name=None, status='accepted', gbif_id=None):
+        if gbif_id is None:
+            next_id[0] += 1
+            gbif_id = next_id[0]
+        taxa.append(dict(worksheet_name=worksheet_name, gbif_id=gbif_id,
+                         gbif_parent_id=parent_id, taxon_name=name, taxon_rank=rank,
+                         gbif_status=status))
+        return gbif_id
+
+    # A hierarchy of higher taxa down to genera
+    parents = [None]
+    for rank, width in [('kingdom', 2), ('phylum', 4), ('class', 4), ('order', 5),
+                        ('family', 5), ('genus', 4)]:
+        parents = [add(parent, '{} {}'.format(rank.capitalize(), next_id[0] + 1), rank)
+                   for parent in parents for idx in range(width)]
+
+    genera = parents
+
+    # The large genus of morphospecies, which are not GBIF taxa so use negative ids
+    for idx in range(siblings):
+        name = 'Morphospecies {}'.format(idx)
+        add(genera[0], name, 'morphospecies', worksheet_name=name, gbif_id=-(idx + 1))
+
+    # Species spread across the other genera, with some used as synonyms. The
+    # synonym is paired with its accepted name using the worksheet name.
+    idx = 0
+    while len(taxa) < n:
+        genus = random.choice(genera[1:])
+        name = 'Species {}'.format(idx)
+        if random.random() < synonyms:
+            add(genus, name, 'species', worksheet_name=name, status='synonym')
+            add(genus, name + ' accepted', 'species', worksheet_name=name)
+        else:
+            add(genus, name, 'species', worksheet_name=name)
+        idx += 1
+
+    random.shuffle(taxa)
+
+    return taxa
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark taxon index rendering')
+    parser.add_argument('-n', type=int, default=50000, help='The number of taxa in the index')
+    parser.add_argument('--siblings', type=int, default=5000,
+                        help='The number of morphospecies in the largest genus')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of timed runs')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed')
+    args = parser.parse_args(sys.argv[1:])
+
+    random.seed(args.seed)
+    taxa = synthetic_taxon_index(args.n, args.siblings)
+    print('Synthetic index of {} taxa, with {} sibling morphospecies\n'.format(
+              len(taxa), args.siblings))
+
+    outputs = {}
+    times = {}
+
+    for label, func in [('previous', previous_taxon_index_to_text),
+                        ('current', taxon_index_to_text)]:
+        times[label] = []
+        for idx in range(args.repeat):
+            # Both implementations sort the index in place, so use a fresh copy
+            index = copy.deepcopy(taxa)
+            start = time.perf_counter()
+            outputs[label] = str(func(index))
+            times[label].append(time.perf_counter() - start)
+
+        print('{:<10} best {:0.3f} s, mean {:0.3f} s'.format(
+                  label, min(times[label]), sum(times[label]) / args.repeat))
+
+    print('\nSpeed up: {:0.1f}x'.format(min(times['previous']) / min(times['current'])))
+
+    if outputs['previous'] != outputs['current']:
+        sys.exit('The HTML output differs between the implementations')
+
+    print('The HTML output is identical')
+
+
+main()
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+
+# Starts the resident dataset validation service. This needs to be run from the
+# web2py shell with the application models loaded, so that the database and site
+# config are available, and should be kept running by a process supervisor:
+#
+#   python web2py.py -S safe_web -M -R applications/safe_web/private/validator_service.py
+#
+# The service address and authkey are set in the [validation] section of appconfig.ini
+
+from safe_web_validator_service import serve
+
+serve()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for the parts of the Zenodo deposition API used by the
+safe_web_datasets module, so that publication can be tested and benchmarked
+without using Zenodo or the Zenodo sandbox. This only needs the standard library
+and is run directly:
+
+    python zenodo_emulator.py --port 8090 --latency 0.2 --fail-rate 0.05
+
+The application is then pointed at the emulator by setting api_url in the
+[zenodo] section of appconfig.ini to http://localhost:8090/api/. Any access token
+is accepted, but one must be provided. All deposits and files are held in memory
+and are lost when the emulator stops.
+
+The emulator covers:
+
+    POST   deposit/depositions                          create a deposit
+    GET    deposit/depositions/<id>                     get a deposit
+    PUT    deposit/depositions/<id>                     update deposit metadata
+    DELETE deposit/depositions/<id>                     delete an unpublished deposit
+    POST   deposit/depositions/<id>/actions/<action>    publish, edit, discard, newversion
+    GET    deposit/depositions/<id>/files               list deposit files
+    DELETE deposit/depositions/<id>/files/<file_id>     delete a deposit file
+    GET    files/<bucket>                               list bucket contents
+    PUT    files/<bucket>/<key>                         upload a file or a file part
+    POST   files/<bucket>/<key>?uploads                 start a multipart upload
+    GET    files/<bucket>/<key>?uploadId=<id>           list uploaded parts
+    POST   files/<bucket>/<key>?uploadId=<id>           complete a multipart upload
+
+File parts are uploaded with the uploadId and partNumber parameters and, as in the
+Invenio files REST API, are numbered from zero and the parts list is a JSON list.
+
+Each request is delayed by the latency plus a random jitter, and uploads are
+further delayed to simulate the upload bandwidth. Failures are injected at random
+at the given rate, optionally only for particular actions, and return the given
+HTTP status with a Zenodo style error body. Injected failures happen before a
+request is acted on.
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class ZenodoState(object):
+    """
+    Holds the deposits, buckets and multipart uploads of the emulator.
+    """
+
+    def __init__(self, base_url):
+
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.next_id = 1000000
+        self.deposits = {}
+        self.buckets = {}
+        self.uploads = {}
+
+    def new_id(self):
+
+        self.next_id += 1
+        return self.next_id
+
+    def new_deposit(self, concept_id=None, files=None):
+
+        dep_id = self.new_id()
+        concept_id = dep_id if concept_id is None else concept_id
+        bucket = str(uuid.uuid4())
+
+        self.buckets[bucket] = files or {}
+        self.deposits[dep_id] = {'id': dep_id, 'conceptrecid': str(concept_id),
+                                 'bucket': bucket, 'submitted': False,
+                                 'state': 'unsubmitted', 'metadata': {},
+                                 'latest_draft': None}
+        return self.deposits[dep_id]
+
+    def deposit_files(self, dep):
+
+        files = []
+        for key, obj in self.buckets[dep['bucket']].items():
+            files.append({'id': obj['id'], 'filename': key, 'filesize': obj['size'],
+                          'checksum': obj['md5'],
+                          'links': {'self': '{}deposit/depositions/{}/files/{}'.format(
+                                                self.base_url, dep['id'], obj['id']),
+                                    'download': '{}files/{}/{}'.format(
+                                                self.base_url, dep['bucket'], key)}})
+        return files
+
+    def deposit_json(self, dep):
+
+        base = '{}deposit/depositions/{}'.format(self.base_url, dep['id'])
+        concept = dep['conceptrecid']
+
+        links = {'self': base,
+                 'html': base,
+                 'files': base + '/files',
+                 'bucket': '{}files/{}'.format(self.base_url, dep['bucket']),
+                 'publish': base + '/actions/publish',
+                 'edit': base + '/actions/edit',
+                 'discard': base + '/actions/discard',
+                 'newversion': base + '/actions/newversion',
+                 'doi': 'https://doi.org/10.5072/zenodo.{}'.format(dep['id']),
+                 'badge': '{}badge/doi/10.5072/zenodo.{}.svg'.format(self.base_url, dep['id']),
+                 'conceptdoi': 'https://doi.org/10.5072/zenodo.{}'.format(concept),
+                 'conceptbadge': '{}badge/doi/10.5072/zenodo.{}.svg'.format(self.base_url, concept)}
+
+        if dep['latest_draft'] is not None:
+            links['latest_draft'] = '{}deposit/depositions/{}'.format(self.base_url,
+                                                                      dep['latest_draft'])
+
+        return {'id': dep['id'], 'record_id': dep['id'], 'conceptrecid': concept,
+                'doi': '10.5072/zenodo.{}'.format(dep['id']),
+                'doi_url': 'https://doi.org/10.5072/zenodo.{}'.format(dep['id']),
+                'submitted': dep['submitted'], 'state': dep['state'],
+                'metadata': dep['metadata'], 'files': self.deposit_files(dep),
+                'links': links}
+
+
+def error(status, message):
+
+    return status, {'status': status, 'message': message}
+
+
+class ZenodoHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the emulator. The server provides the shared state and
+    the latency and failure settings.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [('POST', r'deposit/depositions', 'create'),
+              ('GET', r'deposit/depositions/(\d+)', 'get'),
+              ('PUT', r'deposit/depositions/(\d+)', 'update'),
+              ('DELETE', r'deposit/depositions/(\d+)', 'delete'),
+              ('POST', r'deposit/depositions/(\d+)/actions/(\w+)', 'action'),
+              ('GET', r'deposit/depositions/(\d+)/files', 'list_files'),
+              ('DELETE', r'deposit/depositions/(\d+)/files/([\w-]+)', 'delete_file'),
+              ('GET', r'files/([\w-]+)', 'bucket'),
+              ('PUT', r'files/([\w-]+)/(.+)', 'put_object'),
+              ('POST', r'files/([\w-]+)/(.+)', 'multipart'),
+              ('GET', r'files/([\w-]+)/(.+)', 'list_parts')]
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def log_message(self, format, *args):
+
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def handle_request(self, method):
+
+        url = urlparse(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+
+        # The client joins some paths with a double slash, so normalise them
+        path = re.sub('/+', '/', url.path)
+        path = path[len('/api/'):] if path.startswith('/api/') else path.lstrip('/')
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            name = None
+
+        # Delay the response and inject failures
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if server.upload_rate and method == 'PUT' and name == 'put_object':
+            delay += len(body) / (server.upload_rate * 1024 ** 2)
+        time.sleep(delay)
+
+        action = match.group(2) if name == 'action' else name
+
+        if name is None:
+            status, content = error(404, 'The requested URL was not found on the server.')
+        elif 'access_token' not in params:
+            status, content = error(401, 'The server could not verify that you are authorized '
+                                         'to access the URL requested.')
+        elif (random.random() < server.fail_rate and
+                (not server.fail_actions or action in server.fail_actions)):
+            status, content = error(server.fail_status, 'Injected failure')
+        else:
+            with server.state.lock:
+                status, content = getattr(self, 'route_' + name)(server.state, params,
+                                                                 body, *match.groups())
+
+        self.send_json(status, content)
+
+    def send_json(self, status, content):
+
+        payload = b'' if content is None else json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Deposition routes
+
+    def get_deposit(self, state, dep_id):
+
+        return state.deposits.get(int(dep_id))
+
+    def route_create(self, state, params, body):
+
+        dep = state.new_deposit()
+        return 201, state.deposit_json(dep)
+
+    def route_get(self, state, params, body, dep_id):
+
+        dep = self.get_deposit(state, dep_id)
+        if dep is None:
+            return error(404, 'PID does not exist.')
+
+        return 200, state.deposit_json(dep)
+
+    def route_update(self, state, params, body, dep_id):
+
+        dep = self.get_deposit(state, dep_id)
+        if dep is None:
+            return error(404, 'PID does not exist.')
+        elif dep['state'] == 'done':
+            return error(400, 'Deposit is published and not in edit mode.')
+
+        try:
+            dep['metadata'] = json.loads(body)['metadata']
+        except (ValueError, KeyError):
+            return error(400, 'Validation error.')
+
+        return 200, state.deposit_json(dep)
+
+    def route_delete(self, state, params, body, dep_id):
+
+        dep = self.get_deposit(state, dep_id)
+        if dep is None:
+            return error(404, 'PID does not exist.')
+        elif dep['submitted']:
+            return error(403, 'Published deposits cannot be deleted.')
+
+        del state.deposits[dep['id']]
+        del state.buckets[dep['bucket']]
+        return 204, None
+
+    def route_action(self, state, params, body, dep_id, action):
+
+        dep = self.get_deposit(state, dep_id)
+        if dep is None:
+            return error(404, 'PID does not exist.')
+
+        if action == 'publish':
+            if dep['state'] == 'done':
+                return error(400, 'Deposit is already published.')
+            elif not state.buckets[dep['bucket']]:
+                return error(400, 'Minimum one file must be provided.')
+            elif not dep['metadata']:
+                return error(400, 'Validation error.')
+
+            dep['submitted'] = True
+            dep['state'] = 'done'
+
+            # Clear the latest draft link from the previous version
+            for other in state.deposits.values():
+                if other['latest_draft'] == dep['id']:
+                    other['latest_draft'] = None
+
+            return 202, state.deposit_json(dep)
+
+        elif action == 'edit':
+            if not dep['submitted']:
+                return error(400, 'Deposit is not published.')
+
+            dep['state'] = 'inprogress'
+            return 201, state.deposit_json(dep)
+
+        elif action == 'discard':
+            if dep['state'] != 'inprogress':
+                return error(400, 'Deposit is not being edited.')
+
+            dep['state'] = 'done'
+            return 201, state.deposit_json(dep)
+
+        elif action == 'newversion':
+            if not dep['submitted']:
+                return error(400, 'Only published deposits can have new versions.')
+
+            # The new draft starts with a copy of the files of the published version
+            files = {key: dict(obj, id=str(uuid.uuid4()))
+                     for key, obj in state.buckets[dep['bucket']].items()}
+            draft = state.new_deposit(concept_id=dep['conceptrecid'], files=files)
+            draft['metadata'] = dict(dep['metadata'])
+            dep['latest_draft'] = draft['id']
+
+            return 201, state.deposit_json(dep)
+
+        return error(404, 'Unknown action.')
+
+    def route_list_files(self, state, params, body, dep_id):
+
+        dep = self.get_deposit(state, dep_id)
+        if dep is None:
+            return error(404, 'PID does not exist.')
+
+        return 200, state.deposit_files(dep)
+
+    def route_delete_file(self, state, params, body, dep_id, file_id):
+
+        dep = self.get_deposit(state, dep_id)
+        if dep is None:
+            return error(404, 'PID does not exist.')
+        elif dep['state'] == 'done':
+            return error(400, 'Deposit is published and not in edit mode.')
+
+        bucket = state.buckets[dep['bucket']]
+        key = [k for k, obj in bucket.items() if obj['id'] == file_id]
+        if not key:
+            return error(404, 'File does not exist.')
+
+        del bucket[key[0]]
+        return 204, None
+
+    # Bucket routes
+
+    def route_bucket(self, state, params, body, bucket):
+
+        if bucket not in state.buckets:
+            return error(404, 'Bucket does not exist.')
+
+        contents = [{'key': key, 'size': obj['size'],
+                     'checksum': 'md5:' + obj['md5'] if obj['md5'] else None}
+                    for key, obj in state.buckets[bucket].items()]
+
+        return 200, {'contents': contents}
+
+    def route_put_object(self, state, params, body, bucket, key):
+
+        if bucket not in state.buckets:
+            return error(404, 'Bucket does not exist.')
+
+        # Upload a part of a multipart upload
+        if 'uploadId' in params:
+            upload = state.uploads.get(params['uploadId'][0])
+            if upload is None or upload['bucket'] != bucket or upload['key'] != key:
+                return error(404, 'Multipart upload does not exist.')
+
+            # Parts are numbered from zero and all but the last must be the
+            # part size, as in the Invenio files REST API
+            part = int(params['partNumber'][0])
+            last_part = upload['size'] // upload['part_size']
+            if upload['size'] % upload['part_size'] == 0:
+                last_part -= 1
+            expected = (upload['size'] % upload['part_size'] if part == last_part
+                        else upload['part_size'])
+
+            if part < 0 or part > last_part:
+                return error(400, 'Invalid part number.')
+            if len(body) != expected:
+                return error(400, 'Invalid part size.')
+
+            upload['parts'][part] = body
+            return 200, {'part_number': part, 'checksum': 'md5:' + hashlib.md5(body).hexdigest()}
+
+        obj = {'id': str(uuid.uuid4()), 'size': len(body), 'md5': hashlib.md5(body).hexdigest()}
+        state.buckets[bucket][key] = obj
+
+        return 200, {'key': key, 'size': obj['size'], 'checksum': 'md5:' + obj['md5']}
+
+    def route_multipart(self, state, params, body, bucket, key):
+
+        if bucket not in state.buckets:
+            return error(404, 'Bucket does not exist.')
+
+        # Start a multipart upload
+        if 'uploads' in params:
+            upload_id = str(uuid.uuid4())
+            state.uploads[upload_id] = {'bucket': bucket, 'key': key,
+                                        'size': int(params['size'][0]),
+                                        'part_size': int(params['partSize'][0]),
+                                        'parts': {}}
+            return 200, {'id': upload_id, 'key': key}
+
+        # Complete a multipart upload
+        upload = state.uploads.get(params.get('uploadId', [None])[0])
+        if upload is None or upload['bucket'] != bucket or upload['key'] != key:
+            return error(404, 'Multipart upload does not exist.')
+
+        data = b''.join(upload['parts'][part] for part in sorted(upload['parts']))
+        if len(data) != upload['size']:
+            return error(400, 'Not all parts have been uploaded.')
+
+        del state.uploads[params['uploadId'][0]]
+        state.buckets[bucket][key] = {'id': str(uuid.uuid4()), 'size': len(data),
+                                      'md5': hashlib.md5(data).hexdigest()}
+
+        return 200, {'key': key, 'size': len(data)}
+
+    def route_list_parts(self, state, params, body, bucket, key):
+
+        upload = state.uploads.get(params.get('uploadId', [None])[0])
+        if upload is None or upload['bucket'] != bucket or upload['key'] != key:
+            return error(404, 'Multipart upload does not exist.')
+
+        return 200, [{'part_number': part} for part in sorted(upload['parts'])]
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Run a local Zenodo deposition API emulator')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Base delay in seconds added to each request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Maximum random delay in seconds added to each request')
+    parser.add_argument('--upload-rate', type=float, default=0.0,
+                        help='Simulated upload bandwidth in MB/s, unlimited if zero')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='Proportion of requests that fail')
+    parser.add_argument('--fail-status', type=int, default=503,
+                        help='HTTP status returned by failed requests')
+    parser.add_argument('--fail-actions', default='',
+                        help='Comma separated actions to fail (e.g. publish,put_object), '
+                             'defaulting to all actions')
+    parser.add_argument('--quiet', action='store_true', help='Do not log requests')
+    args = parser.parse_args(args)
+
+    server = ThreadingHTTPServer((args.host, args.port), ZenodoHandler)
+    server.state = ZenodoState('http://{}:{}/api/'.format(args.host, args.port))
+    server.latency = args.latency
+    server.jitter = args.jitter
+    server.upload_rate = args.upload_rate
+    server.fail_rate = args.fail_rate
+    server.fail_status = args.fail_status
+    server.fail_actions = set(a for a in args.fail_actions.split(',') if a)
+    server.quiet = args.quiet
+
+    sys.stderr.write('Zenodo emulator running on http://{}:{}/api/\n'.format(args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
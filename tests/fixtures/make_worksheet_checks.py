@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Writes the dataset workbook used by test_worksheet_checks.py. The taxa in
+# the workbook are in the small GBIF backbone in worksheet_checks_gbif.sql and
+# the locations are in worksheet_checks_locations.json. Run this from the
+# fixtures directory to recreate the workbook after changing it.
+
+import datetime
+import openpyxl
+
+SUMMARY = [['SAFE Project ID', 1],
+           ['Access status', 'Open'],
+           ['Title', 'Worksheet check fixture'],
+           ['Description', 'A small dataset used to test worksheet checking'],
+           ['Keywords', 'test', 'fixture'],
+           ['Author name', 'Tester, A.'],
+           ['Author affiliation', 'Test University'],
+           ['Worksheet name', 'Counts', 'Traps', 'Visits'],
+           ['Worksheet title', 'Animal counts', 'Trap captures', 'Site visits'],
+           ['Worksheet description', 'Counts of animals at locations',
+            'Captures in traps at locations', 'Dates of site visits']]
+
+TAXA = [['Name', 'Taxon name', 'Taxon type', 'Parent name', 'Parent type'],
+        ['Orangutan', 'Pongo pygmaeus', 'Species', None, None],
+        ['Bearded pig', 'Sus barbatus', 'Species', None, None],
+        ['Pig tick', 'Tick sp. 1', 'Morphospecies', 'Sus', 'Genus']]
+
+LOCATIONS = [['Location name'], ['Site_A'], ['Site_B'], ['Site_C']]
+
+
+def data_sheet(descriptors, fields, rows):
+    """
+    Returns the rows of a data worksheet, with the descriptors in the first
+    column, followed by numbered rows of data.
+    """
+
+    sheet = [[desc] + [fld.get(desc) for fld in fields] for desc in descriptors]
+    sheet += [[idx + 1] + list(row) for idx, row in enumerate(rows)]
+    return sheet
+
+
+COUNTS = data_sheet(['field_type', 'description', 'units', 'method', 'taxon_field', 'field_name'],
+                    [{'field_type': 'Location', 'description': 'Site', 'field_name': 'site'},
+                     {'field_type': 'Date', 'description': 'Survey date', 'field_name': 'date'},
+                     {'field_type': 'Taxa', 'description': 'Animal', 'field_name': 'animal'},
+                     {'field_type': 'Abundance', 'description': 'Count', 'method': 'Survey',
+                      'taxon_field': 'animal', 'field_name': 'count'}],
+                    [('Site_A', datetime.datetime(2019, 3, 1), 'Orangutan', 2),
+                     ('Site_B', datetime.datetime(2019, 3, 2), 'Bearded pig', 5),
+                     ('Site_A', datetime.datetime(2019, 3, 4), 'Bearded pig', 1)])
+
+# The Traps worksheet uses a category that is not in the levels, to give errors
+TRAPS = data_sheet(['field_type', 'description', 'levels', 'units', 'method', 'field_name'],
+                   [{'field_type': 'Location', 'description': 'Trap site', 'field_name': 'site'},
+                    {'field_type': 'Date', 'description': 'Trap date', 'field_name': 'date'},
+                    {'field_type': 'Taxa', 'description': 'Catch', 'field_name': 'catch'},
+                    {'field_type': 'Categorical', 'description': 'Trap type',
+                     'levels': 'pitfall;malaise', 'field_name': 'trap'},
+                    {'field_type': 'Numeric', 'description': 'Trap weight', 'units': 'g',
+                     'method': 'Balance', 'field_name': 'weight'}],
+                   [('Site_B', datetime.datetime(2019, 2, 20), 'Pig tick', 'pitfall', 12.5),
+                    ('Site_C', datetime.datetime(2019, 2, 21), 'Pig tick', 'sticky', 3.2)])
+
+VISITS = data_sheet(['field_type', 'description', 'field_name'],
+                    [{'field_type': 'Location', 'description': 'Site visited', 'field_name': 'site'},
+                     {'field_type': 'Date', 'description': 'Visit date', 'field_name': 'date'},
+                     {'field_type': 'Comments', 'description': 'Notes', 'field_name': 'notes'}],
+                    [('Site_A', datetime.datetime(2019, 1, 10), 'First visit'),
+                     ('Site_C', datetime.datetime(2019, 4, 2), None)])
+
+
+def main():
+
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+
+    for title, rows in [('Summary', SUMMARY), ('Taxa', TAXA), ('Locations', LOCATIONS),
+                        ('Counts', COUNTS), ('Traps', TRAPS), ('Visits', VISITS)]:
+        ws = wb.create_sheet(title)
+        for row in rows:
+            ws.append(row)
+
+    wb.save('worksheet_checks.xlsx')
+
+
+if __name__ == '__main__':
+    main()
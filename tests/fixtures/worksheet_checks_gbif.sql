@@ -0,0 +1,17 @@
+-- A tiny GBIF backbone, holding the taxa used by worksheet_checks.xlsx and their
+-- parent taxa, in the format of the local GBIF database used by safedata_validator.
+CREATE TABLE backbone (id INTEGER PRIMARY KEY, parent_key INTEGER, canonical_name TEXT,
+                       rank TEXT, status TEXT, kingdom_key INTEGER, phylum_key INTEGER,
+                       class_key INTEGER, order_key INTEGER, family_key INTEGER,
+                       genus_key INTEGER, species_key INTEGER);
+INSERT INTO backbone VALUES (1, NULL, 'Animalia', 'KINGDOM', 'ACCEPTED', 1, NULL, NULL, NULL, NULL, NULL, NULL);
+INSERT INTO backbone VALUES (44, 1, 'Chordata', 'PHYLUM', 'ACCEPTED', 1, 44, NULL, NULL, NULL, NULL, NULL);
+INSERT INTO backbone VALUES (359, 44, 'Mammalia', 'CLASS', 'ACCEPTED', 1, 44, 359, NULL, NULL, NULL, NULL);
+INSERT INTO backbone VALUES (798, 359, 'Primates', 'ORDER', 'ACCEPTED', 1, 44, 359, 798, NULL, NULL, NULL);
+INSERT INTO backbone VALUES (731, 359, 'Artiodactyla', 'ORDER', 'ACCEPTED', 1, 44, 359, 731, NULL, NULL, NULL);
+INSERT INTO backbone VALUES (5483, 798, 'Hominidae', 'FAMILY', 'ACCEPTED', 1, 44, 359, 798, 5483, NULL, NULL);
+INSERT INTO backbone VALUES (9614, 731, 'Suidae', 'FAMILY', 'ACCEPTED', 1, 44, 359, 731, 9614, NULL, NULL);
+INSERT INTO backbone VALUES (2436436, 5483, 'Pongo', 'GENUS', 'ACCEPTED', 1, 44, 359, 798, 5483, 2436436, NULL);
+INSERT INTO backbone VALUES (2441212, 9614, 'Sus', 'GENUS', 'ACCEPTED', 1, 44, 359, 731, 9614, 2441212, NULL);
+INSERT INTO backbone VALUES (5219532, 2436436, 'Pongo pygmaeus', 'SPECIES', 'ACCEPTED', 1, 44, 359, 798, 5483, 2436436, 5219532);
+INSERT INTO backbone VALUES (7705930, 2441212, 'Sus barbatus', 'SPECIES', 'ACCEPTED', 1, 44, 359, 731, 9614, 2441212, 7705930);
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Tests of the part sizes used for multipart uploads to Zenodo. These use the
+# functions in modules/safe_web_multipart.py, which do not need web2py, so can
+# be run with:
+#
+#   python -m pytest tests/test_multipart.py
+#
+# The parts are checked against the part sizes that Invenio expects, following
+# MultipartObject.last_part_number and MultipartObject.last_part_size in
+# invenio_files_rest/models.py and the part size check in the part upload view
+# in invenio_files_rest/views.py, rather than against the repo's Zenodo emulator.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from safe_web_multipart import multipart_part_size, multipart_parts
+
+MB = 1024 * 1024
+
+# FILES_REST_MULTIPART_CHUNKSIZE_MIN in invenio_files_rest/config.py
+INVENIO_CHUNKSIZE_MIN = 5 * MB
+
+
+def invenio_part_sizes(size, chunk_size):
+    """
+    Returns the size Invenio expects for each part of a multipart upload, from
+    part zero to the last part number.
+    """
+
+    last_part_number = int(size / chunk_size) if size % chunk_size else int(size / chunk_size) - 1
+    last_part_size = size % chunk_size
+
+    return [last_part_size if part == last_part_number else chunk_size
+            for part in range(last_part_number + 1)]
+
+
+def upload_part_sizes(size, part_size):
+    """
+    Returns the sizes of the parts read from a file by upload_file_multipart.
+    """
+
+    part_size = multipart_part_size(size, part_size)
+
+    return [min(part_size, size - part * part_size)
+            for part in range(multipart_parts(size, part_size))]
+
+
+class TestMultipartParts(unittest.TestCase):
+
+    def check_parts(self, size, part_size):
+        """
+        The parts uploaded for a file cover the file and each part, including the
+        last, has the size that Invenio expects.
+        """
+
+        part_size = multipart_part_size(size, part_size)
+        parts = upload_part_sizes(size, part_size)
+
+        self.assertEqual(sum(parts), size)
+        self.assertTrue(all(parts))
+        self.assertEqual(parts, invenio_part_sizes(size, part_size))
+
+        return part_size
+
+    def test_invenio_rejects_exact_multiples(self):
+        """
+        Invenio expects an empty last part for a file that is an exact multiple of
+        the part size, so the full sized last part would be rejected.
+        """
+
+        self.assertEqual(invenio_part_sizes(3 * 10, 10), [10, 10, 0])
+
+    def test_non_multiples(self):
+        """
+        Files that are not an exact multiple of the part size use the part size.
+        """
+
+        for size in (11, 19, 21, 99, 101):
+            self.assertEqual(self.check_parts(size, 10), 10)
+
+        for size in (64 * MB + 1, 3 * 64 * MB - 1, 1000 * MB + 17):
+            self.assertEqual(self.check_parts(size, 64 * MB), 64 * MB)
+
+    def test_exact_multiples(self):
+        """
+        Files that are an exact multiple of the part size use a smaller part size.
+        """
+
+        for size in (20, 30, 100, 1000):
+            self.assertLess(self.check_parts(size, 10), 10)
+
+        for size in (2 * 64 * MB, 16 * 64 * MB, 1000 * 64 * MB):
+            part_size = self.check_parts(size, 64 * MB)
+            self.assertLess(part_size, 64 * MB)
+            self.assertGreaterEqual(part_size, INVENIO_CHUNKSIZE_MIN)
+
+    def test_multiple_of_smaller_part_size(self):
+        """
+        Files that are also an exact multiple of the next smaller part sizes use a
+        part size that does not divide the file.
+        """
+
+        self.assertEqual(self.check_parts(10 * 9 * 8, 10), 7)
+        self.assertEqual(self.check_parts(64 * MB * (64 * MB - 1), 64 * MB), 64 * MB - 2)
+
+    def test_all_small_sizes(self):
+        """
+        All file sizes larger than the part size give parts that Invenio accepts,
+        unless every smaller part size divides the file size.
+        """
+
+        for part_size in range(2, 20):
+            for size in range(part_size + 1, 20 * part_size):
+                if all(size % smaller == 0 for smaller in range(2, part_size + 1)):
+                    self.assertIsNone(multipart_part_size(size, part_size))
+                else:
+                    self.check_parts(size, part_size)
+
+    def test_no_part_size(self):
+        """
+        No part size is found when every smaller part size divides the file size.
+        """
+
+        self.assertIsNone(multipart_part_size(10 * 9 * 8 * 7, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
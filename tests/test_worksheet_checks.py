@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Tests of the sheet checks used by verify_dataset. These use the functions in
+# modules/safe_web_worksheet_checks.py, which do not need web2py, and a small
+# dataset in the fixtures directory, so can be run with:
+#
+#   python -m pytest tests/test_worksheet_checks.py
+#
+# The fixture dataset is checked against a tiny local GBIF database, built from
+# fixtures/worksheet_checks_gbif.sql, and a locations file, so no network access
+# is needed.
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import simplejson
+import safedata_validator
+from safedata_validator.safedata_validator import CH, DataWorksheet
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.insert(0, os.path.join(os.path.dirname(FIXTURES), '..', 'modules'))
+
+from safe_web_worksheet_checks import (ValidatorResources, get_sheet_fingerprints,
+                                       sheet_check_keys, load_metadata_sheets, load_worksheets)
+
+DATASET_FILE = os.path.join(FIXTURES, 'worksheet_checks.xlsx')
+LOCATIONS_FILE = os.path.join(FIXTURES, 'worksheet_checks_locations.json')
+
+CACHE_KEY = {'validator_version': safedata_validator.__version__,
+             'gazetteer_version': 'test',
+             'location_aliases_version': 'test',
+             'gbif_version': 'test'}
+
+
+def stored(value):
+    """
+    Returns a value as stored and loaded by a DAL json field, which stores
+    datetimes as strings.
+    """
+
+    return simplejson.loads(simplejson.dumps(value, default=lambda o: o.isoformat()[:19].replace('T', ' ')))
+
+
+class TestWorksheetChecks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.gbif_database = os.path.join(cls.tmpdir, 'gbif.sqlite')
+
+        with open(os.path.join(FIXTURES, 'worksheet_checks_gbif.sql')) as sql:
+            conn = sqlite3.connect(cls.gbif_database)
+            conn.executescript(sql.read())
+            conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.tmpdir)
+
+    def check_dataset(self, n_workers, previous=None, resources=None):
+        """
+        Checks the fixture dataset as verify_dataset does, reusing any previous
+        sheet checks and validator resources given, and returns the outcome of the
+        check as stored values along with the sheet checks and the stages that were run.
+        """
+
+        if resources is None:
+            resources = ValidatorResources()
+
+        dataset = resources.dataset(DATASET_FILE, [LOCATIONS_FILE, self.gbif_database],
+                                    gbif_database=self.gbif_database,
+                                    locations=LOCATIONS_FILE)
+        previous = previous or {}
+        timings = []
+
+        dataset.load_summary(validate_doi=False)
+        keys = sheet_check_keys(dataset, get_sheet_fingerprints(dataset), CACHE_KEY)
+        checks = load_metadata_sheets(dataset, keys, previous, timings)
+        checks['worksheets'] = load_worksheets(dataset, DATASET_FILE, keys['worksheets'],
+                                               previous.get('worksheets', {}), n_workers,
+                                               timings, resources=resources)
+        dataset.final_checks()
+
+        self.assertTrue(all(isinstance(dwsh, DataWorksheet) for dwsh in dataset.dataworksheets))
+
+        # The validator truncates the report without rewinding it when a dataset is
+        # created, which leaves null characters at the start of the report.
+        outcome = {'report': dataset.report().getvalue().replace('\x00', ''),
+                   'counters': dict(CH.counters),
+                   'metadata': stored(dataset.export_metadata_dict()),
+                   'taxon_index': stored(dataset.taxon_index),
+                   'location_index': stored(dataset.location_index),
+                   'passed': dataset.passed}
+
+        return outcome, stored(checks), [tm['stage'] for tm in timings]
+
+    def test_fixture_report(self):
+        """
+        The fixture dataset checks all sheets and fails on the bad trap category.
+        """
+
+        outcome, _, _ = self.check_dataset(n_workers=1)
+
+        self.assertFalse(outcome['passed'])
+        self.assertEqual(outcome['counters']['ERROR'], 1)
+        self.assertIn("missing from levels descriptor row: 'sticky'", outcome['report'])
+        for sheet in ('Taxa worksheet', 'Locations worksheet', 'data worksheet Counts',
+                      'data worksheet Traps', 'data worksheet Visits'):
+            self.assertIn('Checking ' + sheet, outcome['report'])
+
+    def test_serial_and_parallel_match(self):
+        """
+        Checking worksheets in a process pool gives the same report text, error
+        counts, metadata, including the extents, and outcome as checking them in turn.
+        """
+
+        serial, _, _ = self.check_dataset(n_workers=1)
+        parallel, _, stages = self.check_dataset(n_workers=3)
+
+        self.assertIn('load_worksheets_parallel', stages)
+        self.assertEqual(serial, parallel)
+
+    def test_held_resources_match(self):
+        """
+        Datasets created from held validator resources, including those created in
+        the process pool, give the same outcome as datasets that load the resources.
+        """
+
+        checked, _, _ = self.check_dataset(n_workers=1)
+
+        resources = ValidatorResources()
+        for n_workers in (1, 1, 3):
+            held, _, _ = self.check_dataset(n_workers=n_workers, resources=resources)
+            self.assertEqual(checked, held)
+
+    def test_reused_checks_match(self):
+        """
+        Reusing stored sheet checks gives the same outcome as checking the sheets.
+        """
+
+        checked, checks, _ = self.check_dataset(n_workers=1)
+        reused, _, stages = self.check_dataset(n_workers=1, previous=checks)
+
+        self.assertEqual(stages, ['reuse_taxa', 'reuse_locations'] + ['reuse_data_worksheet'] * 3)
+        self.assertEqual(checked, reused)
+
+    def test_changed_worksheet_is_checked(self):
+        """
+        A worksheet with a changed key is checked again, in the pool, and the other
+        stored checks are reused.
+        """
+
+        checked, checks, _ = self.check_dataset(n_workers=1)
+        checks['worksheets']['Counts']['key'] = 'changed'
+        checks['worksheets']['Traps']['key'] = 'changed'
+        reused, _, stages = self.check_dataset(n_workers=2, previous=checks)
+
+        self.assertEqual(stages.count('reuse_data_worksheet'), 1)
+        self.assertEqual(stages.count('load_data_worksheet'), 2)
+        self.assertEqual(checked, reused)
+
+
+if __name__ == '__main__':
+    unittest.main()